@@ -0,0 +1,167 @@
+"""Synthetic flibusta catalog of realistic size.
+
+The catalog has the same format as `catalog.txt` and, for a given seed,
+is always the same. Faker is only used to fill pools of names and words,
+the records themselves are drawn from the pools with a seeded random
+generator, so half a million books take seconds rather than minutes.
+
+Proportions follow the real catalog: most books are in Russian, about
+one book in six has more than one author (one card per author), a few
+prolific authors have hundreds of books, and many books belong to a
+series.
+
+    $ python benchmarks/catalog.py --books 500000 catalog.txt
+"""
+
+import itertools
+import random
+from argparse import ArgumentParser
+
+from faker import Faker
+
+from tamizdat.index import CATALOG_CSV_COLUMNS
+
+
+CATALOG_HEADER = ";".join(CATALOG_CSV_COLUMNS)
+
+LANGUAGES = {
+    "ru": 85, "en": 5, "uk": 3, "be": 1, "de": 1,
+    "fr": 1, "pl": 1, "bg": 1, "es": 1, "eo": 1}
+
+AUTHORS_PER_BOOK = {1: 83, 2: 12, 3: 4, 4: 1}
+
+LAST_NAME_ENDINGS = ("ов", "ев", "ин", "ский", "енко", "ук", "ич", "ян")
+
+
+class CatalogGenerator:
+    def __init__(self, num_books, seed=0):
+        self.num_books = num_books
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        fake = Faker("ru_RU")
+        fake.seed_instance(seed)
+
+        # Faker knows only a few hundred Russian words and last names, so
+        # both pools are grown by gluing stems and endings together. Title
+        # words are drawn with Zipf-like weights, as in natural language.
+        stems = sorted(set(
+            word for _ in range(200) for word in fake.words(50)))
+        self.words = sorted(set(stems) | set(
+            self.random.choice(stems)[:4] + self.random.choice(stems)[-3:]
+            for _ in range(50000)))
+        self.random.shuffle(self.words)
+        self.word_cum_weights = list(itertools.accumulate(
+            1 / rank for rank in range(1, len(self.words) + 1)))
+
+        self.last_names = sorted(set(
+            fake.last_name_male() for _ in range(5000)) | set(
+            self.random.choice(stems)[:5].capitalize() +
+            self.random.choice(LAST_NAME_ENDINGS)
+            for _ in range(20000)))
+        self.first_names = sorted(set(
+            fake.first_name_male() for _ in range(500)))
+        self.middle_names = sorted(set(
+            fake.middle_name_male() for _ in range(300)))
+
+        # Roughly one author per three books, and a long tail: the
+        # popularity of an author is drawn from a Pareto distribution.
+        self.authors = [
+            self._author()
+            for _ in range(max(1, num_books // 3))
+        ]
+        self.author_cum_weights = list(itertools.accumulate(
+            self.random.paretovariate(1.2)
+            for _ in self.authors))
+        self.series = [
+            self._phrase(1, 3)
+            for _ in range(max(1, num_books // 20))
+        ]
+
+    def _choice(self, weights):
+        choice, = self.random.choices(
+            list(weights), weights=list(weights.values()))
+        return choice
+
+    def _phrase(self, min_words, max_words, rng=None):
+        rng = rng or self.random
+        return " ".join(rng.choices(
+            self.words,
+            cum_weights=self.word_cum_weights,
+            k=rng.randint(min_words, max_words)))
+
+    def _author(self):
+        # Some authors only have a last name, like pseudonyms and
+        # collectives do in the real catalog.
+        if self.random.random() < 0.05:
+            return (self.random.choice(self.last_names), "", "")
+        return (
+            self.random.choice(self.last_names),
+            self.random.choice(self.first_names),
+            self.random.choice(self.middle_names)
+            if self.random.random() < 0.7 else "")
+
+    def _book(self, book_id):
+        return (
+            self._phrase(1, 5).capitalize(),
+            self._phrase(2, 6) if self.random.random() < 0.2 else "",
+            self._choice(LANGUAGES),
+            str(self.random.randint(1900, 2020))
+            if self.random.random() < 0.7 else "",
+            self.random.choice(self.series)
+            if self.random.random() < 0.4 else "",
+            str(book_id))
+
+    def cards(self):
+        for book_id in range(1, self.num_books + 1):
+            book = self._book(book_id)
+            num_authors = self._choice(AUTHORS_PER_BOOK)
+            authors = set(self.random.choices(
+                self.authors,
+                cum_weights=self.author_cum_weights,
+                k=num_authors))
+            for author in authors:
+                yield author + book
+
+    def lines(self):
+        yield CATALOG_HEADER + "\n"
+        for card in self.cards():
+            yield ";".join(card) + "\n"
+
+    def queries(self, num_queries):
+        # Queries have their own generator, so they do not depend on
+        # whether the catalog has been generated already.
+        rng = random.Random(self.seed + 1)
+        kinds = [
+            ("author", lambda: rng.choice(self.authors)[0]),
+            ("title", lambda: self._phrase(1, 2, rng)),
+            ("author_title", lambda: "{} {}".format(
+                rng.choice(self.authors)[0],
+                self._phrase(1, 1, rng))),
+            ("series", lambda: rng.choice(self.series)),
+            ("miss", lambda: "zzz{}".format(rng.randint(0, 10**6))),
+        ]
+        return [
+            (kind, make_query())
+            for _ in range(num_queries)
+            for kind, make_query in kinds
+        ]
+
+    def write(self, fd):
+        for line in self.lines():
+            fd.write(line)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--books", type=int, default=500000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("output", type=str)
+    args = parser.parse_args()
+
+    with open(args.output, "w") as fd:
+        CatalogGenerator(args.books, args.seed).write(fd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Peak RSS of building and sending an ebook email.
+
+Every attachment size is measured in a fresh interpreter, once with the
+streaming Mailer and once with the old in-memory MIMEApplication path,
+against an SMTP stand-in that throws the data away.
+
+    $ python benchmarks/email_memory.py 1 5 20 50
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from unittest.mock import Mock
+
+
+class NullSMTP:
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, sender):
+        return 250, b"OK"
+
+    def rcpt(self, recipient):
+        return 250, b"OK"
+
+    def putcmd(self, command):
+        self.replies = iter([(354, b"Go ahead"), (250, b"OK")])
+
+    def getreply(self):
+        return next(self.replies)
+
+    def send(self, data):
+        pass
+
+    def sendmail(self, sender, recipient, message):
+        pass
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(method, size_mb):
+    from tamizdat.email import Mailer
+
+    with tempfile.NamedTemporaryFile(suffix=".epub") as ebook_file:
+        chunk = os.urandom(1 << 20)
+        for _ in range(size_mb):
+            ebook_file.write(chunk)
+        ebook_file.flush()
+        del chunk
+
+        book = Mock(title="Title", annotation=None, author_list=[])
+        ebook = Mock()
+        ebook.file.local_path = ebook_file.name
+        user = Mock(email="reader@example.com")
+
+        mailer = Mailer("bot@example.com", "password", "localhost", 0)
+        server = NullSMTP()
+        baseline = peak_rss_mb()
+
+        if method == "streaming":
+            mailer.send(book, ebook, user, server)
+        else:
+            message = MIMEMultipart()
+            with open(ebook_file.name, "rb") as fd:
+                message.attach(MIMEApplication(fd.read()))
+            server.sendmail(mailer.login, user.email, str(message))
+
+        return peak_rss_mb() - baseline
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int, default=[1, 5, 20, 50])
+    parser.add_argument("--method", choices=["streaming", "inline"])
+    args = parser.parse_args()
+
+    if args.method:
+        size_mb, = args.sizes
+        print(measure(args.method, size_mb))
+        return
+
+    results = []
+    for size_mb in args.sizes:
+        row = {"size_mb": size_mb}
+        for method in ("streaming", "inline"):
+            output = subprocess.check_output([
+                sys.executable, __file__,
+                "--method", method, str(size_mb)])
+            row[method] = round(float(output), 1)
+        results.append(row)
+        print(
+            "{size_mb:4d} MB attachment: "
+            "streaming +{streaming:7.1f} MB, "
+            "inline +{inline:7.1f} MB".format(**row),
+            file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Rendering time of a ten book SearchResponse.
+
+Compares the response templates (included templates inlined, resolved
+once per class) with a plain environment that resolves the template on
+every response and every include on every book, as it used to.
+
+    $ python benchmarks/render.py
+"""
+
+import json
+import timeit
+from argparse import ArgumentParser
+from types import SimpleNamespace
+
+from faker import Faker
+from jinja2 import Environment, PackageLoader
+
+from tamizdat.response import SearchResponse
+
+
+fake = Faker("ru_RU")
+fake.seed_instance(0)
+
+
+def fake_books(num_books):
+    return [
+        SimpleNamespace(
+            book_id=fake.random_int(0, 100000),
+            title=fake.sentence(),
+            subtitle=fake.sentence(),
+            year=fake.random_int(1900, 2000),
+            series=fake.sentence(),
+            language=fake.random_element(["ru", "en", "de"]),
+            author_list=[
+                SimpleNamespace(
+                    first_name=fake.first_name_male(),
+                    middle_name=fake.middle_name_male(),
+                    last_name=fake.last_name_male())
+                for _ in range(fake.random_int(1, 3))
+            ])
+        for _ in range(num_books)
+    ]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--books", type=int, default=10)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    books = fake_books(args.books)
+    plain_environment = Environment(
+        loader=PackageLoader("tamizdat", "templates"),
+        lstrip_blocks=True,
+        trim_blocks=True)
+
+    def render_plain():
+        template = plain_environment.get_template("search_results.md")
+        return template.render(books=books).strip()
+
+    def render_inlined():
+        return str(SearchResponse(books))
+
+    assert render_plain() == render_inlined()
+
+    results = {}
+    for name, render in [("plain", render_plain), ("inlined", render_inlined)]:
+        best = min(timeit.repeat(render, number=args.number, repeat=5))
+        results[name] = round(best / args.number * 1e6, 1)
+
+    results["speedup"] = round(results["plain"] / results["inlined"], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
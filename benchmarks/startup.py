@@ -0,0 +1,88 @@
+"""Start-up time of the `tamizdat` command line.
+
+Runs a sub-command under `python -X importtime` and reports the total
+import time, the wall time and the heavy dependencies it pulled in.
+Exits with an error if a light sub-command imports one of them or if
+the import time goes above `--max-import-ms`.
+
+    $ python benchmarks/startup.py --database index.sqlite3 admin 1
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "..", "bin", "tamizdat")
+
+HEAVY_MODULES = (
+    "jinja2",
+    "lxml",
+    "requests",
+    "telegram",
+    "transliterate",
+    "validate_email")
+
+IMPORTTIME_LINE = re.compile(
+    r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+
+
+def run(arguments):
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", SCRIPT] + arguments,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True)
+    wall_time = time.perf_counter() - started
+
+    import_time = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, module = match.groups()
+        modules.add(module.split(".")[0])
+        if len(indent) == 1:
+            import_time += int(cumulative)
+
+    return wall_time * 1e3, import_time / 1e3, modules
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float)
+    parser.add_argument(
+        "--allow-heavy", action="store_true",
+        help="Do not fail if heavy dependencies are imported")
+    args, arguments = parser.parse_known_args()
+
+    runs = [run(arguments) for _ in range(args.repeat)]
+    wall_time = min(wall_time for wall_time, _, _ in runs)
+    import_time = min(import_time for _, import_time, _ in runs)
+    _, _, modules = runs[-1]
+    heavy = sorted(set(HEAVY_MODULES) & modules)
+
+    print(json.dumps({
+        "arguments": arguments,
+        "wall_ms": round(wall_time, 1),
+        "import_ms": round(import_time, 1),
+        "heavy_modules": heavy,
+    }, indent=2))
+
+    if heavy and not args.allow_heavy:
+        sys.exit("heavy modules imported: {}".format(", ".join(heavy)))
+    if args.max_import_ms and import_time > args.max_import_ms:
+        sys.exit("import time {:.1f} ms is above {:.1f} ms".format(
+            import_time, args.max_import_ms))
+
+
+if __name__ == "__main__":
+    main()
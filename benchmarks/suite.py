@@ -0,0 +1,266 @@
+"""Catalog import, search and rendering benchmarks.
+
+Generates a synthetic catalog (see `benchmarks/catalog.py`), imports it
+into a fresh database and measures
+
+* every phase of `Index.import_catalog`,
+* `Index.search` latency percentiles for a mix of queries, with warm
+  and cold SQLite page cache,
+* `Index.get` latency,
+* rendering of search and book info responses.
+
+Results are written as JSON. Given a previous result with `--compare`,
+the suite lists every timing that got slower by more than `--tolerance`
+and exits with an error if there are any.
+
+    $ python benchmarks/suite.py --books 500000 --output results.json
+    $ python benchmarks/suite.py --books 500000 --compare results.json
+"""
+
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from functools import wraps
+from types import FunctionType
+
+from tamizdat.index import Index
+from tamizdat.models import make_database
+
+from catalog import CatalogGenerator
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+
+    def percentile(fraction):
+        index = min(len(timings) - 1, int(fraction * len(timings)))
+        return round(timings[index] * 1e3, 3)
+
+    return {
+        "p50_ms": percentile(0.5),
+        "p90_ms": percentile(0.9),
+        "p99_ms": percentile(0.99),
+        "mean_ms": round(sum(timings) / len(timings) * 1e3, 3),
+    }
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return time.perf_counter() - started, result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def import_phases():
+    # Every non-static private method of Index is an import phase, so the
+    # suite keeps up when phases are added, renamed or dropped.
+    return [
+        name for name, attribute in vars(Index).items()
+        if name.startswith("_") and not name.startswith("__")
+        and isinstance(attribute, FunctionType)
+    ]
+
+
+def bench_import(index, generator, catalog_path):
+    phases = {}
+
+    def timing(name, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            elapsed, result = timed(lambda: method(*args, **kwargs))
+            phases[name] = round(phases.get(name, 0) + elapsed, 3)
+            return result
+        return wrapper
+
+    for name in import_phases():
+        setattr(index, name, timing(name, getattr(index, name)))
+
+    try:
+        with open(catalog_path) as catalog:
+            elapsed, _ = timed(lambda: index.import_catalog(catalog))
+    finally:
+        for name in import_phases():
+            delattr(index, name)
+
+    phases["total"] = round(elapsed, 3)
+    return phases
+
+
+def bench_search(index, generator, num_queries):
+    timings = {}
+    hits = {}
+    for kind, query in generator.queries(num_queries):
+        elapsed, books = timed(lambda: index.search(query))
+        timings.setdefault(kind, []).append(elapsed)
+        hits.setdefault(kind, []).append(len(books))
+
+    results = {
+        kind: dict(
+            percentiles(kind_timings),
+            hit_rate=round(
+                sum(1 for count in hits[kind] if count) / len(hits[kind]), 3))
+        for kind, kind_timings in timings.items()
+    }
+    results["all"] = percentiles([
+        elapsed
+        for kind_timings in timings.values()
+        for elapsed in kind_timings
+    ])
+    return results
+
+
+def bench_cold_search(index, generator, num_queries):
+    # Every query runs on a fresh connection, so SQLite's page cache is
+    # empty, while the operating system's one is not.
+    timings = []
+    for kind, query in generator.queries(num_queries):
+        index.database.close()
+        index.database.connect()
+        timings.append(timed(lambda: index.search(query))[0])
+    return percentiles(timings)
+
+
+def bench_get(index, num_books, num_queries):
+    rng = random.Random(0)
+    timings = [
+        timed(lambda: index.get(rng.randint(1, num_books)))[0]
+        for _ in range(num_queries)
+    ]
+    return percentiles(timings)
+
+
+def bench_render(index, generator, num_queries):
+    from tamizdat.response import BookInfoResponse, SearchResponse
+
+    search_timings = []
+    info_timings = []
+    for kind, query in generator.queries(num_queries):
+        books = index.search(query)
+        if not books:
+            continue
+        # Rendering includes the queries fired by templates, such as
+        # the authors of every book, as it does in the bot. Book info is
+        # shown for a book looked up by id, as /info does.
+        book = index.get(books[0].book_id)
+        search_timings.append(timed(lambda: str(SearchResponse(books)))[0])
+        info_timings.append(timed(lambda: str(BookInfoResponse(book)))[0])
+
+    return {
+        "search_results": percentiles(search_timings),
+        "book_info": percentiles(info_timings),
+    }
+
+
+def run(args):
+    directory = tempfile.mkdtemp()
+    catalog_path = os.path.join(directory, "catalog.txt")
+    database_path = os.path.join(directory, "index.sqlite3")
+
+    generator = CatalogGenerator(args.books, args.seed)
+    with open(catalog_path, "w") as catalog:
+        elapsed, _ = timed(lambda: generator.write(catalog))
+    print("Generated the catalog in {:.1f}s".format(elapsed), file=sys.stderr)
+
+    database = make_database(database_path)
+    index = Index(database)
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "books": args.books,
+            "seed": args.seed,
+            "queries": args.queries,
+        },
+    }
+
+    results["import_s"] = bench_import(index, generator, catalog_path)
+    print("Imported in {total}s".format(**results["import_s"]), file=sys.stderr)
+
+    database.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    results["database_bytes"] = os.path.getsize(database_path)
+    results["search"] = bench_search(index, generator, args.queries)
+    results["cold_search"] = bench_cold_search(
+        index, generator, max(1, args.queries // 5))
+    results["get"] = bench_get(index, args.books, args.queries * 5)
+    results["render"] = bench_render(index, generator, args.queries)
+
+    database.close()
+    for filename in os.listdir(directory):
+        os.remove(os.path.join(directory, filename))
+    os.rmdir(directory)
+    return results
+
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + ".")
+        elif key.endswith(("_ms", "_s")) or prefix.startswith("import_s."):
+            yield prefix + key, value
+
+
+def compare(baseline, results, tolerance):
+    current = dict(flatten(results))
+    regressions = []
+    for key, before in flatten(baseline):
+        after = current.get(key)
+        if after is None or not before:
+            continue
+        if after > before * (1 + tolerance):
+            regressions.append((key, before, after))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--books", type=int, default=500000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--queries", type=int, default=200,
+        help="Queries of every kind")
+    parser.add_argument("--output", type=str)
+    parser.add_argument("--compare", type=str)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(text)
+    print(text)
+
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+        regressions = compare(baseline, results, args.tolerance)
+        for key, before, after in regressions:
+            print(
+                "{}: {} -> {} ({:+.0%})".format(
+                    key, before, after, after / before - 1),
+                file=sys.stderr)
+        if regressions:
+            sys.exit("{} regressions".format(len(regressions)))
+
+
+if __name__ == "__main__":
+    main()
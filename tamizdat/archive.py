@@ -0,0 +1,166 @@
+import logging
+import os
+import re
+import struct
+import zipfile
+import zlib
+from os import path
+
+from .metrics import count_cache, instrument
+from .models import READER_FORMATS, ArchiveMember, Ebook, File
+
+
+# The library names the members of its archives after the books, as in
+# `f.fb2-123456-124000.zip/123457.fb2`.
+MEMBER_NAME = re.compile(
+    r"^(\d+)\.({})$".format("|".join(READER_FORMATS)), re.IGNORECASE)
+
+# The local file header that precedes the data of every member.
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class Archives:
+    # Local copies of the bulk archives of the library. The archives are
+    # scanned once, and a member is read afterwards by seeking right to
+    # it, without going through the central directory of the archive.
+
+    def __init__(self, chunk_size=1 << 16):
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def _members(filename):
+        with zipfile.ZipFile(filename) as archive:
+            for info in archive.infolist():
+                match = MEMBER_NAME.match(info.filename)
+                if not match:
+                    continue
+                book_id, format_ = match.groups()
+                yield {
+                    "book_id": int(book_id),
+                    "format": format_.lower(),
+                    "archive": filename,
+                    "offset": info.header_offset,
+                    "compress_type": info.compress_type,
+                    "compress_size": info.compress_size,
+                    "file_size": info.file_size,
+                    "crc": info.CRC,
+                }
+
+    def index(self, directory):
+        # Archives are scanned in the order of their names, so a book
+        # that has been repacked into a later archive is taken from it.
+        filenames = sorted(
+            path.abspath(path.join(directory, filename))
+            for filename in os.listdir(directory)
+            if filename.lower().endswith(".zip"))
+
+        indexed = 0
+        for filename in filenames:
+            try:
+                members = list(self._members(filename))
+            except (OSError, zipfile.BadZipFile) as error:
+                logging.error(
+                    "Skipping {}: {}".format(filename, error))
+                continue
+
+            logging.debug(
+                "Indexing {} books in {}".format(len(members), filename))
+            with ArchiveMember._meta.database.atomic():
+                for start in range(0, len(members), 1000):
+                    ArchiveMember.replace_many(
+                        members[start:start + 1000]).execute()
+            indexed += len(members)
+
+        logging.info(
+            "Indexed {} books in {} archives"
+            .format(indexed, len(filenames)))
+        return indexed
+
+    def find(self, book_id):
+        member = ArchiveMember.get_or_none(ArchiveMember.book_id == book_id)
+        count_cache("archive", member is not None)
+        return member
+
+    def read(self, member):
+        # The data of the member, in chunks, checked against the
+        # checksum of the central directory.
+        with open(member.archive, "rb") as fd:
+            fd.seek(member.offset)
+            header = fd.read(LOCAL_HEADER.size)
+            if len(header) < LOCAL_HEADER.size:
+                raise ArchiveError("Truncated {!r}".format(member))
+            signature, *_, name_length, extra_length = (
+                LOCAL_HEADER.unpack(header))
+            if signature != LOCAL_HEADER_SIGNATURE:
+                raise ArchiveError("No local header for {!r}".format(member))
+            fd.seek(name_length + extra_length, os.SEEK_CUR)
+
+            if member.compress_type == zipfile.ZIP_STORED:
+                decompressor = None
+            elif member.compress_type == zipfile.ZIP_DEFLATED:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            else:
+                raise ArchiveError(
+                    "Unsupported compression in {!r}".format(member))
+
+            crc = 0
+            remaining = member.compress_size
+            while remaining:
+                chunk = fd.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise ArchiveError("Truncated {!r}".format(member))
+                remaining -= len(chunk)
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+            if decompressor:
+                chunk = decompressor.flush()
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+
+            if crc != member.crc:
+                raise ArchiveError("Bad checksum of {!r}".format(member))
+
+    @instrument("extract")
+    def extract(self, member, filename):
+        # Written next to the target first, so that a reader never sees
+        # half of a book.
+        partial = "{}.part".format(filename)
+        try:
+            with open(partial, "wb") as fd:
+                for chunk in self.read(member):
+                    fd.write(chunk)
+            os.replace(partial, filename)
+        except BaseException:
+            if path.exists(partial):
+                os.remove(partial)
+            raise
+
+    def get_ebook(self, book, formats=READER_FORMATS):
+        # The ebook of the book from the archives, on disk where the
+        # library downloads would be, or None if it is not there.
+        member = self.find(book.book_id)
+        if not member or member.format not in formats:
+            return None
+
+        ebook = book.get_ebook([member.format])
+        if ebook is None:
+            ebook = Ebook(book=book.book_id, format=member.format)
+            ebook.file = File.create(
+                local_path="{}.{}".format(book.book_id, member.format))
+            ebook.save()
+        elif not ebook.file.local_path:
+            ebook.file.local_path = "{}.{}".format(
+                book.book_id, member.format)
+            ebook.file.save()
+
+        if not path.exists(ebook.file.local_path):
+            logging.info("Extracting {!r}".format(member))
+            self.extract(member, ebook.file.local_path)
+        return ebook
@@ -0,0 +1,48 @@
+import zipfile
+from os import path
+
+
+def ebook_size(item):
+    _, ebook = item
+    return path.getsize(ebook.file.local_path)
+
+
+def pack(items, limit, size=ebook_size):
+    # Books are packed into as few bundles of at most `limit` bytes as
+    # the first fit of the largest books first makes. A book larger than
+    # the limit gets a bundle of its own. The bundles keep the books in
+    # their order, and come in the order of their first books.
+    sizes = [size(item) for item in items]
+    order = sorted(range(len(items)), key=lambda number: -sizes[number])
+
+    bundles = []
+    for number in order:
+        for bundle in bundles:
+            if bundle["size"] + sizes[number] <= limit:
+                break
+        else:
+            bundle = {"size": 0, "items": []}
+            bundles.append(bundle)
+        bundle["size"] += sizes[number]
+        bundle["items"].append(number)
+
+    bundles.sort(key=lambda bundle: min(bundle["items"]))
+    return [
+        [items[number] for number in sorted(bundle["items"])]
+        for bundle in bundles
+    ]
+
+
+def write_zip(fd, files):
+    # The files are read and compressed a chunk at a time.
+    with zipfile.ZipFile(fd, "w", zipfile.ZIP_DEFLATED) as archive:
+        names = set()
+        for local_path, name in files:
+            stem, extension = path.splitext(name)
+            unique = name
+            copy = 1
+            while unique in names:
+                copy += 1
+                unique = "{} ({}){}".format(stem, copy, extension)
+            names.add(unique)
+            archive.write(local_path, unique)
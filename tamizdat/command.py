@@ -1,68 +1,154 @@
 import logging
+import math
+import os
+import re
 import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from telegram.ext.updater import Updater
 
 from validate_email import validate_email
 
-from .models import User
+from .archive import ArchiveError
+from .index import ITEMS_PER_PAGE, TimeLimitExceeded
+from .inline import Debouncer, PrefixCache
+from .metrics import COMMANDS, count_cache, instrument
+from .models import (
+    BOOK_CACHE, READER_FORMATS, EmailJob, TelegramFile, User)
+from .profiling import SamplingProfiler, directory_size, rss_bytes
+from .scheduler import SchedulerError
 from .response import (
     NoResponse,
     UserNotFoundResponse,
     UserAuthorizedResponse,
     NewUserAdminNotification,
     BookNotFoundResponse,
-    EmailSentResponse,
+    EbookNotFoundResponse,
+    EmailQueuedResponse,
     EmailFailedResponse,
+    RateLimitedResponse,
+    BusyResponse,
+    LibraryUnavailableResponse,
     SearchResponse,
+    InlineSearchResponse,
+    AuthorBooksResponse,
+    SeriesBooksResponse,
     BookInfoResponse,
     DownloadResponse,
+    BundleResponse,
+    ProfileStartedResponse,
+    ProfileResponse,
+    StatsResponse,
     SettingsResponse,
     SettingsEmailChooseResponse,
     SettingsEmailSetResponse,
     SettingsEmailInvalidResponse)
 from .system import stop_bot
+from .tracing import TRACER, current_trace, span
+
+
+# Requests to the library that have not started this many seconds after
+# the command did are dropped, the user has given up on them by then.
+FETCH_TIMEOUT = 60
+
+# Search filters, as in `lang:ru year:1990..2000 series:"Мир Полудня"`.
+# Telegram clients tend to replace the straight quotes with curly ones.
+SEARCH_FILTER = re.compile(
+    r'\b(lang|year|series):(?:["“«]([^"”»]*)["”»]?|(\S+))')
+YEARS = re.compile(r"^(\d{4})?(?:(\.\.)(\d{4})?)?$")
+
+# An inline query is sent on every keystroke and an answer that comes
+# late is of no use, so the index gets this many seconds for it.
+INLINE_TIME_LIMIT = 1
+# Telegram shows at most this many inline results.
+INLINE_RESULTS = 50
+
+# A command sends at most this many books, of a series for example, and
+# fetches this many of them at once.
+MAX_BUNDLE = 20
+BUNDLE_FETCHES = 4
 
 
 class Command:
+    # Set to an outbox to serve the responses through.
+    outbox = None
+
     def prepare(self, bot, message):
         pass
 
     def execute(self, bot, message, *args):
         raise NotImplementedError()
 
+    @instrument("handle")
     def handle(self, bot, message, *args):
         response = self.prepare(bot, message)
-        if response:
-            return response
-        return self.execute(bot, message, *args)
+        if not response:
+            response = self.execute(bot, message, *args)
+        COMMANDS.labels(type(self).__name__, type(response).__name__).inc()
+        return response
+
+    @instrument("serve")
+    def respond(self, response, bot, message):
+        with span("telegram", type(response).__name__):
+            return response.serve(bot, message)
+
+    def process(self, update, bot, message, *args):
+        with TRACER.trace(
+            type(self).__name__,
+            update_id=update.update_id,
+            chat_id=message.chat.id
+        ) as trace:
+            response = self.handle(bot, message, *args)
+            trace.set(outcome=type(response).__name__)
+            return self.deliver(response, bot, message)
+
+    def deliver(self, response, bot, message):
+        if self.outbox:
+            # The reply is sent after the trace of the update is over,
+            # so it gets a trace of its own, linked by the attributes.
+            trace = current_trace()
+            attributes = {}
+            if trace:
+                attributes = dict(trace.attributes, command=trace.name)
+            return self.outbox.put(
+                message.chat.id, partial(self.reply, response, attributes),
+                bot, message)
+        return self.respond(response, bot, message)
+
+    def reply(self, response, attributes, bot, message):
+        with TRACER.trace("Reply", **attributes) as trace:
+            trace.set(response=type(response).__name__)
+            return self.respond(response, bot, message)
 
     def handle_message(self, update, context):
         message = update.message
-        response = self.handle(context.bot, message, message.text)
-        return response.serve(context.bot, message)
+        return self.process(update, context.bot, message, message.text)
 
     def handle_command(self, update, context):
         message = update.message
-        response = self.handle(context.bot, message, *context.args)
-        return response.serve(context.bot, message)
+        return self.process(update, context.bot, message, *context.args)
 
     def handle_callback(self, update, context):
         message = update.callback_query.message
-        response = self.handle(context.bot, message, *context.args)
-        return response.serve(context.bot, message)
+        return self.process(update, context.bot, message, *context.args)
 
     def handle_command_regex(self, update, context):
         message = update.message
-        response = self.handle(context.bot, message, *context.match.groups())
-        return response.serve(context.bot, message)
+        return self.process(
+            update, context.bot, message, *context.match.groups())
 
     def handle_callback_regex(self, update, context):
         message = update.callback_query.message
-        response = self.handle(context.bot, message, *context.match.groups())
-        return response.serve(context.bot, message)
+        return self.process(
+            update, context.bot, message, *context.match.groups())
 
 
 class UserCommand(Command):
+    rate_limiter = None
+
     def get_user(self, user_id):
         return User.get_or_none(User.user_id == user_id)
 
@@ -83,6 +169,13 @@ class UserCommand(Command):
 
         self.user = user
 
+        limiter = self.rate_limiter
+        if limiter and not user.is_admin and not limiter.allow(user.user_id):
+            logging.info(
+                "Rate limited {} from user {}"
+                .format(type(self).__name__, user.user_id))
+            return RateLimitedResponse(limiter.retry_after(user.user_id))
+
 
 class AdminCommand(UserCommand):
     def prepare(self, bot, message):
@@ -134,21 +227,59 @@ class SettingsEmailSetCommand(UserCommand):
 
 
 class SearchCommand(UserCommand):
-    def __init__(self, index):
+    def __init__(self, index, rate_limiter=None):
         self.index = index
+        self.rate_limiter = rate_limiter
         self.translator = str.maketrans(dict.fromkeys(string.punctuation))
 
+    @staticmethod
+    def parse_years(text):
+        match = YEARS.match(text)
+        if not match:
+            return None
+        first, dots, last = match.groups()
+        if not (first or last):
+            return None
+        first = int(first) if first else None
+        last = int(last) if last else None
+        return (first, last) if dots else (first, first)
+
+    def parse(self, text):
+        filters = {}
+
+        def add_filter(match):
+            name, quoted, plain = match.groups()
+            value = quoted if quoted is not None else plain
+            if name == "lang":
+                filters["language"] = value.lower()
+            elif name == "year":
+                years = self.parse_years(value)
+                if years:
+                    filters["years"] = years
+            elif name == "series":
+                filters["series"] = value.translate(self.translator)
+            return " "
+
+        search_term = SEARCH_FILTER.sub(add_filter, text)
+        return search_term.translate(self.translator).strip(), filters
+
     def execute(self, bot, message, search_term):
-        search_term = search_term.translate(self.translator)
-        books = self.index.search(search_term)
+        search_term, filters = self.parse(search_term)
+        books = self.index.search(search_term, **filters)
         if not books:
             return BookNotFoundResponse()
-        return SearchResponse(books)
+
+        # A full page with no filters is where narrowing the search down
+        # helps the most.
+        facets = None
+        if not filters and len(books) >= ITEMS_PER_PAGE:
+            facets = self.index.facets()
+        return SearchResponse(books, facets)
 
 
 class MessageCommand(UserCommand):
-    def __init__(self, index):
-        self.search_command = SearchCommand(index)
+    def __init__(self, index, rate_limiter=None):
+        self.search_command = SearchCommand(index, rate_limiter)
         self.settings_email_set_command = SettingsEmailSetCommand()
 
     def execute(self, bot, message, text):
@@ -158,66 +289,470 @@ class MessageCommand(UserCommand):
             return self.search_command.handle(bot, message, text)
 
 
+class InlineSearchCommand(Command):
+    # Searches from `@bot query` in any chat. The queries are answered
+    # on threads of their own, so the dispatcher only notes that a query
+    # came and is free to notice that the next one supersedes it.
+
+    def __init__(
+        self,
+        index,
+        rate_limiter=None,
+        debouncer=None,
+        cache=None,
+        executor=None,
+        time_limit=INLINE_TIME_LIMIT
+    ):
+        self.index = index
+        self.rate_limiter = rate_limiter
+        self.debouncer = debouncer or Debouncer()
+        self.cache = PrefixCache() if cache is None else cache
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="inline")
+        self.time_limit = time_limit
+
+    def search(self, user, text):
+        books = self.cache.get(text)
+        count_cache("inline", books is not None)
+        if books is not None:
+            return books
+
+        limiter = self.rate_limiter
+        if limiter and not user.is_admin and not limiter.allow(user.user_id):
+            logging.info(
+                "Rate limited {} from user {}"
+                .format(type(self).__name__, user.user_id))
+            return None
+
+        books = self.index.search(
+            PrefixCache.key(text), items_per_page=INLINE_RESULTS, prefix=True)
+        self.cache.put(text, books, len(books) < INLINE_RESULTS)
+        return books
+
+    def execute(self, bot, query, text):
+        user = User.get_or_none(User.user_id == query.from_user.id)
+        if not user or not user.is_authorized or not PrefixCache.key(text):
+            return NoResponse()
+
+        try:
+            with self.index.time_limit(self.time_limit):
+                books = self.search(user, text)
+                if books is None:
+                    return NoResponse()
+                uploads = self.index.uploaded_ebooks(
+                    books, bot.id, user.preferred_formats)
+        except TimeLimitExceeded:
+            logging.warning(
+                "Inline query {!r} took longer than {}s"
+                .format(text, self.time_limit))
+            return NoResponse()
+        return InlineSearchResponse(books, uploads)
+
+    def process(self, update, bot, query, *args):
+        with TRACER.trace(
+            type(self).__name__,
+            update_id=update.update_id,
+            chat_id=query.from_user.id
+        ) as trace:
+            response = self.handle(bot, query, *args)
+            trace.set(outcome=type(response).__name__)
+            return self.respond(response, bot, query)
+
+    def answer(self, update, bot, query, deadline):
+        if not self.debouncer.settle(query.from_user.id, query.id, deadline):
+            return
+        try:
+            self.process(update, bot, query, query.query)
+        except Exception as error:
+            logging.error(
+                "Failed to answer inline query: {}".format(error),
+                exc_info=True)
+
+    def handle_inline_query(self, update, context):
+        query = update.inline_query
+        deadline = self.debouncer.arrive(query.from_user.id, query.id)
+        return self.executor.submit(
+            self.answer, update, context.bot, query, deadline)
+
+
+class ListingCommand(UserCommand):
+    def __init__(self, index, rate_limiter=None):
+        self.index = index
+        self.rate_limiter = rate_limiter
+
+    @staticmethod
+    def page(page_number, count):
+        pages = max(1, math.ceil(count / ITEMS_PER_PAGE))
+        return min(max(1, int(page_number)), pages), pages
+
+
+class AuthorCommand(ListingCommand):
+    def execute(self, bot, message, author_id, page_number=1):
+        author = self.index.get_author(int(author_id))
+        if not author:
+            return BookNotFoundResponse()
+
+        page_number, pages = self.page(
+            page_number, self.index.count_author_books(author.author_id))
+        books = self.index.author_books(author.author_id, page_number)
+        return AuthorBooksResponse(author, books, page_number, pages)
+
+
+class SeriesCommand(ListingCommand):
+    def execute(self, bot, message, series_id, page_number=1):
+        series = self.index.get_series(int(series_id))
+        if not series:
+            return BookNotFoundResponse()
+
+        page_number, pages = self.page(page_number, series.books)
+        books = self.index.series_books(series.series_id, page_number)
+        return SeriesBooksResponse(series, books, page_number, pages)
+
+
 class BookInfoCommand(UserCommand):
-    def __init__(self, index, website):
+    def __init__(self, index, website, rate_limiter=None, fetch_limit=None):
         self.index = index
         self.website = website
+        self.rate_limiter = rate_limiter
+        self.fetch_limit = fetch_limit
+
+    def download_cover(self, bot, book, deadline):
+        # Covers that have not been uploaded yet are downloaded first,
+        # so the response can upload them and send the Telegram id
+        # from then on.
+        cover = book.cover_image
+        if not cover or cover.get_telegram_id(bot.id):
+            return
+        try:
+            self.website.download_file(cover, deadline=deadline)
+        except Exception as error:
+            logging.warning(
+                "Could not download the cover of book_id={}: {!r}"
+                .format(book.book_id, error))
+
+    def augment(self, bot, book, deadline):
+        try:
+            self.website.fetch_additional_info(book, deadline=deadline)
+        except (SchedulerError, OSError) as error:
+            logging.warning(
+                "Showing book_id={} without additional info: {!r}"
+                .format(book.book_id, error))
+        else:
+            self.download_cover(bot, book, deadline)
 
     def execute(self, bot, message, book_id):
+        deadline = time.monotonic() + FETCH_TIMEOUT
         book = self.index.get(book_id)
         if not book:
             return BookNotFoundResponse()
-        self.website.fetch_additional_info(book)
+
+        # The library is asked within the fetch slots the downloads
+        # take. When they are all taken, the book is shown with what is
+        # already known of it.
+        if not self.fetch_limit:
+            self.augment(bot, book, deadline)
+            return BookInfoResponse(book)
+        with self.fetch_limit.slot() as acquired:
+            if acquired:
+                self.augment(bot, book, deadline)
+            else:
+                logging.info(
+                    "Showing book_id={} as is, fetches are busy"
+                    .format(book_id))
         return BookInfoResponse(book)
 
 
 class DownloadCommand(UserCommand):
-    def __init__(self, index, website):
+    def __init__(
+        self,
+        index,
+        website,
+        formats=READER_FORMATS,
+        converter=None,
+        attachment_cache=None,
+        rate_limiter=None,
+        fetch_limit=None,
+        archives=None
+    ):
         self.index = index
         self.website = website
+        self.formats = formats
+        self.converter = converter
+        self.attachment_cache = attachment_cache
+        self.rate_limiter = rate_limiter
+        self.fetch_limit = fetch_limit
+        self.archives = archives
+
+    def target_format(self, source_format):
+        target_format, *_ = self.formats
+        if not self.converter:
+            return source_format
+        if not self.converter.can_convert(source_format, target_format):
+            return source_format
+        return target_format
+
+    def convert(self, book, ebook):
+        target_format = self.target_format(ebook.format)
+        if target_format == ebook.format:
+            return ebook
 
-    def execute(self, bot, message, book_id):
+        try:
+            return self.converter.convert_ebook(book, ebook, target_format)
+        except Exception as error:
+            logging.error(
+                "Failed to convert ebook: {}".format(error), exc_info=True)
+            return ebook
+
+    def book_ids(self, args):
+        # As in `/download 1 2 3` or `/download series 42`.
+        if len(args) == 2 and args[0] == "series":
+            books = self.index.series_books(int(args[1]), 1, MAX_BUNDLE)
+            return [book.book_id for book in books]
+        return list(args[:MAX_BUNDLE])
+
+    def execute(self, bot, message, book_id, *args):
+        if not args:
+            return self.fetch_one(book_id)
+        try:
+            book_ids = self.book_ids((book_id, ) + args)
+        except ValueError:
+            return BookNotFoundResponse()
+        if not book_ids:
+            return BookNotFoundResponse()
+        return self.fetch_slot(self.fetch_bundle, self.charge(book_ids))
+
+    def charge(self, book_ids):
+        # The command has paid for the first book of a bundle, the others
+        # are paid for one by one, and the ones left unpaid are dropped.
+        limiter = self.rate_limiter
+        if not limiter or self.user.is_admin:
+            return book_ids
+        paid = 1
+        while paid < len(book_ids) and limiter.allow(self.user.user_id):
+            paid += 1
+        if paid < len(book_ids):
+            logging.info(
+                "Rate limited {} of {} books from user {}"
+                .format(len(book_ids) - paid, len(book_ids),
+                        self.user.user_id))
+        return book_ids[:paid]
+
+    def fetch_one(self, book_id):
+        response = self.fetch_local(book_id)
+        if response:
+            return response
+        return self.fetch_slot(self.fetch, book_id)
+
+    def fetch_slot(self, fetch, *args):
+        # When all the outbound fetch slots are taken, the user is told
+        # to come back later rather than left waiting in a queue.
+        if not self.fetch_limit:
+            return fetch(*args)
+        with self.fetch_limit.slot() as acquired:
+            if not acquired:
+                return BusyResponse()
+            return fetch(*args)
+
+    def fetch_bundle(self, book_ids):
+        def fetch(book_id):
+            return self.fetch_local(book_id) or self.fetch(book_id)
+
+        # Every fetch of a bundle running at once takes a slot of its
+        # own. The bundle has one already, and when the others are taken
+        # it is fetched a book at a time.
+        most = min(BUNDLE_FETCHES, len(book_ids))
+        with ExitStack() as slots:
+            fetches = most
+            if self.fetch_limit:
+                fetches = 1
+                while fetches < most:
+                    if not slots.enter_context(self.fetch_limit.slot()):
+                        break
+                    fetches += 1
+
+            with ThreadPoolExecutor(fetches) as executor:
+                responses = list(executor.map(fetch, book_ids))
+
+        items = [
+            (response.book, response.ebook)
+            for response in responses
+            if isinstance(response, DownloadResponse)
+        ]
+        if not items:
+            # Nothing to bundle, what went wrong with the first book is
+            # told instead.
+            return responses[0]
+        if len(items) < len(responses):
+            logging.warning(
+                "Only {} of {} books fetched for {}"
+                .format(len(items), len(responses), book_ids))
+        return BundleResponse(items)
+
+    def library_has_better(self, book, format_):
+        # Whether the library has a format the user prefers to the one
+        # served from the archives, downloaded already.
+        for preferred in self.formats:
+            if preferred == format_:
+                return False
+            ebook = book.get_ebook([preferred])
+            if (
+                ebook and ebook.file.remote_url and
+                ebook.file.local_path and
+                os.path.exists(ebook.file.local_path)
+            ):
+                return True
+        return False
+
+    def fetch_local(self, book_id):
+        # Books in the local archives are served, converted if need be,
+        # without asking the library. The library is left to serve the
+        # books the archives have in no format the user reads, and the
+        # ones it has in a better format on disk.
+        if not self.archives:
+            return None
+        book = self.index.get(book_id)
+        if not book:
+            return None
+        member = self.archives.find(book.book_id)
+        if not member:
+            return None
+
+        format_ = self.target_format(member.format)
+        if format_ not in self.formats:
+            return None
+        if self.library_has_better(book, format_):
+            return None
+
+        # A book extracted, or converted, before is served as it is.
+        ebook = book.get_ebook([format_])
+        if not (
+            ebook and ebook.file.local_path and
+            os.path.exists(ebook.file.local_path)
+        ):
+            try:
+                ebook = self.archives.get_ebook(book, [member.format])
+            except (OSError, ArchiveError) as error:
+                logging.error(
+                    "Failed to read book_id={} from the archives: {}"
+                    .format(book_id, error), exc_info=True)
+                return None
+            if not ebook:
+                return None
+
+            ebook = self.convert(book, ebook)
+            book = self.index.get(book_id)
+            if ebook.format not in self.formats:
+                return None
+
+        logging.info(
+            "Serving {} ebook for book_id={} from the archives"
+            .format(ebook.format, book_id))
+        if self.attachment_cache:
+            self.attachment_cache.warm_async(ebook)
+        return DownloadResponse(book, ebook)
+
+    def fetch(self, book_id):
+        deadline = time.monotonic() + FETCH_TIMEOUT
         book = self.index.get(book_id)
         if not book:
             return BookNotFoundResponse()
 
-        logging.info("Asked for ebook for book_id={}".format(book_id))
+        # Errors of the library itself, requests included, are told
+        # apart from the failures of the download below.
+        try:
+            self.website.fetch_additional_info(book, deadline=deadline)
+        except (SchedulerError, OSError) as error:
+            logging.warning(
+                "Library unavailable for book_id={}: {!r}"
+                .format(book_id, error))
+            return LibraryUnavailableResponse()
+        ebook = book.get_ebook(self.formats)
+        if not ebook:
+            return EbookNotFoundResponse()
+
+        logging.info(
+            "Asked for {} ebook for book_id={}"
+            .format(ebook.format, book_id))
         try:
-            self.website.download_file(book.ebook_epub)
+            self.website.download_file(ebook.file, deadline=deadline)
+            ebook = self.convert(book, ebook)
+            if self.attachment_cache:
+                self.attachment_cache.warm_async(ebook)
             if book.cover_image:
-                self.website.download_file(book.cover_image)
+                self.website.download_file(book.cover_image, deadline=deadline)
+        except SchedulerError as error:
+            logging.warning(
+                "Library unavailable for book_id={}: {!r}"
+                .format(book_id, error))
+            return LibraryUnavailableResponse()
         except Exception as error:
             logging.error(
                 "Failed to download file: {}".format(error), exc_info=True)
             return EmailFailedResponse(self.user)
         else:
-            return DownloadResponse(book)
+            return DownloadResponse(book, ebook)
 
 
 class EmailCommand(UserCommand):
-    def __init__(self, index, website, mailer):
+    def __init__(
+        self,
+        index,
+        website,
+        mail_queue,
+        converter=None,
+        attachment_cache=None,
+        rate_limiter=None,
+        fetch_limit=None,
+        archives=None
+    ):
         self.index = index
         self.website = website
-        self.mailer = mailer
+        self.mail_queue = mail_queue
+        self.converter = converter
+        self.attachment_cache = attachment_cache
+        self.rate_limiter = rate_limiter
+        self.fetch_limit = fetch_limit
+        self.archives = archives
+
+    def execute(self, bot, message, book_id, *args):
+        if self.user.email is None:
+            return SettingsEmailChooseCommand().handle(bot, message)
 
-    def execute(self, bot, message, book_id):
-        download = DownloadCommand(self.index, self.website)
-        response = download.handle(bot, message, book_id)
-        if isinstance(response, BookNotFoundResponse):
+        formats = self.user.preferred_formats
+        # The nested download is run for the user of this command, which
+        # has paid for the first book already.
+        download = DownloadCommand(
+            self.index, self.website, formats,
+            self.converter, self.attachment_cache,
+            rate_limiter=self.rate_limiter,
+            fetch_limit=self.fetch_limit,
+            archives=self.archives)
+        download.user = self.user
+        response = download.execute(bot, message, book_id, *args)
+        if isinstance(response, BundleResponse):
+            return self.enqueue_bundle(response.items)
+        # Whatever went wrong with the download is told to the user.
+        if not isinstance(response, DownloadResponse):
             return response
 
-        if self.user.email is None:
-            return SettingsEmailChooseCommand().handle(bot, message)
+        try:
+            self.mail_queue.enqueue(response.book, response.ebook, self.user)
+        except Exception as error:
+            logging.error(
+                "Failed queueing email: {}".format(error), exc_info=True)
+            return EmailFailedResponse(self.user)
+        else:
+            return EmailQueuedResponse(self.user)
 
-        book = self.index.get(book_id)
+    def enqueue_bundle(self, items):
         try:
-            self.mailer.send(book, self.user)
+            self.mail_queue.enqueue_bundle(items, self.user)
         except Exception as error:
             logging.error(
-                "Failed sending email: {}".format(error), exc_info=True)
+                "Failed queueing email: {}".format(error), exc_info=True)
             return EmailFailedResponse(self.user)
         else:
-            return EmailSentResponse(self.user)
+            return EmailQueuedResponse(self.user)
 
 
 class RestartCommand(AdminCommand):
@@ -227,3 +762,94 @@ class RestartCommand(AdminCommand):
     def execute(self, *_):
         logging.info("Received restart command. Exiting")
         stop_bot(self.updater)
+
+
+class ProfileCommand(AdminCommand):
+    def __init__(self, profiler=None, max_seconds=300):
+        self.profiler = profiler or SamplingProfiler()
+        self.max_seconds = max_seconds
+
+    def profile(self, bot, message, seconds):
+        try:
+            profile = self.profiler.profile(seconds)
+            self.deliver(ProfileResponse(profile), bot, message)
+        except Exception as error:
+            logging.error("Profiling failed: {}".format(error), exc_info=True)
+
+    def execute(self, bot, message, seconds="10"):
+        # The profile is collected on a thread of its own, so the
+        # dispatcher keeps serving the updates that are being profiled.
+        try:
+            seconds = min(max(int(seconds), 1), self.max_seconds)
+        except ValueError:
+            seconds = 10
+        logging.info("Profiling the dispatcher for {}s".format(seconds))
+        threading.Thread(
+            target=self.profile,
+            args=(bot, message, seconds),
+            daemon=True).start()
+        return ProfileStartedResponse(seconds)
+
+
+class StatsCommand(AdminCommand):
+    def __init__(
+        self,
+        database,
+        updater=None,
+        mail_queue=None,
+        converter=None,
+        attachment_cache=None,
+        website=None
+    ):
+        self.database = database
+        self.updater = updater
+        self.mail_queue = mail_queue
+        self.converter = converter
+        self.attachment_cache = attachment_cache
+        self.website = website
+
+    def database_size(self):
+        filenames = [self.database.database, self.database.database + "-wal"]
+        catalog_address = getattr(self.database, "catalog_address", None)
+        if catalog_address:
+            filenames.append(catalog_address)
+        return sum(
+            os.path.getsize(filename)
+            for filename in filenames
+            if os.path.exists(filename))
+
+    def execute(self, *_):
+        queues = {}
+        if self.updater:
+            queues["updates"] = self.updater.update_queue.qsize()
+        if self.mail_queue:
+            queues["emails"] = (
+                EmailJob
+                .select()
+                .where(EmailJob.status.in_(
+                    (EmailJob.PENDING, EmailJob.SENDING)))
+                .count())
+        if self.converter:
+            queues["conversions"] = len(self.converter.pending)
+        if self.website:
+            queues["library"] = self.website.scheduler.queue_depth()
+        if self.outbox:
+            queues["replies"] = self.outbox.queue_depth()
+
+        caches = {
+            "books": (len(BOOK_CACHE), None),
+            "telegram_files": (TelegramFile.select().count(), None),
+        }
+        if self.attachment_cache:
+            caches["attachments"] = directory_size(
+                self.attachment_cache.cache_dir)
+        if self.converter:
+            caches["conversions"] = directory_size(self.converter.cache_dir)
+
+        return StatsResponse({
+            "rss": rss_bytes(),
+            "database": self.database_size(),
+            "threads": threading.active_count(),
+            "queues": queues,
+            "caches": caches,
+        })
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+
+from .metrics import count_cache
+from .models import Ebook, File
+
+
+SOURCE_FORMATS = ("fb2", "epub")
+TARGET_FORMATS = ("epub", "mobi", "azw3")
+
+
+class Converter:
+    def can_convert(self, source_format, target_format):
+        return (
+            source_format != target_format and
+            source_format in SOURCE_FORMATS and
+            target_format in TARGET_FORMATS)
+
+    def convert(self, source_path, target_path):
+        raise NotImplementedError()
+
+
+class CalibreConverter(Converter):
+    def __init__(self, executable="ebook-convert", timeout=120):
+        self.executable = executable
+        self.timeout = timeout
+
+    def convert(self, source_path, target_path):
+        subprocess.run(
+            [self.executable, source_path, target_path],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=self.timeout,
+            check=True)
+
+
+def _run_converter(converter, source_path, target_path):
+    # Converters write to a temporary name first, so a half-written
+    # file left by a killed worker is never mistaken for a cached one.
+    _, extension = path.splitext(target_path)
+    partial_path = "{}.partial{}".format(target_path, extension)
+    converter.convert(source_path, partial_path)
+    os.replace(partial_path, target_path)
+    return target_path
+
+
+class ConversionPool:
+    def __init__(
+        self,
+        converter,
+        cache_dir="converted",
+        max_workers=2,
+        timeout=180,
+        executor=None
+    ):
+        self.converter = converter
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.executor = executor or ProcessPoolExecutor(max_workers)
+
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    @staticmethod
+    def _hash(filename):
+        digest = hashlib.sha256()
+        with open(filename, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1 << 16), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _cache_path(self, source_path, target_format):
+        return path.join(
+            self.cache_dir,
+            "{}.{}".format(self._hash(source_path), target_format))
+
+    def can_convert(self, source_format, target_format):
+        return self.converter.can_convert(source_format, target_format)
+
+    def convert(self, source_path, target_format):
+        target_path = self._cache_path(source_path, target_format)
+        cached = path.exists(target_path)
+        count_cache("conversion", cached)
+        if cached:
+            logging.debug("Conversion cache hit {}".format(target_path))
+            return target_path
+
+        with self.lock:
+            future = self.pending.get(target_path)
+            submitted = not future
+            if submitted:
+                logging.info(
+                    "Converting {} to {}".format(source_path, target_format))
+                os.makedirs(self.cache_dir, exist_ok=True)
+                future = self.executor.submit(
+                    _run_converter,
+                    self.converter, source_path, target_path)
+                self.pending[target_path] = future
+
+        # A future that is already done runs the callback right away,
+        # so it is added once the lock is released.
+        if submitted:
+            future.add_done_callback(lambda _: self._forget(target_path))
+        return future.result(timeout=self.timeout)
+
+    def _forget(self, target_path):
+        with self.lock:
+            self.pending.pop(target_path, None)
+
+    def convert_ebook(self, book, ebook, target_format):
+        local_path = self.convert(ebook.file.local_path, target_format)
+
+        # A conversion is recorded once, so the file keeps the Telegram
+        # ids it has been uploaded under. The ebooks the library has in
+        # the format itself, with a remote file, are never replaced, but
+        # one that was never downloaded is kept on disk as converted.
+        converted = Ebook.get_or_none(
+            (Ebook.book == book.book_id) & (Ebook.format == target_format))
+        if not converted:
+            converted = Ebook(book=book, format=target_format)
+        elif converted.file.local_path == local_path:
+            return converted
+        elif converted.file.remote_url:
+            if converted.file.local_path and path.exists(
+                converted.file.local_path
+            ):
+                raise ValueError(
+                    "{!r} is in the library, not converting"
+                    .format(converted))
+            converted.file.local_path = local_path
+            converted.file.save()
+            return converted
+        converted.file = File.create(local_path=local_path)
+        converted.save()
+        return converted
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -1,11 +1,95 @@
-from email.mime.application import MIMEApplication
+import base64
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.generator import BytesGenerator
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.policy import SMTP as SMTP_POLICY
 from email.utils import formatdate
-from os.path import basename
-from smtplib import SMTP_SSL
+from io import BytesIO
+from os import path
+from smtplib import (
+    SMTP, SMTP_SSL,
+    SMTPDataError, SMTPException,
+    SMTPRecipientsRefused, SMTPSenderRefused)
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from uuid import uuid4
 
+from tamizdat.bundle import ebook_size, pack
+from tamizdat.metrics import count_cache, instrument
+from tamizdat.models import EmailAttachment, EmailJob
 from tamizdat.response import environment
+from tamizdat.tracing import TRACER, span
+
+
+# The attachment is base64-encoded into the message in chunks of this
+# many bytes. It is a multiple of 57, so every chunk makes whole 76
+# character lines.
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+# Messages up to this size are assembled in memory, bigger ones spill
+# over to a temporary file.
+SPOOL_MAX_SIZE = 1 << 20
+
+# Messages are sent to the server in blocks of this size.
+SEND_BLOCK_SIZE = 1 << 16
+
+# Larger messages are turned down by the mail providers. Amazon takes up
+# to 50 megabytes sent to a Kindle address.
+MESSAGE_SIZE_LIMIT = 25 << 20
+KINDLE_MESSAGE_SIZE_LIMIT = 50 << 20
+
+
+def message_size(item):
+    # Base64 takes a third more, and the rest of the message is small.
+    return ebook_size(item) * 4 // 3 + 4096
+
+
+def encode_attachment(source, fd):
+    for chunk in iter(lambda: source.read(ATTACHMENT_CHUNK_SIZE), b""):
+        fd.write(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+
+
+class AttachmentCache:
+    def __init__(self, cache_dir="attachments"):
+        self.cache_dir = cache_dir
+        self.executor = ThreadPoolExecutor(1)
+
+    def path(self, ebook):
+        return path.join(
+            self.cache_dir,
+            "{}.{}.b64".format(ebook.book_id, ebook.format))
+
+    def is_fresh(self, ebook):
+        cached_path = self.path(ebook)
+        return (
+            path.exists(cached_path) and
+            path.getmtime(cached_path) >= path.getmtime(ebook.file.local_path))
+
+    def warm(self, ebook):
+        cached_path = self.path(ebook)
+        fresh = self.is_fresh(ebook)
+        count_cache("attachment", fresh)
+        if fresh:
+            return cached_path
+
+        logging.debug("Encoding attachment {}".format(cached_path))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(ebook.file.local_path, "rb") as source, \
+                NamedTemporaryFile(
+                    dir=self.cache_dir, delete=False) as fd:
+            encode_attachment(source, fd)
+        os.replace(fd.name, cached_path)
+        return cached_path
+
+    def warm_async(self, ebook):
+        return self.executor.submit(self.warm, ebook)
 
 
 class Mailer:
@@ -15,41 +99,363 @@ class Mailer:
         password: str,
         host: str,
         port: int,
+        use_ssl: bool = True,
+        attachment_cache: AttachmentCache = None,
     ):
         self.host = host
         self.port = port
         self.login = login
         self.password = password
+        self.use_ssl = use_ssl
+        self.attachment_cache = attachment_cache
 
-    def prepare_message(self, book, user):
+    def prepare_message(self, items, user, placeholder):
+        book, _ = items[0]
         authors = environment.get_template("authors.md").render(book=book)
         title = book.title
         subject = "{}. {}".format(authors, title)
+        if len(items) > 1:
+            subject = "{} и ещё {}".format(subject, len(items) - 1)
 
-        message = MIMEMultipart()
+        message = MIMEMultipart(policy=SMTP_POLICY)
         message["From"] = self.login
         message["To"] = user.email
         message["Date"] = formatdate()
         message["Subject"] = subject
 
-        if book.annotation:
-            message.attach(MIMEText(book.annotation))
+        if len(items) == 1 and book.annotation:
+            message.attach(MIMEText(book.annotation, policy=SMTP_POLICY))
 
-        with open(book.ebook_mobi.local_path, "rb") as fd:
-            filename = basename(book.ebook_mobi.local_path)
-            attachment = MIMEApplication(
-                fd.read(), Name=filename)
+        for _, ebook in items:
+            filename = path.basename(ebook.file.local_path)
+            attachment = MIMEBase(
+                "application", "octet-stream",
+                policy=SMTP_POLICY, Name=filename)
+            attachment["Content-Transfer-Encoding"] = "base64"
             attachment["Content-Disposition"] = (
                 "attachment; filename={}".format(filename))
+            attachment.set_payload(placeholder)
             message.attach(attachment)
 
         return message
 
-    def send(self, book, user):
-        message = self.prepare_message(book, user)
-        server = SMTP_SSL(self.host, self.port)
+    def _write_attachment(self, fd, ebook):
+        if self.attachment_cache:
+            with open(self.attachment_cache.warm(ebook), "rb") as encoded:
+                shutil.copyfileobj(encoded, fd)
+            return
+
+        with open(ebook.file.local_path, "rb") as source:
+            encode_attachment(source, fd)
+
+    def write_bundle(self, fd, items, user):
+        # The message skeleton is rendered by the email package with
+        # placeholders in place of the attachments, and the placeholders
+        # are then replaced with the files encoded chunk by chunk, so the
+        # ebooks are never held in memory as a whole. The placeholder is
+        # unique to the message, so the annotation cannot contain it.
+        placeholder = "--attachment-{}--".format(uuid4().hex)
+        skeleton = BytesIO()
+        BytesGenerator(skeleton).flatten(
+            self.prepare_message(items, user, placeholder))
+        head, *tails = skeleton.getvalue().split(
+            placeholder.encode() + b"\r\n")
+        if len(tails) != len(items):
+            raise ValueError("Found {} attachment placeholders for {} books"
+                             .format(len(tails), len(items)))
+
+        fd.write(head)
+        for (_, ebook), tail in zip(items, tails):
+            self._write_attachment(fd, ebook)
+            fd.write(tail)
+
+    def write_message(self, fd, book, ebook, user):
+        self.write_bundle(fd, [(book, ebook)], user)
+
+    def _send_data(self, server, recipient, fd):
+        server.ehlo_or_helo_if_needed()
+
+        code, response = server.mail(self.login)
+        if code != 250:
+            server.rset()
+            raise SMTPSenderRefused(code, response, self.login)
+
+        code, response = server.rcpt(recipient)
+        if code not in (250, 251):
+            server.rset()
+            raise SMTPRecipientsRefused({recipient: (code, response)})
+
+        server.putcmd("data")
+        code, response = server.getreply()
+        if code != 354:
+            raise SMTPDataError(code, response)
+
+        # The lines that start with a dot get another one, see RFC 5321,
+        # a block at a time. A block that ends mid-line tells whether the
+        # next one starts a line.
+        line_start = True
+        for block in iter(lambda: fd.read(SEND_BLOCK_SIZE), b""):
+            block = block.replace(b"\n.", b"\n..")
+            if line_start and block.startswith(b"."):
+                block = b"." + block
+            line_start = block.endswith(b"\n")
+            server.send(block)
+        server.send(b".\r\n" if line_start else b"\r\n.\r\n")
+
+        code, response = server.getreply()
+        if code != 250:
+            raise SMTPDataError(code, response)
+
+    def connect(self):
+        smtp_class = SMTP_SSL if self.use_ssl else SMTP
+        server = smtp_class(self.host, self.port)
 
         server.ehlo()
         server.login(self.login, self.password)
-        server.sendmail(self.login, user.email, str(message))
-        server.close()
+        return server
+
+    @instrument("send_email")
+    def send_bundle(self, items, user, server=None):
+        with SpooledTemporaryFile(SPOOL_MAX_SIZE) as fd:
+            self.write_bundle(fd, items, user)
+            fd.seek(0)
+
+            with span("smtp", user.email):
+                if server:
+                    self._send_data(server, user.email, fd)
+                    return
+
+                server = self.connect()
+                try:
+                    self._send_data(server, user.email, fd)
+                finally:
+                    server.close()
+
+    def send(self, book, ebook, user, server=None):
+        self.send_bundle([(book, ebook)], user, server)
+
+
+class SMTPPool:
+    def __init__(self, connect, size=2, keepalive=60):
+        self.connect = connect
+        self.keepalive = keepalive
+
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except (SMTPException, OSError):
+            server.close()
+
+    @staticmethod
+    def _is_alive(server):
+        try:
+            status, _ = server.noop()
+            return status == 250
+        except (SMTPException, OSError):
+            return False
+
+    def _take_idle(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return None, None
+
+    @contextmanager
+    def connection(self):
+        with self.slots:
+            server, last_used = self._take_idle()
+            if server and time.monotonic() - last_used > self.keepalive:
+                if not self._is_alive(server):
+                    logging.debug("Dropping stale SMTP connection")
+                    server.close()
+                    server = None
+
+            if not server:
+                logging.debug("Opening new SMTP connection")
+                server = self.connect()
+
+            try:
+                yield server
+            except (SMTPException, OSError):
+                server.close()
+                raise
+            finally:
+                if server.sock:
+                    with self.lock:
+                        self.idle.append((server, time.monotonic()))
+
+    def ping(self):
+        # Servers drop idle sessions after a while, so the idle connections
+        # are NOOP-ed from time to time and the dead ones are dropped.
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        alive = []
+        for server, last_used in idle:
+            if time.monotonic() - last_used < self.keepalive:
+                alive.append((server, last_used))
+            elif self._is_alive(server):
+                alive.append((server, time.monotonic()))
+            else:
+                server.close()
+
+        with self.lock:
+            self.idle.extend(alive)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for server, _ in idle:
+            self._close(server)
+
+
+class MailQueue:
+    def __init__(
+        self,
+        mailer,
+        notify=None,
+        pool_size=2,
+        max_attempts=5,
+        backoff=30,
+        poll_interval=1,
+        keepalive=60,
+        lease=600,
+    ):
+        self.mailer = mailer
+        self.notify = notify
+        self.pool = SMTPPool(mailer.connect, pool_size, keepalive)
+        self.executor = ThreadPoolExecutor(pool_size)
+
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.lease = lease
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enqueue(self, book, ebook, user):
+        job = EmailJob.create(user=user, book=book, ebook=ebook)
+        logging.info("Queued {}".format(job))
+        return job
+
+    def enqueue_bundle(self, items, user):
+        # Several books go in as few messages as the size limit of the
+        # recipient allows.
+        limit = (
+            KINDLE_MESSAGE_SIZE_LIMIT if user.is_kindle
+            else MESSAGE_SIZE_LIMIT)
+        jobs = []
+        with EmailJob._meta.database.atomic():
+            for bundle in pack(items, limit, message_size):
+                (book, ebook), *extra = bundle
+                job = EmailJob.create(user=user, book=book, ebook=ebook)
+                for book, ebook in extra:
+                    EmailAttachment.create(job=job, book=book, ebook=ebook)
+                jobs.append(job)
+        logging.info("Queued {}".format(jobs))
+        return jobs
+
+    def due_jobs(self):
+        return list(
+            EmailJob
+            .select()
+            .where(
+                (EmailJob.status == EmailJob.PENDING) &
+                (EmailJob.next_attempt_at <= time.time()))
+            .order_by(EmailJob.job_id))
+
+    def claim(self, job):
+        # A job is sent by the worker that claims it first, so a job
+        # seen by two pollers is sent once. The claim runs out after a
+        # while, and the job of a worker that died is sent again.
+        claimed = (
+            EmailJob
+            .update(
+                status=EmailJob.SENDING,
+                next_attempt_at=time.time() + self.lease)
+            .where(
+                (EmailJob.job_id == job.job_id) &
+                (EmailJob.status == EmailJob.PENDING))
+            .execute())
+        return claimed == 1
+
+    def release_stale(self):
+        released = (
+            EmailJob
+            .update(status=EmailJob.PENDING)
+            .where(
+                (EmailJob.status == EmailJob.SENDING) &
+                (EmailJob.next_attempt_at <= time.time()))
+            .execute())
+        if released:
+            logging.warning("Released {} stale email jobs".format(released))
+        return released
+
+    def deliver(self, job):
+        with self.pool.connection() as server:
+            self.mailer.send_bundle(job.attachments(), job.user, server)
+
+    def process(self, job):
+        if not self.claim(job):
+            logging.debug("{} is taken by another worker".format(job))
+            return
+        with TRACER.trace("EmailJob", job_id=job.job_id) as trace:
+            self._process(job)
+            trace.set(outcome=job.status)
+
+    def _process(self, job):
+        job.attempts += 1
+        try:
+            self.deliver(job)
+        except Exception as error:
+            logging.error(
+                "Failed sending {}: {}".format(job, error), exc_info=True)
+            job.error = str(error)
+            if job.attempts < self.max_attempts:
+                job.status = EmailJob.PENDING
+                job.next_attempt_at = (
+                    time.time() + self.backoff * 2 ** (job.attempts - 1))
+                job.save()
+                return
+            job.status = EmailJob.FAILED
+        else:
+            job.status = EmailJob.SENT
+            job.error = None
+
+        job.save()
+        if self.notify:
+            self.notify(job)
+
+    def process_pending(self):
+        jobs = self.due_jobs()
+        list(self.executor.map(self.process, jobs))
+        return len(jobs)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.process_pending()
+                self.pool.ping()
+            except Exception as error:
+                logging.error(
+                    "Mail queue failure: {}".format(error), exc_info=True)
+            self.stopped.wait(self.poll_interval)
+        self.pool.close()
+
+    def start(self):
+        self.release_stale()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.executor.shutdown()
@@ -1,6 +1,16 @@
 import logging
+import sqlite3
+import time
+from contextlib import contextmanager
 
-from .models import Author, Book, BookAuthors, CardIndex, Card
+from peewee import JOIN, OperationalError, fn
+
+from .metrics import count_cache, instrument
+from .models import (
+    BOOK_CACHE, CATALOG_MODELS, READER_FORMATS,
+    Author, AuthorListing, Book, BookAuthors, BookIndex, BookInfo, Card,
+    DecadeFacet, Ebook, File, LanguageFacet, Series, SeriesListing,
+    TelegramFile)
 
 
 CATALOG_CSV_COLUMNS = (
@@ -27,9 +37,18 @@ CATALOG_DB_COLUMNS = (
     "book_id")
 
 
+ITEMS_PER_PAGE = 10
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
 class Index:
-    def __init__(self, database):
+    def __init__(self, database, cache=BOOK_CACHE):
         self.database = database
+        self.cache = cache
+        self._facets = None
 
     @staticmethod
     def _split_line(line):
@@ -53,6 +72,7 @@ class Index:
             record["year"] = int(record["year"])
         except ValueError:
             record["year"] = None
+        record["language"] = record["language"].lower()
 
         card = Card(**record)
         return card
@@ -75,6 +95,7 @@ class Index:
 
         with self.database.atomic():
             logging.debug("Adding the cards")
+            self.database.create_tables([Card])
             peewee_logger = logging.getLogger("peewee")
             peewee_logger.setLevel(logging.INFO)
             Card.bulk_create(catalog_cards, batch_size=1000)
@@ -144,48 +165,410 @@ class Index:
                     Author.author_id
                 ]).execute()
 
-    def _prepare_card_index(self):
-        cards = Card.select(
-            Card.card_id,
-            Card.last_name,
-            Card.first_name,
-            Card.middle_name,
-            Card.title,
-            Card.subtitle,
-            Card.series)
+    def _prepare_book_index(self):
+        # One row per book, keyed by the book id, with all the authors
+        # of the book in one column.
+        full_name = (
+            fn.COALESCE(Author.last_name, "").concat(" ")
+            .concat(fn.COALESCE(Author.first_name, "")).concat(" ")
+            .concat(fn.COALESCE(Author.middle_name, "")))
+
+        books = (
+            Book
+            .select(
+                Book.book_id,
+                fn.GROUP_CONCAT(full_name, ", "),
+                Book.title,
+                Book.subtitle,
+                Book.series)
+            .join(
+                BookAuthors, JOIN.LEFT_OUTER,
+                on=(Book.book_id == BookAuthors.book_id))
+            .join(
+                Author, JOIN.LEFT_OUTER,
+                on=(BookAuthors.author_id == Author.author_id))
+            .group_by(Book.book_id))
 
         with self.database.atomic():
             logging.debug("Preparing fulltext index")
-            CardIndex.insert_from(
-                cards, [
-                    CardIndex.rowid,
-                    CardIndex.last_name,
-                    CardIndex.first_name,
-                    CardIndex.middle_name,
-                    CardIndex.title,
-                    CardIndex.subtitle,
-                    CardIndex.series
-                ]
-            ).execute()
-
-    def import_catalog(self, catalog):
+            BookIndex.insert_from(books, [
+                BookIndex.rowid,
+                BookIndex.authors,
+                BookIndex.title,
+                BookIndex.subtitle,
+                BookIndex.series
+            ]).execute()
+
+    def _prepare_facets(self):
+        languages = (
+            Book
+            .select(Book.language, fn.COUNT(Book.id))
+            .where(Book.language.is_null(False) & (Book.language != ""))
+            .group_by(Book.language))
+
+        decade = Book.year / 10 * 10
+        decades = (
+            Book
+            .select(decade, fn.COUNT(Book.id))
+            .where(Book.year.is_null(False))
+            .group_by(decade))
+
+        with self.database.atomic():
+            logging.debug("Counting the books by language and decade")
+            LanguageFacet.insert_from(languages, [
+                LanguageFacet.language,
+                LanguageFacet.books
+            ]).execute()
+            DecadeFacet.insert_from(decades, [
+                DecadeFacet.decade,
+                DecadeFacet.books
+            ]).execute()
+
+    def _prepare_listings(self):
+        series = (
+            Book
+            .select(Book.series, fn.COUNT(Book.id))
+            .where(Book.series.is_null(False) & (Book.series != ""))
+            .group_by(Book.series))
+
+        order = (
+            Book.year.asc(nulls="LAST"),
+            Book.title,
+            Book.book_id)
+
+        author_books = (
+            BookAuthors
+            .select(
+                BookAuthors.author_id,
+                fn.ROW_NUMBER().over(
+                    partition_by=[BookAuthors.author_id],
+                    order_by=order),
+                Book.book_id)
+            .join(Book, on=(BookAuthors.book_id == Book.book_id)))
+
+        series_books = (
+            Book
+            .select(
+                Series.series_id,
+                fn.ROW_NUMBER().over(
+                    partition_by=[Series.series_id],
+                    order_by=order),
+                Book.book_id)
+            .join(Series, on=(Book.series == Series.name)))
+
+        with self.database.atomic():
+            logging.debug("Listing the books of every author and series")
+            Series.insert_from(series, [
+                Series.name,
+                Series.books
+            ]).execute()
+            AuthorListing.insert_from(author_books, [
+                AuthorListing.author,
+                AuthorListing.position,
+                AuthorListing.book
+            ]).execute()
+            SeriesListing.insert_from(series_books, [
+                SeriesListing.series,
+                SeriesListing.position,
+                SeriesListing.book
+            ]).execute()
+
+    def _compact(self, page_size=None):
+        # The cards are only needed to put the books, the authors and
+        # the index together. What is left is rewritten into a file
+        # without the free pages and with fresh statistics for the
+        # query planner.
+        logging.debug("Dropping the cards")
+        self.database.drop_tables([Card], safe=True)
+
+        # The page size can not be changed in WAL mode.
+        journal_mode = self.database.journal_mode
+        if page_size:
+            self.database.journal_mode = "delete"
+            self.database.page_size = page_size
+
+        logging.debug("Vacuuming the database")
+        self.database.execute_sql("VACUUM")
+        self.database.execute_sql("ANALYZE")
+
+        if page_size:
+            self.database.journal_mode = journal_mode
+
+    def import_catalog(self, catalog, page_size=None):
         logging.info("Importing catalog")
         self._import_cards(catalog)
         self._prepare_authors()
         self._prepare_books()
-        self._prepare_card_index()
+        self._prepare_book_index()
+        self._prepare_facets()
+        self._prepare_listings()
+        self._compact(page_size)
         logging.info("Importing done!")
 
-    def search(self, term, page_number=1, items_per_page=10):
-        books = (
+    def migrate(self, page_size=None):
+        migrated = False
+
+        # Databases imported by older versions index the cards rather
+        # than the books and keep the cards around.
+        if not self.database.table_exists(BookIndex._meta.table_name):
+            logging.info("Indexing the books instead of the cards")
+            self.database.execute_sql("DROP TABLE IF EXISTS cardindex")
+            self.database.create_tables([BookIndex])
+            self._prepare_book_index()
+            migrated = True
+
+        if not self.database.table_exists(LanguageFacet._meta.table_name):
+            logging.info("Counting the books for the search filters")
+            # Older imports kept the languages as they were in the
+            # catalog, while the filters look them up in lower case.
+            (Book
+             .update(language=fn.LOWER(Book.language))
+             .where(Book.language != fn.LOWER(Book.language))
+             .execute())
+            self.database.create_tables([LanguageFacet, DecadeFacet])
+            self._prepare_facets()
+            migrated = True
+
+        if not self.database.table_exists(Series._meta.table_name):
+            logging.info("Listing the books of every author and series")
+            self.database.create_tables([Series, AuthorListing, SeriesListing])
+            self._prepare_listings()
+            migrated = True
+
+        if not migrated:
+            logging.info("The database is up to date")
+            return False
+
+        # Adds the indexes that are missing.
+        self.database.create_tables(CATALOG_MODELS)
+        self._compact(page_size)
+        logging.info("Migration done!")
+        return True
+
+    def facets(self):
+        if self._facets is None:
+            self._facets = {
+                "language": [
+                    (facet.language, facet.books)
+                    for facet in LanguageFacet
+                    .select()
+                    .order_by(
+                        LanguageFacet.books.desc(), LanguageFacet.language)
+                ],
+                "decade": [
+                    (facet.decade, facet.books)
+                    for facet in DecadeFacet
+                    .select()
+                    .order_by(DecadeFacet.books.desc(), DecadeFacet.decade)
+                ],
+            }
+        return self._facets
+
+    @contextmanager
+    def time_limit(self, seconds):
+        # The queries of this thread that are still running `seconds`
+        # from now are interrupted. SQLite calls the handler every so
+        # many virtual machine instructions.
+        deadline = time.monotonic() + seconds
+        connection = self.database.connection()
+        connection.set_progress_handler(
+            lambda: time.monotonic() > deadline, 1000)
+        try:
+            yield
+        except (OperationalError, sqlite3.OperationalError) as error:
+            # The error comes unwrapped when the rows are being fetched.
+            if "interrupted" not in str(error):
+                raise
+            raise TimeLimitExceeded(seconds) from error
+        finally:
+            connection.set_progress_handler(None, 0)
+
+    @staticmethod
+    def _match_expression(term, series, prefix=False):
+        # The words of the series only match the series column.
+        if term and prefix:
+            term = " ".join('"{}"*'.format(word) for word in term.split())
+        words = [term] if term else []
+        if series:
+            words.extend(
+                'series : "{}"'.format(word)
+                for word in series.split())
+        return " ".join(words)
+
+    @instrument("search")
+    def search(
+        self,
+        term,
+        page_number=1,
+        items_per_page=ITEMS_PER_PAGE,
+        language=None,
+        years=None,
+        series=None,
+        prefix=False
+    ):
+        match = self._match_expression(term, series, prefix)
+        if not (match or language or years):
+            return []
+
+        books = Book.select()
+        if match:
+            books = (
+                books
+                .join(BookIndex, on=(Book.book_id == BookIndex.rowid))
+                .where(BookIndex.match(match)))
+        if language:
+            books = books.where(Book.language == language)
+        if years:
+            first, last = years
+            if first is not None:
+                books = books.where(Book.year >= first)
+            if last is not None:
+                books = books.where(Book.year <= last)
+
+        books = list(books.paginate(page_number, items_per_page))
+        self._load_authors(books)
+        return books
+
+    def uploaded_ebooks(self, books, bot_id, formats=READER_FORMATS):
+        # The Telegram ids of the ebooks the bot has uploaded already,
+        # in the most preferred format, by book id.
+        uploads = (
+            Ebook
+            .select(Ebook.book, Ebook.format, TelegramFile.telegram_id)
+            .join(TelegramFile, on=(TelegramFile.file == Ebook.file))
+            .where(
+                Ebook.book.in_([book.book_id for book in books]) &
+                Ebook.format.in_(list(formats)) &
+                (TelegramFile.bot_id == bot_id))
+            .tuples())
+
+        ranked = {}
+        for book_id, format_, telegram_id in uploads:
+            rank = formats.index(format_)
+            if book_id not in ranked or rank < ranked[book_id][0]:
+                ranked[book_id] = (rank, telegram_id)
+        return {
+            book_id: telegram_id
+            for book_id, (_, telegram_id) in ranked.items()
+        }
+
+    def _load_authors(self, books):
+        # The authors of a whole page of books in one query.
+        books_by_id = {book.book_id: book for book in books}
+        for book in books:
+            book._authors = []
+
+        links = (
+            BookAuthors
+            .select(BookAuthors, Author)
+            .join(Author, on=(BookAuthors.author_id == Author.author_id))
+            .where(BookAuthors.book_id.in_(list(books_by_id)))
+            .order_by(BookAuthors.id))
+        for link in links:
+            books_by_id[link.book_id_id]._authors.append(link.author_id)
+
+    def _load(self, book_id):
+        # The book, its info, its cover, its series and its authors come
+        # in one query, with a row per author, and the ebooks with their files
+        # in another.
+        rows = list(
             Book
-            .select(Book, Card, CardIndex)
-            .join(Card, on=(Book.book_id == Card.book_id))
-            .join(CardIndex, on=(Card.card_id == CardIndex.rowid))
-            .where(CardIndex.match(term))
-            .group_by(Book.book_id)
-            .paginate(page_number, items_per_page))
-        return list(books)
+            .select(Book, BookInfo, File, Series, BookAuthors, Author)
+            .join(
+                BookInfo, JOIN.LEFT_OUTER,
+                on=(BookInfo.book == Book.book_id), attr="_info")
+            .join(
+                File, JOIN.LEFT_OUTER,
+                on=(BookInfo.cover_image == File.file_id),
+                attr="cover_image")
+            .join_from(
+                Book, Series, JOIN.LEFT_OUTER,
+                on=(Series.name == Book.series), attr="_series")
+            .join_from(
+                Book, BookAuthors, JOIN.LEFT_OUTER,
+                on=(BookAuthors.book_id == Book.book_id), attr="_link")
+            .join_from(
+                BookAuthors, Author, JOIN.LEFT_OUTER,
+                on=(BookAuthors.author_id == Author.author_id),
+                attr="author")
+            .where(Book.book_id == book_id)
+            .order_by(BookAuthors.id))
+        if not rows:
+            return None
+
+        book = rows[0]
+        book.info = book._info or False
+        book._authors = [
+            row._link.author
+            for row in rows
+            if row._link and row._link.author
+        ]
+
+        ebooks = (
+            Ebook
+            .select(Ebook, File)
+            .join(File, on=(Ebook.file == File.file_id))
+            .where(Ebook.book == book_id))
+        book._ebooks = []
+        for ebook in ebooks:
+            ebook.book = book
+            book._ebooks.append(ebook)
+        return book
 
     def get(self, book_id):
-        return Book.get_or_none(Book.book_id == book_id)
+        # Commands pass the ids as they were typed, the cache is keyed
+        # by the numbers.
+        try:
+            book_id = int(book_id)
+        except (TypeError, ValueError):
+            return None
+
+        book = self.cache.get(book_id)
+        count_cache("book", book is not None)
+        if book is None:
+            book = self._load(book_id)
+            if book is not None:
+                self.cache.put(book)
+        return book
+
+    def get_author(self, author_id):
+        return Author.get_or_none(Author.author_id == author_id)
+
+    def get_series(self, series_id):
+        return Series.get_or_none(Series.series_id == series_id)
+
+    def count_author_books(self, author_id):
+        # The last position of a listing is its length, found with a
+        # single index lookup.
+        return (
+            AuthorListing
+            .select(fn.MAX(AuthorListing.position))
+            .where(AuthorListing.author == author_id)
+            .scalar()) or 0
+
+    def _listing(self, listing, where, page_number, items_per_page):
+        first = (page_number - 1) * items_per_page + 1
+        books = list(
+            Book
+            .select()
+            .join(listing, on=(listing.book == Book.book_id))
+            .where(
+                where &
+                listing.position.between(first, first + items_per_page - 1))
+            .order_by(listing.position))
+        self._load_authors(books)
+        return books
+
+    def author_books(
+        self, author_id, page_number=1, items_per_page=ITEMS_PER_PAGE
+    ):
+        return self._listing(
+            AuthorListing, AuthorListing.author == author_id,
+            page_number, items_per_page)
+
+    def series_books(
+        self, series_id, page_number=1, items_per_page=ITEMS_PER_PAGE
+    ):
+        return self._listing(
+            SeriesListing, SeriesListing.series == series_id,
+            page_number, items_per_page)
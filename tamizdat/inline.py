@@ -0,0 +1,117 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+WORD = re.compile(r"\w+")
+
+
+def _fold(character):
+    # The unicode61 tokenizer of the index only strips the diacritics
+    # of the latin letters, `й` stays `й`.
+    if ord(character) < 0x250:
+        return unicodedata.normalize("NFD", character)[0]
+    return character
+
+
+def words(text):
+    text = unicodedata.normalize("NFC", text.lower())
+    return WORD.findall("".join(_fold(character) for character in text))
+
+
+def book_words(book):
+    authors = " ".join(
+        " ".join(filter(None, (
+            author.last_name, author.first_name, author.middle_name)))
+        for author in book.author_list)
+    return words(" ".join(filter(None, (
+        book.title, book.subtitle, book.series, authors))))
+
+
+def matches(book, query_words):
+    # Every word of the query starts a word of the book, as with the
+    # prefix queries of the index.
+    known = book_words(book)
+    return all(
+        any(word.startswith(query_word) for word in known)
+        for query_word in query_words)
+
+
+class Debouncer:
+    # Clients send an inline query on every keystroke. A query is only
+    # answered once its user has not typed anything for `delay` seconds,
+    # the queries it supersedes are dropped.
+
+    def __init__(self, delay=0.3, clock=time.monotonic, sleep=time.sleep):
+        self.delay = delay
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.latest = {}
+
+    def arrive(self, key, query_id):
+        with self.lock:
+            self.latest[key] = query_id
+        return self.clock() + self.delay
+
+    def settle(self, key, query_id, deadline):
+        self.sleep(max(0, deadline - self.clock()))
+        with self.lock:
+            if self.latest.get(key) != query_id:
+                return False
+            del self.latest[key]
+            return True
+
+
+class PrefixCache:
+    # Results of inline queries by their words. Typing on narrows the
+    # results down, so a query that extends one with all of its results
+    # found is answered by filtering those instead of asking the index.
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(text):
+        return " ".join(words(text))
+
+    def _put(self, key, books, complete):
+        self.entries[key] = (books, complete)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, text):
+        key = self.key(text)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                books, _ = entry
+                return books
+
+            for length in range(len(key) - 1, 0, -1):
+                entry = self.entries.get(key[:length])
+                if entry is None or not entry[1]:
+                    continue
+                books, _ = entry
+                query_words = key.split()
+                books = [book for book in books if matches(book, query_words)]
+                self._put(key, books, True)
+                return books
+
+    def put(self, text, books, complete):
+        with self.lock:
+            self._put(self.key(text), books, complete)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
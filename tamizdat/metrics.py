@@ -0,0 +1,247 @@
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    metric_type = NotImplemented
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self.lock = threading.Lock()
+        self.children = {}
+        registry.register(self)
+
+    def make_child(self):
+        raise NotImplementedError()
+
+    def labels(self, *labelvalues):
+        # The fast path is a plain dictionary lookup, the lock is only
+        # taken the first time a label combination shows up.
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(
+                    labelvalues, self.make_child())
+        return child
+
+    def samples(self, labelvalues, child):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.metric_type),
+        ]
+        for labelvalues, child in sorted(self.children.items()):
+            for suffix, extra, value in self.samples(labelvalues, child):
+                lines.append("{}{}{} {}".format(
+                    self.name, suffix,
+                    _format_labels(self.labelnames, labelvalues, extra),
+                    _format_value(value)))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def make_child(self):
+        return _Value()
+
+    def samples(self, labelvalues, child):
+        return [("_total", (), child.value)]
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def make_child(self):
+        return _Value()
+
+    def samples(self, labelvalues, child):
+        return [("", (), child.value)]
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def make_child(self):
+        return _Histogram(self.buckets)
+
+    def samples(self, labelvalues, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"), ), counts):
+            cumulative += count
+            samples.append(("_bucket", [("le", _format_value(bound))], cumulative))
+        samples.append(("_sum", (), total))
+        samples.append(("_count", (), cumulative))
+        return samples
+
+
+OPERATION_SECONDS = Histogram(
+    "tamizdat_operation_seconds",
+    "Latency of the bot operations",
+    ["operation"])
+
+OPERATIONS_IN_FLIGHT = Gauge(
+    "tamizdat_operations_in_flight",
+    "Operations that are running right now",
+    ["operation"])
+
+OPERATION_ERRORS = Counter(
+    "tamizdat_operation_errors",
+    "Operations that ended with an exception",
+    ["operation"])
+
+COMMANDS = Counter(
+    "tamizdat_commands",
+    "Handled commands by the response they ended with",
+    ["command", "outcome"])
+
+CACHE_REQUESTS = Counter(
+    "tamizdat_cache_requests",
+    "Cache lookups, hit ratio is hit / (hit + miss)",
+    ["cache", "result"])
+
+
+def instrument(operation):
+    seconds = OPERATION_SECONDS.labels(operation)
+    in_flight = OPERATIONS_IN_FLIGHT.labels(operation)
+    errors = OPERATION_ERRORS.labels(operation)
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            in_flight.inc()
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                errors.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started)
+                in_flight.dec()
+        return wrapper
+
+    return decorator
+
+
+def count_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port, address="127.0.0.1", registry=REGISTRY):
+    handler = type(
+        "MetricsHandler", (MetricsHandler, ), {"registry": registry})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
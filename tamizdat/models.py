@@ -1,14 +1,122 @@
+import os
+import threading
+from collections import OrderedDict
+from urllib.request import pathname2url
+
 from peewee import (
     Proxy, SqliteDatabase,
-    Model, DeferredThroughModel,
-    AutoField, DeferredForeignKey, ForeignKeyField, ManyToManyField,
-    BooleanField, CharField, IntegerField, TextField)
+    Model, DeferredThroughModel, CompositeKey,
+    AutoField, ForeignKeyField, ManyToManyField,
+    BooleanField, CharField, FloatField, IntegerField, TextField)
 from playhouse.sqlite_ext import FTS5Model, SearchField
 
+from .tracing import span
+
 
 proxy = Proxy()
 
 
+EBOOK_FORMATS = ("fb2", "epub", "mobi", "azw3")
+
+KINDLE_FORMATS = ("mobi", "azw3", "epub", "fb2")
+READER_FORMATS = ("epub", "fb2", "mobi", "azw3")
+
+KINDLE_DOMAINS = ("kindle.com", "free.kindle.com")
+
+# Set on every connection, peewee keeps one per thread. In WAL mode the
+# readers are never blocked by a writer and the other way round, and a
+# writer waits for another one instead of failing right away.
+PRAGMAS = (
+    ("journal_mode", "wal"),
+    ("synchronous", "normal"),
+    ("busy_timeout", 5000),
+    ("cache_size", -64 * 1024),
+    ("mmap_size", 256 * 1024 * 1024))
+
+# The catalog database does not change between imports, so it is mapped
+# into memory whole and the pages are shared by all the bot processes.
+CATALOG_SCHEMA = "catalog"
+CATALOG_PRAGMAS = (
+    ("mmap_size", 1 << 32),
+    ("cache_size", -2 * 1024))
+
+
+class TracedSqliteDatabase(SqliteDatabase):
+    def execute_sql(self, sql, params=None):
+        with span("db", sql):
+            return super().execute_sql(sql, params)
+
+
+class SplitSqliteDatabase(TracedSqliteDatabase):
+    # The state database, with the catalog attached read-only to every
+    # connection. The catalog tables are not in the state database, so
+    # SQLite finds them in the attached one by their plain names.
+
+    def __init__(self, address, catalog_address, *args, **kwargs):
+        super().__init__(address, *args, uri=True, **kwargs)
+        self.catalog_address = catalog_address
+        self.catalog_uri = "file:{}?mode=ro&immutable=1".format(
+            pathname2url(os.path.abspath(catalog_address)))
+
+    def _connect(self):
+        connection = super()._connect()
+        connection.execute(
+            "ATTACH DATABASE ? AS {}".format(CATALOG_SCHEMA),
+            (self.catalog_uri, ))
+        for pragma, value in CATALOG_PRAGMAS:
+            connection.execute("PRAGMA {}.{} = {}".format(
+                CATALOG_SCHEMA, pragma, value))
+        return connection
+
+
+class BookCache:
+    # The books looked up most recently, with everything that is shown
+    # along with them. Saving a book, its info, its ebooks or any of
+    # their files drops the book from the cache.
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.lock = threading.Lock()
+        self.books = OrderedDict()
+
+    def __len__(self):
+        return len(self.books)
+
+    def get(self, book_id):
+        with self.lock:
+            book = self.books.get(book_id)
+            if book is not None:
+                self.books.move_to_end(book_id)
+            return book
+
+    def put(self, book):
+        with self.lock:
+            self.books[book.book_id] = book
+            self.books.move_to_end(book.book_id)
+            while len(self.books) > self.size:
+                self.books.popitem(last=False)
+
+    def discard(self, book_id):
+        with self.lock:
+            self.books.pop(book_id, None)
+
+    def discard_file(self, file_id):
+        with self.lock:
+            for book_id, book in list(self.books.items()):
+                cover_image = book.info.cover_image_id if book.info else None
+                files = [cover_image] + [
+                    ebook.file_id for ebook in book.ebook_list]
+                if file_id in files:
+                    del self.books[book_id]
+
+    def clear(self):
+        with self.lock:
+            self.books.clear()
+
+
+BOOK_CACHE = BookCache()
+
+
 class BaseModel(Model):
     class Meta:
         database = proxy
@@ -39,7 +147,12 @@ BookAuthorsDeferred = DeferredThroughModel()
 
 
 class Book(BaseModel):
-    book_id = IntegerField(index=True)
+    class Meta:
+        indexes = (
+            (("language", "year"), False),
+            (("year",), False))
+
+    book_id = IntegerField(unique=True)
 
     title = CharField()
     subtitle = CharField(null=True)
@@ -52,10 +165,67 @@ class Book(BaseModel):
         backref="books",
         through_model=BookAuthorsDeferred)
 
-    augmented = BooleanField(null=True, default=False)
-    annotation = TextField(null=True)
-    cover_image = DeferredForeignKey("File", field="file_id", null=True)
-    ebook_epub = DeferredForeignKey("File", field="file_id", null=True)
+    # What is scraped from the library is kept in BookInfo, as the
+    # catalog is read-only. None is cached as False.
+    _info = None
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = (
+                BookInfo.get_or_none(BookInfo.book == self.book_id) or False)
+        return self._info or None
+
+    @info.setter
+    def info(self, info):
+        self._info = info
+
+    # Index.get loads the authors and the ebooks along with the book,
+    # otherwise they are queried every time.
+    _authors = None
+    _ebooks = None
+
+    @property
+    def author_list(self):
+        if self._authors is not None:
+            return self._authors
+        return list(self.authors)
+
+    @property
+    def ebook_list(self):
+        if self._ebooks is not None:
+            return self._ebooks
+        return list(self.ebooks)
+
+    # The series of the book, looked up by name by Index.get.
+    _series = None
+
+    @property
+    def series_id(self):
+        return self._series.series_id if self._series else None
+
+    @property
+    def augmented(self):
+        return self.info is not None
+
+    @property
+    def annotation(self):
+        return self.info.annotation if self.info else None
+
+    @property
+    def cover_image(self):
+        return self.info.cover_image if self.info else None
+
+    def get_ebook(self, formats=READER_FORMATS):
+        ebooks = {ebook.format: ebook for ebook in self.ebook_list}
+        for format_ in formats:
+            if format_ in ebooks:
+                return ebooks[format_]
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        BOOK_CACHE.discard(self.book_id)
+        return result
 
     def __repr__(self):
         return "Book({!r}, {!r}, {!r}, {!r}, {!r}, {!r}, ...)".format(
@@ -78,6 +248,35 @@ class BookAuthors(BaseModel):
 BookAuthorsDeferred.set_model(BookAuthors)
 
 
+class Series(BaseModel):
+    series_id = AutoField()
+    name = CharField(unique=True)
+    books = IntegerField()
+
+
+# The books of every author and every series in the order they are
+# listed, by year and then by title. A page of a listing is a range of
+# positions, read in one index range scan.
+class AuthorListing(BaseModel):
+    class Meta:
+        primary_key = CompositeKey("author", "position")
+        without_rowid = True
+
+    author = ForeignKeyField(Author, field="author_id", index=False)
+    position = IntegerField()
+    book = ForeignKeyField(Book, field="book_id", index=False)
+
+
+class SeriesListing(BaseModel):
+    class Meta:
+        primary_key = CompositeKey("series", "position")
+        without_rowid = True
+
+    series = ForeignKeyField(Series, field="series_id", index=False)
+    position = IntegerField()
+    book = ForeignKeyField(Book, field="book_id", index=False)
+
+
 class Card(BaseModel):
     class Meta:
         indexes = (
@@ -114,28 +313,29 @@ class Card(BaseModel):
         return repr(self)
 
 
-class CardIndex(FTS5Model):
+class BookIndex(FTS5Model):
     class Meta:
         database = proxy
+        # Only the index is stored. The rowid is the book id, and the
+        # books themselves are read from Book.
+        options = {"content": ""}
 
-    last_name = SearchField()
-    first_name = SearchField()
-    middle_name = SearchField()
+    authors = SearchField()
     title = SearchField()
     subtitle = SearchField()
     series = SearchField()
 
-    def __repr__(self):
-        return "CardIndex({!r}, {!r}, {!r}, {!r}, {!r}, {!r})".format(
-            self.last_name,
-            self.first_name,
-            self.middle_name,
-            self.title,
-            self.subtitle,
-            self.series)
 
-    def __str__(self):
-        return repr(self)
+# How many books there are in every language and every decade, counted
+# once at import, so that search does not have to.
+class LanguageFacet(BaseModel):
+    language = CharField(primary_key=True)
+    books = IntegerField()
+
+
+class DecadeFacet(BaseModel):
+    decade = IntegerField(primary_key=True)
+    books = IntegerField()
 
 
 class File(BaseModel):
@@ -143,7 +343,84 @@ class File(BaseModel):
 
     remote_url = CharField(null=True)
     local_path = CharField(null=True)
-    telegram_id = CharField(null=True)
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        BOOK_CACHE.discard_file(self.file_id)
+        return result
+
+    def get_telegram_id(self, bot_id):
+        upload = TelegramFile.get_or_none(
+            (TelegramFile.file == self.file_id) &
+            (TelegramFile.bot_id == bot_id))
+        return upload.telegram_id if upload else None
+
+    def set_telegram_id(self, bot_id, telegram_id):
+        TelegramFile.replace(
+            file=self.file_id,
+            bot_id=bot_id,
+            telegram_id=telegram_id).execute()
+
+
+class BookInfo(BaseModel):
+    book = ForeignKeyField(
+        Book, field="book_id", primary_key=True, backref="+")
+    annotation = TextField(null=True)
+    cover_image = ForeignKeyField(File, field="file_id", null=True)
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        BOOK_CACHE.discard(self.book_id)
+        return result
+
+
+class TelegramFile(BaseModel):
+    class Meta:
+        indexes = (
+            (("file", "bot_id"), True),)
+
+    file = ForeignKeyField(File, field="file_id", backref="uploads")
+    bot_id = IntegerField()
+    telegram_id = CharField()
+
+
+class ArchiveMember(BaseModel):
+    # Where a book is in the local copies of the library archives, see
+    # tamizdat.archive. The sizes and the checksum come from the central
+    # directory of the archive, which is not read again.
+    book_id = IntegerField(primary_key=True)
+    format = CharField()
+    archive = CharField()
+    offset = IntegerField()
+    compress_type = IntegerField()
+    compress_size = IntegerField()
+    file_size = IntegerField()
+    crc = IntegerField()
+
+    def __repr__(self):
+        return "ArchiveMember({!r}, {!r}, {!r})".format(
+            self.book_id, self.archive, self.offset)
+
+
+class Ebook(BaseModel):
+    class Meta:
+        indexes = (
+            (("book", "format"), True),)
+
+    book = ForeignKeyField(Book, field="book_id", backref="ebooks")
+    format = CharField()
+    file = ForeignKeyField(File, field="file_id")
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        BOOK_CACHE.discard(self.book_id)
+        return result
+
+    def __repr__(self):
+        return "Ebook({!r}, {!r})".format(self.book_id, self.format)
+
+    def __str__(self):
+        return repr(self)
 
 
 class User(BaseModel):
@@ -159,12 +436,104 @@ class User(BaseModel):
 
     email = CharField(null=True)
 
+    @property
+    def is_kindle(self):
+        if not self.email:
+            return False
+        _, _, domain = self.email.rpartition("@")
+        return domain.lower() in KINDLE_DOMAINS
+
+    @property
+    def preferred_formats(self):
+        return KINDLE_FORMATS if self.is_kindle else READER_FORMATS
+
+
+class EmailJob(BaseModel):
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+    class Meta:
+        indexes = (
+            (("status", "next_attempt_at"), False),)
+
+    job_id = AutoField()
+
+    user = ForeignKeyField(User, field="user_id")
+    book = ForeignKeyField(Book, field="book_id")
+    ebook = ForeignKeyField(Ebook)
+
+    status = CharField(default=PENDING)
+    attempts = IntegerField(default=0)
+    next_attempt_at = FloatField(default=0)
+    error = TextField(null=True)
+
+    def __repr__(self):
+        return "EmailJob({!r}, {!r}, {!r}, {!r})".format(
+            self.job_id,
+            self.user_id,
+            self.book_id,
+            self.status)
+
+    def __str__(self):
+        return repr(self)
+
+    def attachments(self):
+        extra = (
+            self.extra_attachments
+            .order_by(EmailAttachment.id))
+        return [(self.book, self.ebook)] + [
+            (attachment.book, attachment.ebook)
+            for attachment in extra
+        ]
+
+
+class EmailAttachment(BaseModel):
+    # The other books of a job that sends several of them in one
+    # message.
+    job = ForeignKeyField(EmailJob, backref="extra_attachments")
+    book = ForeignKeyField(Book, field="book_id")
+    ebook = ForeignKeyField(Ebook)
+
+
+# Cards are only there during the import, see Index.import_catalog.
+CATALOG_MODELS = (
+    Author, Book, BookAuthors, BookIndex, LanguageFacet, DecadeFacet,
+    Series, AuthorListing, SeriesListing)
+
+STATE_MODELS = (
+    BookInfo, File, TelegramFile, Ebook, User, EmailJob, EmailAttachment,
+    ArchiveMember)
+
+MODELS = CATALOG_MODELS + STATE_MODELS
+
+
+def make_database(address = ":memory:", pragmas=PRAGMAS, models=MODELS):
+    database = TracedSqliteDatabase(address, pragmas=pragmas)
+    proxy.initialize(database)
+    BOOK_CACHE.clear()
+    database.create_tables(models)
+    return database
+
+
+def open_database(address, pragmas=PRAGMAS):
+    if not os.path.exists(address):
+        return make_database(address, pragmas)
+
+    database = TracedSqliteDatabase(address, pragmas=pragmas)
+    proxy.initialize(database)
+    BOOK_CACHE.clear()
+    return database
+
+
+def open_split_database(catalog_address, state_address, pragmas=PRAGMAS):
+    if not os.path.exists(catalog_address):
+        raise FileNotFoundError(catalog_address)
 
-def make_database(address = ":memory:"):
-    database = SqliteDatabase(address)
+    database = SplitSqliteDatabase(
+        state_address, catalog_address, pragmas=pragmas)
     proxy.initialize(database)
-    database.create_tables([
-        Author, Book, BookAuthors,
-        Card, CardIndex,
-        File, User])
+    BOOK_CACHE.clear()
+    database.create_tables(STATE_MODELS)
     return database
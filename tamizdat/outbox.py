@@ -0,0 +1,176 @@
+import functools
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import RetryAfter
+
+from .ratelimit import RateLimiter, TokenBucket
+
+
+class _Retrying:
+    # Stands in for the bot or the message a response is served with,
+    # so that the calls the response makes go through the outbox.
+
+    def __init__(self, outbox, target):
+        self.outbox = outbox
+        self.target = target
+
+    def __getattr__(self, name):
+        value = getattr(self.target, name)
+        if not callable(value):
+            return value
+        return functools.partial(self.outbox.call, value)
+
+
+class Outbox:
+    # Responses are served on threads of their own, so the handlers
+    # return right away. Telegram takes about 30 calls a second from a
+    # bot and a message a second in a chat, so all the calls share one
+    # budget and every chat gets one response a second. The messages of
+    # a response, like a cover and the text under it, go out together,
+    # and the responses of a chat go out in order.
+
+    def __init__(
+        self,
+        rate=30,
+        chat_rate=1,
+        chat_burst=1,
+        workers=4,
+        max_attempts=5,
+        clock=time.monotonic,
+        sleep=time.sleep
+    ):
+        self.chat_limiter = RateLimiter(chat_rate, chat_burst, clock=clock)
+        self.bucket = TokenBucket(rate, rate, clock)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.sleep = sleep
+
+        self.condition = threading.Condition()
+        self.waiting = OrderedDict()
+        self.busy = set()
+        self.stopped = False
+        self.threads = []
+
+        self.lock = threading.Lock()
+        self.paused_until = float("-inf")
+
+    def put(self, chat_id, serve, bot, message):
+        # `serve` is called with the bot and the message.
+        with self.condition:
+            self.waiting.setdefault(chat_id, deque()).append(
+                (serve, bot, message))
+            self.condition.notify()
+
+    def _take(self):
+        with self.condition:
+            while True:
+                wait = None
+                for chat_id, jobs in self.waiting.items():
+                    if chat_id in self.busy:
+                        continue
+                    if not self.chat_limiter.allow(chat_id):
+                        retry_after = self.chat_limiter.retry_after(chat_id)
+                        wait = (
+                            retry_after if wait is None
+                            else min(wait, retry_after))
+                        continue
+
+                    job = jobs.popleft()
+                    if jobs:
+                        # The other chats in line go first.
+                        self.waiting.move_to_end(chat_id)
+                    else:
+                        del self.waiting[chat_id]
+                    self.busy.add(chat_id)
+                    return chat_id, job
+
+                if self.stopped and not self.waiting:
+                    return None
+                self.condition.wait(wait)
+
+    def _done(self, chat_id):
+        with self.condition:
+            self.busy.discard(chat_id)
+            self.condition.notify_all()
+
+    def _throttle(self):
+        while True:
+            with self.lock:
+                wait = self.paused_until - self.clock()
+                if wait <= 0:
+                    if self.bucket.take():
+                        return
+                    wait = self.bucket.retry_after()
+            self.sleep(wait)
+
+    def call(self, function, *args, **kwargs):
+        # When Telegram asks to slow down, all the calls wait for as
+        # long as it says, and for twice as long every next time.
+        for attempt in itertools.count():
+            self._throttle()
+            try:
+                return function(*args, **kwargs)
+            except RetryAfter as error:
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                delay = error.retry_after * 2 ** attempt
+                logging.warning(
+                    "Flood control exceeded, pausing for {}s".format(delay))
+                with self.lock:
+                    self.paused_until = max(
+                        self.paused_until, self.clock() + delay)
+
+            # Files that have been read are read again from the start.
+            for value in itertools.chain(args, kwargs.values()):
+                if hasattr(value, "seek"):
+                    value.seek(0)
+
+    def serve(self, chat_id, serve, bot, message):
+        try:
+            serve(
+                _Retrying(self, bot),
+                _Retrying(self, message) if message is not None else None)
+        except Exception as error:
+            logging.error(
+                "Failed to respond in chat {}: {}".format(chat_id, error),
+                exc_info=True)
+
+    def run(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            chat_id, (serve, bot, message) = taken
+            try:
+                self.serve(chat_id, serve, bot, message)
+            finally:
+                self._done(chat_id)
+
+    def queue_depth(self):
+        with self.condition:
+            return sum(len(jobs) for jobs in self.waiting.values())
+
+    def start(self):
+        self.stopped = False
+        self.threads = [
+            threading.Thread(
+                target=self.run,
+                name="outbox:{}".format(number),
+                daemon=True)
+            for number in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        # The responses that are waiting are still sent.
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,119 @@
+import os
+import re
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+from os import path
+
+
+# python-telegram-bot names the threads it runs handlers in after the
+# bot, e.g. `Bot:1234:dispatcher` and `Bot:1234:worker:0`. The responses
+# are served on the `outbox:0` and so on.
+DISPATCHER_THREADS = re.compile(r"^(Bot:\d+:(dispatcher|worker:)|outbox:)")
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    # Semicolons separate frames in the collapsed format.
+    return "{} ({}:{})".format(
+        code.co_name,
+        path.basename(code.co_filename),
+        code.co_firstlineno).replace(";", ":")
+
+
+class Profile:
+    def __init__(self, stacks, samples, duration):
+        self.stacks = stacks
+        self.samples = samples
+        self.duration = duration
+
+    def hotspots(self, limit=20):
+        # Cumulative counts: every sample is counted once for every
+        # function on its stack, recursion notwithstanding.
+        cumulative = Counter()
+        own = Counter()
+        for stack, count in self.stacks.items():
+            for frame in set(stack[1:]):
+                cumulative[frame] += count
+            own[stack[-1]] += count
+
+        total = max(sum(self.stacks.values()), 1)
+        return [
+            (frame, count / total, own[frame] / total)
+            for frame, count in cumulative.most_common(limit)
+        ]
+
+    def collapsed(self):
+        # The format of Brendan Gregg's stackcollapse scripts, which
+        # flamegraph.pl and speedscope read.
+        return "".join(
+            "{} {}\n".format(";".join(stack), count)
+            for stack, count in sorted(self.stacks.items()))
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, thread_filter=DISPATCHER_THREADS):
+        self.interval = interval
+        self.thread_filter = thread_filter
+
+    def _threads(self):
+        return {
+            thread.ident: thread.name
+            for thread in threading.enumerate()
+            if thread.ident != threading.get_ident()
+            and self.thread_filter.search(thread.name)
+        }
+
+    def sample(self, stacks):
+        threads = self._threads()
+        for ident, frame in sys._current_frames().items():
+            name = threads.get(ident)
+            if name is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(name)
+            stacks[tuple(reversed(stack))] += 1
+
+    def profile(self, seconds):
+        stacks = Counter()
+        samples = 0
+        started = time.monotonic()
+        deadline = started + seconds
+        while time.monotonic() < deadline:
+            self.sample(stacks)
+            samples += 1
+            time.sleep(self.interval)
+        return Profile(stacks, samples, time.monotonic() - started)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as fd:
+            _, resident, *_ = fd.read().split()
+        return int(resident) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak rather than current usage, which is the best we have
+        # where there is no procfs. Linux reports it in kilobytes.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def directory_size(directory):
+    files = 0
+    size = 0
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return files, size
+
+    for entry in entries:
+        if entry.is_file():
+            files += 1
+            size += entry.stat().st_size
+    return files, size
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Idle buckets are forgotten once there are more than this many, a
+# forgotten bucket is a full one anyway.
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def retry_after(self):
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    # Every key (a chat) gets a bucket of its own, and all of them also
+    # draw from the global bucket, if there is one.
+
+    def __init__(
+        self,
+        rate,
+        burst,
+        global_rate=None,
+        global_burst=None,
+        clock=time.monotonic
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.global_bucket = (
+            TokenBucket(global_rate, global_burst or burst, clock)
+            if global_rate
+            else None)
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self._prune()
+            bucket = self.buckets[key] = TokenBucket(
+                self.rate, self.burst, self.clock)
+        return bucket
+
+    def _prune(self):
+        for key, bucket in list(self.buckets.items()):
+            if bucket.is_full():
+                del self.buckets[key]
+
+    def allow(self, key):
+        with self.lock:
+            bucket = self._bucket(key)
+            if not bucket.take():
+                return False
+            if self.global_bucket and not self.global_bucket.take():
+                bucket.give_back()
+                return False
+            return True
+
+    def retry_after(self, key):
+        with self.lock:
+            retry_after = self._bucket(key).retry_after()
+            if self.global_bucket:
+                retry_after = max(
+                    retry_after, self.global_bucket.retry_after())
+            return retry_after
+
+    def state(self):
+        with self.lock:
+            for bucket in self.buckets.values():
+                bucket._refill()
+            return {
+                str(key): bucket.tokens
+                for key, bucket in self.buckets.items()
+                if bucket.tokens < bucket.burst
+            }
+
+    def restore(self, state):
+        with self.lock:
+            for key, tokens in state.items():
+                bucket = self._bucket(int(key))
+                bucket.tokens = min(bucket.burst, tokens)
+
+
+class ConcurrencyLimit:
+    def __init__(self, size):
+        self.size = size
+        self.semaphore = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def slot(self):
+        acquired = self.semaphore.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.semaphore.release()
+
+
+class RateLimits:
+    def __init__(self, search=None, download=None, fetches=None, path=None):
+        self.search = search
+        self.download = download
+        self.fetches = fetches
+        self.path = path
+
+    def _limiters(self):
+        return {
+            name: limiter
+            for name, limiter in (
+                ("search", self.search), ("download", self.download))
+            if limiter
+        }
+
+    def load(self):
+        # Buckets survive restarts, so restarting the bot does not hand
+        # out fresh budgets. Time spent offline is not refilled.
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as fd:
+                state = json.load(fd)
+        except (OSError, ValueError) as error:
+            logging.error("Could not load rate limits: {}".format(error))
+            return
+
+        for name, limiter in self._limiters().items():
+            limiter.restore(state.get(name, {}))
+
+    def save(self):
+        if not self.path:
+            return
+        state = {
+            name: limiter.state()
+            for name, limiter in self._limiters().items()
+        }
+        with open(self.path, "w") as fd:
+            json.dump(state, fd)
@@ -1,10 +1,22 @@
 import logging
-
-from jinja2 import Environment, PackageLoader, select_autoescape
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, TelegramError
+import math
+import re
+import tempfile
+import time
+from io import BytesIO
+from os import path
+
+from jinja2 import (
+    Environment, FileSystemBytecodeCache, PackageLoader, select_autoescape)
+from telegram import (
+    InlineKeyboardButton, InlineKeyboardMarkup,
+    InlineQueryResultArticle, InlineQueryResultCachedDocument,
+    InputTextMessageContent, TelegramError)
 from telegram.parsemode import ParseMode
 from transliterate import translit
 
+from .bundle import pack, write_zip
+from .metrics import count_cache
 from .models import User
 from .settings import EMAIL_LOGIN
 
@@ -12,10 +24,44 @@ from .settings import EMAIL_LOGIN
 ICON_BOOK_PILE = "📖"
 ICON_ENVELOPE = "✉"
 
+# Telegram does not take larger files as photos.
+MAX_PHOTO_SIZE = 10 * 1024 * 1024
+# Nor larger files as documents.
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+# Archives of books are written to memory up to this size, to the disk
+# beyond it.
+MAX_SPOOLED_SIZE = 8 * 1024 * 1024
+
+
+INCLUDE_PATTERN = re.compile(r'{%(-?)\s*include\s+"([^"]+)"\s*(-?)%}')
+
+
+class InliningLoader(PackageLoader):
+    # Includes are pasted into the including template when it is loaded,
+    # so rendering a search page does not look up header, authors and
+    # author templates again for every book. The pasted source is wrapped
+    # in a `with` block to keep the scoping of a real include.
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        source = INCLUDE_PATTERN.sub(
+            lambda match: self._inline(environment, match),
+            source)
+        return source, filename, uptodate
+
+    def _inline(self, environment, match):
+        left, name, right = match.groups()
+        source, _, _ = self.get_source(environment, name)
+        if source.endswith("\n"):
+            source = source[:-1]
+        return "{%" + left + " with %}" + source + "{% endwith " + right + "%}"
+
 
 environment = Environment(
     autoescape=select_autoescape(["markdown"]),
-    loader=PackageLoader("tamizdat", "templates"),
+    loader=InliningLoader("tamizdat", "templates"),
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=False,
     lstrip_blocks=True,
     trim_blocks=True)
 
@@ -28,8 +74,9 @@ class NoResponse:
 class Response:
     template_path = NotImplemented
 
-    def __init__(self):
-        self.template = environment.get_template(self.template_path)
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.template = environment.get_template(cls.template_path)
 
     def __str__(self):
         return self.template.render()
@@ -37,6 +84,12 @@ class Response:
     def serve(self, bot, message):
         return message.reply_text(str(self), parse_mode=ParseMode.MARKDOWN)
 
+    def send(self, bot, chat_id):
+        return bot.send_message(
+            chat_id,
+            str(self),
+            parse_mode=ParseMode.MARKDOWN)
+
 
 class UserNotFoundResponse(Response):
     template_path = "user_not_found.md"
@@ -59,16 +112,36 @@ class NewUserAdminNotification(Response):
     def serve(self, bot, message):
         admins = User.select().where(User.is_admin == True)
         for admin in admins:
-            bot.send_message(
-                admin.user_id,
-                str(self),
-                parse_mode=ParseMode.MARKDOWN)
+            self.send(bot, admin.user_id)
 
 
 class BookNotFoundResponse(Response):
     template_path = "book_not_found.md"
 
 
+class EbookNotFoundResponse(Response):
+    template_path = "ebook_not_found.md"
+
+
+class RateLimitedResponse(Response):
+    template_path = "rate_limited.md"
+
+    def __init__(self, retry_after):
+        super().__init__()
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.template.render(retry_after=math.ceil(self.retry_after))
+
+
+class BusyResponse(Response):
+    template_path = "busy.md"
+
+
+class LibraryUnavailableResponse(Response):
+    template_path = "library_unavailable.md"
+
+
 class SettingsResponse(Response):
     template_path = "settings.md"
 
@@ -112,12 +185,131 @@ class SettingsEmailInvalidResponse(Response):
 class SearchResponse(Response):
     template_path = "search_results.md"
 
-    def __init__(self, books):
+    def __init__(self, books, facets=None):
+        super().__init__()
+        self.books = books
+        self.facets = facets
+
+    def __str__(self):
+        return self.template.render(
+            books=self.books, facets=self.facets).strip()
+
+
+class InlineSearchResponse(Response):
+    # Books the bot has uploaded already are sent right away as
+    # documents, the others as their search result.
+    template_path = "book_header.md"
+    description_template = environment.get_template("inline_description.md")
+
+    def __init__(self, books, uploads, cache_time=300):
+        super().__init__()
+        self.books = books
+        self.uploads = uploads
+        self.cache_time = cache_time
+
+    def result(self, book):
+        description = self.description_template.render(book=book).strip()
+        telegram_id = self.uploads.get(book.book_id)
+        if telegram_id:
+            return InlineQueryResultCachedDocument(
+                id=str(book.book_id),
+                title=book.title,
+                document_file_id=telegram_id,
+                description=description)
+
+        return InlineQueryResultArticle(
+            id=str(book.book_id),
+            title=book.title,
+            description=description,
+            input_message_content=InputTextMessageContent(
+                self.template.render(book=book).strip(),
+                parse_mode=ParseMode.MARKDOWN))
+
+    def serve(self, bot, query):
+        # The results depend on who asks, only the authorized users get
+        # any.
+        return query.answer(
+            [self.result(book) for book in self.books],
+            cache_time=self.cache_time,
+            is_personal=True)
+
+
+class ListingResponse(Response):
+    # A page of the books of an author or a series, with buttons for
+    # the neighbouring pages.
+    command = NotImplemented
+    template_path = "search_results.md"
+
+    def __init__(self, key, books, page_number, pages):
         super().__init__()
+        self.key = key
         self.books = books
+        self.page_number = page_number
+        self.pages = pages
+
+    def button(self, text, page_number):
+        return InlineKeyboardButton(
+            text,
+            callback_data="/{} {} {}".format(
+                self.command, self.key, page_number))
+
+    def keyboard(self):
+        buttons = []
+        if self.page_number > 1:
+            buttons.append(self.button("←", self.page_number - 1))
+        if self.page_number < self.pages:
+            buttons.append(self.button("→", self.page_number + 1))
+        return [buttons] if buttons else []
+
+    def serve(self, bot, message):
+        keyboard = self.keyboard()
+        message.reply_text(
+            str(self),
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+
+
+class AuthorBooksResponse(ListingResponse):
+    command = "author"
+    template_path = "author_books.md"
+
+    def __init__(self, author, books, page_number, pages):
+        super().__init__(author.author_id, books, page_number, pages)
+        self.author = author
 
     def __str__(self):
-        return self.template.render(books=self.books).strip()
+        return self.template.render(
+            author=self.author,
+            books=self.books,
+            page_number=self.page_number,
+            pages=self.pages).strip()
+
+
+class SeriesBooksResponse(ListingResponse):
+    command = "series"
+    template_path = "series_books.md"
+
+    def __init__(self, series, books, page_number, pages):
+        super().__init__(series.series_id, books, page_number, pages)
+        self.series = series
+
+    def keyboard(self):
+        # The whole series, not just the page, is sent by these.
+        return super().keyboard() + [[
+            InlineKeyboardButton(
+                "{} Скачать серию".format(ICON_BOOK_PILE),
+                callback_data="/download series {}".format(self.key)),
+            InlineKeyboardButton(
+                "{} Почтой".format(ICON_ENVELOPE),
+                callback_data="/email series {}".format(self.key))
+        ]]
+
+    def __str__(self):
+        return self.template.render(
+            series=self.series,
+            books=self.books,
+            page_number=self.page_number,
+            pages=self.pages).strip()
 
 
 class BookInfoResponse(Response):
@@ -130,13 +322,34 @@ class BookInfoResponse(Response):
     def __str__(self):
         return self.template.render(book=self.book).strip()
 
+    def send_cover(self, bot, message):
+        # The cover is uploaded from the disk once and sent by its
+        # Telegram id afterwards. Telegram is only left to fetch it from
+        # the library when we do not have it.
+        cover = self.book.cover_image
+        telegram_id = cover.get_telegram_id(bot.id)
+        count_cache("cover", telegram_id)
+        if telegram_id:
+            return message.reply_photo(telegram_id)
+
+        local_path = cover.local_path
+        if not (
+            local_path and path.exists(local_path) and
+            path.getsize(local_path) <= MAX_PHOTO_SIZE
+        ):
+            logging.debug(
+                "Sending cover image {}".format(cover.remote_url))
+            return message.reply_photo(cover.remote_url)
+
+        with open(local_path, "rb") as photo:
+            response = message.reply_photo(photo, timeout=60)
+        # The largest of the sizes Telegram has made of the photo.
+        cover.set_telegram_id(bot.id, response.photo[-1].file_id)
+
     def serve(self, bot, message):
         if self.book.cover_image:
             try:
-                logging.debug(
-                    "Trying to send cover image {}"
-                    .format(self.book.cover_image.remote_url))
-                message.reply_photo(self.book.cover_image.remote_url)
+                self.send_cover(bot, message)
             except TelegramError as error:
                 logging.error(error, exc_info=True)
 
@@ -156,26 +369,73 @@ class BookInfoResponse(Response):
 class DownloadResponse(Response):
     template_path = "filename.md"
 
-    def __init__(self, book):
+    def __init__(self, book, ebook):
         super().__init__()
         self.book = book
-        self.ebook = book.ebook_mobi
+        self.ebook = ebook
 
     def serve(self, bot, message):
-        if self.ebook.telegram_id:
-            return message.reply_document(
-                self.ebook.telegram_id)
+        file_ = self.ebook.file
+        telegram_id = file_.get_telegram_id(bot.id)
+        count_cache("telegram_file", telegram_id)
+        if telegram_id:
+            return message.reply_document(telegram_id)
 
         filename = translit(
-            self.template.render(book=self.book),
+            self.template.render(book=self.book, ebook=self.ebook),
+            "ru",
             reversed=True)
-        response = message.reply_document(
-            document=open(self.ebook.local_path, "rb"),
-            filename=filename,
-            timeout=60)
+        with open(file_.local_path, "rb") as document:
+            response = message.reply_document(
+                document=document,
+                filename=filename,
+                timeout=60)
+
+        file_.set_telegram_id(bot.id, response.document.file_id)
+
 
-        self.ebook.telegram_id = response.document.file_id
-        self.ebook.save()
+class BundleResponse(Response):
+    # Several books, sent as zip archives of as few parts as Telegram
+    # takes. An archive is compressed as it is written, so no more than
+    # a chunk of a book is in memory at a time.
+    template_path = "bundle_filename.md"
+    filename_template = environment.get_template("filename.md")
+
+    def __init__(self, items, limit=MAX_DOCUMENT_SIZE):
+        super().__init__()
+        self.items = items
+        self.limit = limit
+
+    def filename(self, items, part, parts):
+        # Named after the series when all the books are of one.
+        series = {book.series for book, _ in self.items}
+        return translit(
+            self.template.render(
+                books=[book for book, _ in items],
+                series=series.pop() if len(series) == 1 else None,
+                part=part,
+                parts=parts).strip(),
+            "ru",
+            reversed=True)
+
+    def files(self, items):
+        for book, ebook in items:
+            name = translit(
+                self.filename_template.render(book=book, ebook=ebook),
+                "ru",
+                reversed=True)
+            yield ebook.file.local_path, name
+
+    def serve(self, bot, message):
+        bundles = pack(self.items, self.limit)
+        for part, items in enumerate(bundles, 1):
+            with tempfile.SpooledTemporaryFile(MAX_SPOOLED_SIZE) as fd:
+                write_zip(fd, self.files(items))
+                fd.seek(0)
+                message.reply_document(
+                    document=fd,
+                    filename=self.filename(items, part, len(bundles)),
+                    timeout=120)
 
 
 class EmailSentResponse(Response):
@@ -189,6 +449,17 @@ class EmailSentResponse(Response):
         return self.template.render(user=self.user)
 
 
+class EmailQueuedResponse(Response):
+    template_path = "email_queued.md"
+
+    def __init__(self, user):
+        super().__init__()
+        self.user = user
+
+    def __str__(self):
+        return self.template.render(user=self.user)
+
+
 class EmailFailedResponse(Response):
     template_path = "email_failed.md"
 
@@ -198,3 +469,45 @@ class EmailFailedResponse(Response):
 
     def __str__(self):
         return self.template.render(user=self.user)
+
+
+class ProfileStartedResponse(Response):
+    template_path = "profile_started.md"
+
+    def __init__(self, seconds):
+        super().__init__()
+        self.seconds = seconds
+
+    def __str__(self):
+        return self.template.render(seconds=self.seconds)
+
+
+class ProfileResponse(Response):
+    template_path = "profile.md"
+
+    def __init__(self, profile, limit=20):
+        super().__init__()
+        self.profile = profile
+        self.limit = limit
+
+    def __str__(self):
+        return self.template.render(
+            profile=self.profile,
+            hotspots=self.profile.hotspots(self.limit)).strip()
+
+    def serve(self, bot, message):
+        message.reply_text(str(self), parse_mode=ParseMode.MARKDOWN)
+        message.reply_document(
+            document=BytesIO(self.profile.collapsed().encode()),
+            filename=time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+
+
+class StatsResponse(Response):
+    template_path = "stats.md"
+
+    def __init__(self, stats):
+        super().__init__()
+        self.stats = stats
+
+    def __str__(self):
+        return self.template.render(stats=self.stats).strip()
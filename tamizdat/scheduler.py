@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+
+# Lower goes first.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class DeadlineExceeded(SchedulerError):
+    pass
+
+
+class CircuitOpen(SchedulerError):
+    pass
+
+
+def is_host_failure(error):
+    # Only what tells that the host is in trouble opens the circuit: a
+    # server error, a timeout or a connection that could not be made.
+    # Asking for a book that is not there is not its fault.
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code >= 500
+    return isinstance(error, OSError)
+
+
+class _Host:
+    def __init__(self):
+        self.waiting = []
+        self.active = 0
+        self.last_started = float("-inf")
+
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+
+
+class RequestScheduler:
+    # Requests to a host are started one at a time, at least
+    # `min_interval` seconds apart, with at most `max_concurrent` of them
+    # running. Waiting requests are started by priority, then in order of
+    # arrival. After `failure_threshold` failures in a row the circuit
+    # opens and requests fail right away for `reset_timeout` seconds,
+    # after which a single request is let through to probe the host.
+
+    def __init__(
+        self,
+        max_concurrent=2,
+        min_interval=0.5,
+        failure_threshold=5,
+        reset_timeout=60,
+        clock=time.monotonic,
+        is_failure=is_host_failure
+    ):
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.is_failure = is_failure
+
+        self.condition = threading.Condition()
+        self.hosts = {}
+        self.sequence = itertools.count()
+
+    def _is_open(self, state, now):
+        return state.open_until is not None and (
+            now < state.open_until or state.probing)
+
+    def _wait_time(self, state, ticket, now):
+        if state.waiting[0] != ticket or state.active >= self.max_concurrent:
+            return None
+        return max(0, state.last_started + self.min_interval - now)
+
+    def _acquire(self, host, priority, deadline):
+        with self.condition:
+            state = self.hosts.setdefault(host, _Host())
+            if self._is_open(state, self.clock()):
+                raise CircuitOpen(host)
+
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(state.waiting, ticket)
+            try:
+                while True:
+                    now = self.clock()
+                    if self._is_open(state, now):
+                        raise CircuitOpen(host)
+                    if deadline is not None and now >= deadline:
+                        raise DeadlineExceeded(host)
+
+                    wait = self._wait_time(state, ticket, now)
+                    if wait == 0:
+                        break
+                    if deadline is not None:
+                        wait = min(
+                            deadline - now,
+                            wait if wait is not None else deadline - now)
+                    self.condition.wait(wait)
+            except BaseException:
+                state.waiting.remove(ticket)
+                heapq.heapify(state.waiting)
+                self.condition.notify_all()
+                raise
+
+            heapq.heappop(state.waiting)
+            if state.open_until is not None:
+                logging.info("Probing {}".format(host))
+                state.probing = True
+            state.active += 1
+            state.last_started = now
+            self.condition.notify_all()
+            return state
+
+    def _release(self, host, state, failed):
+        with self.condition:
+            state.active -= 1
+            if failed:
+                state.failures += 1
+                if state.probing or state.failures >= self.failure_threshold:
+                    logging.warning(
+                        "{} failed {} times in a row, pausing requests"
+                        .format(host, state.failures))
+                    state.open_until = self.clock() + self.reset_timeout
+            else:
+                state.failures = 0
+                state.open_until = None
+            state.probing = False
+            self.condition.notify_all()
+
+    def run(self, url, function, priority=INTERACTIVE, deadline=None):
+        host = urlparse(url).netloc
+        state = self._acquire(host, priority, deadline)
+        failed = False
+        try:
+            return function()
+        except BaseException as error:
+            failed = self.is_failure(error)
+            raise
+        finally:
+            self._release(host, state, failed)
+
+    def queue_depth(self):
+        with self.condition:
+            return sum(len(state.waiting) for state in self.hosts.values())
+
+
+class DirectScheduler:
+    # Runs every request right away, for when there is nothing to
+    # coordinate, as in the import or in tests.
+
+    def run(self, url, function, priority=INTERACTIVE, deadline=None):
+        return function()
+
+    def queue_depth(self):
+        return 0
@@ -4,5 +4,44 @@ EMAIL_LOGIN = os.getenv("TAMIZDAT_EMAIL_LOGIN")
 EMAIL_PASSWORD = os.getenv("TAMIZDAT_EMAIL_PASSWORD")
 EMAIL_HOST = os.getenv("TAMIZDAT_EMAIL_HOST")
 EMAIL_PORT = os.getenv("TAMIZDAT_EMAIL_PORT")
+EMAIL_POOL_SIZE = int(os.getenv("TAMIZDAT_EMAIL_POOL_SIZE", 2))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("TAMIZDAT_EMAIL_MAX_ATTEMPTS", 5))
+EMAIL_RETRY_BACKOFF = int(os.getenv("TAMIZDAT_EMAIL_RETRY_BACKOFF", 30))
+EMAIL_ATTACHMENT_CACHE_DIR = os.getenv(
+    "TAMIZDAT_EMAIL_ATTACHMENT_CACHE_DIR", "attachments")
 
 TELEGRAM_TOKEN = os.getenv("TAMIZDAT_TELEGRAM_TOKEN")
+# Calls to Telegram per second for all the chats together, and responses
+# per second in a chat.
+TELEGRAM_RATE_LIMIT = float(os.getenv("TAMIZDAT_TELEGRAM_RATE_LIMIT", 30))
+TELEGRAM_CHAT_RATE_LIMIT = float(
+    os.getenv("TAMIZDAT_TELEGRAM_CHAT_RATE_LIMIT", 1))
+TELEGRAM_SENDERS = int(os.getenv("TAMIZDAT_TELEGRAM_SENDERS", 4))
+
+CONVERTER_EXECUTABLE = os.getenv("TAMIZDAT_CONVERTER_EXECUTABLE")
+CONVERTER_CACHE_DIR = os.getenv("TAMIZDAT_CONVERTER_CACHE_DIR", "converted")
+CONVERTER_WORKERS = int(os.getenv("TAMIZDAT_CONVERTER_WORKERS", 2))
+CONVERTER_TIMEOUT = int(os.getenv("TAMIZDAT_CONVERTER_TIMEOUT", 180))
+
+TRACE_SAMPLE_RATE = float(os.getenv("TAMIZDAT_TRACE_SAMPLE_RATE", 0.01))
+TRACE_SLOW_THRESHOLD = float(os.getenv("TAMIZDAT_TRACE_SLOW_THRESHOLD", 1.0))
+TRACE_LOG = os.getenv("TAMIZDAT_TRACE_LOG")
+
+# Budgets are requests per minute per chat, and for all the chats
+# together, with bursts of up to *_BURST requests.
+SEARCH_RATE_LIMIT = float(os.getenv("TAMIZDAT_SEARCH_RATE_LIMIT", 20))
+SEARCH_BURST = int(os.getenv("TAMIZDAT_SEARCH_BURST", 10))
+SEARCH_GLOBAL_RATE_LIMIT = float(
+    os.getenv("TAMIZDAT_SEARCH_GLOBAL_RATE_LIMIT", 600))
+DOWNLOAD_RATE_LIMIT = float(os.getenv("TAMIZDAT_DOWNLOAD_RATE_LIMIT", 2))
+DOWNLOAD_BURST = int(os.getenv("TAMIZDAT_DOWNLOAD_BURST", 5))
+DOWNLOAD_GLOBAL_RATE_LIMIT = float(
+    os.getenv("TAMIZDAT_DOWNLOAD_GLOBAL_RATE_LIMIT", 60))
+MAX_CONCURRENT_FETCHES = int(os.getenv("TAMIZDAT_MAX_CONCURRENT_FETCHES", 4))
+RATE_LIMIT_STATE = os.getenv("TAMIZDAT_RATE_LIMIT_STATE")
+
+LIBRARY_MAX_CONCURRENT = int(os.getenv("TAMIZDAT_LIBRARY_MAX_CONCURRENT", 2))
+LIBRARY_MIN_INTERVAL = float(os.getenv("TAMIZDAT_LIBRARY_MIN_INTERVAL", 0.5))
+LIBRARY_FAILURE_THRESHOLD = int(
+    os.getenv("TAMIZDAT_LIBRARY_FAILURE_THRESHOLD", 5))
+LIBRARY_RESET_TIMEOUT = float(os.getenv("TAMIZDAT_LIBRARY_RESET_TIMEOUT", 60))
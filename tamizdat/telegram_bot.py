@@ -1,79 +1,198 @@
 from telegram.ext import (
     Filters, Updater,
-    CallbackQueryHandler, CommandHandler, MessageHandler, RegexHandler)
+    CallbackQueryHandler, CommandHandler, InlineQueryHandler, MessageHandler,
+    RegexHandler)
 
 from .command import (
     AuthorizeUserCommand,
-    RestartCommand,
+    RestartCommand, ProfileCommand, StatsCommand,
     SettingsCommand, SettingsEmailChooseCommand,
-    MessageCommand, BookInfoCommand, DownloadCommand, EmailCommand)
+    MessageCommand, InlineSearchCommand,
+    BookInfoCommand, DownloadCommand, EmailCommand,
+    AuthorCommand, SeriesCommand)
+from .outbox import Outbox
+from .ratelimit import RateLimits
+from .response import EmailFailedResponse, EmailSentResponse
 
 
 class TelegramBot:
-    def __init__(self, token, index, website, mailer):
+    def __init__(
+        self,
+        token,
+        index,
+        website,
+        mail_queue,
+        converter=None,
+        attachment_cache=None,
+        rate_limits=None,
+        outbox=None,
+        archives=None
+    ):
         self.updater = Updater(token, use_context=True)
+        self.mail_queue = mail_queue
+        self.mail_queue.notify = self.notify_email
+        self.outbox = outbox or Outbox()
+        self.rate_limits = rate_limits or RateLimits()
+        search_limiter = self.rate_limits.search
+        download_limiter = self.rate_limits.download
+        fetch_limit = self.rate_limits.fetches
+
         self.updater.dispatcher.add_handler(
             MessageHandler(
                 Filters.regex(r"^/authorize(\d+)"),
-                callback=AuthorizeUserCommand().handle_command_regex))
+                callback=self.served(
+                    AuthorizeUserCommand()).handle_command_regex))
 
         self.updater.dispatcher.add_handler(
             CommandHandler(
                 "settings",
-                SettingsCommand().handle_command))
+                self.served(SettingsCommand()).handle_command))
 
         self.updater.dispatcher.add_handler(
             CommandHandler(
                 "setemail",
-                callback=SettingsEmailChooseCommand().handle_command))
+                callback=self.served(
+                    SettingsEmailChooseCommand()).handle_command))
         self.updater.dispatcher.add_handler(
             CallbackQueryHandler(
                 pattern=r"^/setemail",
-                callback=SettingsEmailChooseCommand().handle_callback_regex))
+                callback=self.served(
+                    SettingsEmailChooseCommand()).handle_callback_regex))
 
         self.updater.dispatcher.add_handler(
             CommandHandler(
                 "info",
-                callback=BookInfoCommand(
-                    index, website).handle_command))
+                callback=self.served(BookInfoCommand(
+                    index, website,
+                    rate_limiter=search_limiter,
+                    fetch_limit=fetch_limit)).handle_command))
         self.updater.dispatcher.add_handler(
             MessageHandler(
                 Filters.regex(r"^/info(\d+)"),
-                callback=BookInfoCommand(
-                    index, website).handle_command_regex))
+                callback=self.served(BookInfoCommand(
+                    index, website,
+                    rate_limiter=search_limiter,
+                    fetch_limit=fetch_limit)).handle_command_regex))
+
+        for command, Listing in (
+            ("author", AuthorCommand),
+            ("series", SeriesCommand)
+        ):
+            self.updater.dispatcher.add_handler(
+                MessageHandler(
+                    Filters.regex(r"^/{}(\d+)".format(command)),
+                    callback=self.served(Listing(
+                        index, search_limiter)).handle_command_regex))
+            self.updater.dispatcher.add_handler(
+                CallbackQueryHandler(
+                    pattern=r"^/{} (\d+) (\d+)".format(command),
+                    callback=self.served(Listing(
+                        index, search_limiter)).handle_callback_regex))
 
         self.updater.dispatcher.add_handler(
             CommandHandler(
                 "download",
-                callback=DownloadCommand(
-                    index, website).handle_command))
+                callback=self.served(DownloadCommand(
+                    index, website,
+                    converter=converter,
+                    attachment_cache=attachment_cache,
+                    rate_limiter=download_limiter,
+                    fetch_limit=fetch_limit,
+                    archives=archives)).handle_command))
         self.updater.dispatcher.add_handler(
             CallbackQueryHandler(
                 pattern=r"^/download (\d+)",
-                callback=DownloadCommand(
-                    index, website).handle_callback_regex))
+                callback=self.served(DownloadCommand(
+                    index, website,
+                    converter=converter,
+                    attachment_cache=attachment_cache,
+                    rate_limiter=download_limiter,
+                    fetch_limit=fetch_limit,
+                    archives=archives)).handle_callback_regex))
+        self.updater.dispatcher.add_handler(
+            CallbackQueryHandler(
+                pattern=r"^/download (series) (\d+)$",
+                callback=self.served(DownloadCommand(
+                    index, website,
+                    converter=converter,
+                    attachment_cache=attachment_cache,
+                    rate_limiter=download_limiter,
+                    fetch_limit=fetch_limit,
+                    archives=archives)).handle_callback_regex))
 
         self.updater.dispatcher.add_handler(
             CommandHandler(
                 "email",
-                callback=EmailCommand(
-                    index, website, mailer).handle_command))
+                callback=self.served(EmailCommand(
+                    index, website, mail_queue,
+                    converter, attachment_cache,
+                    download_limiter, fetch_limit,
+                    archives=archives)).handle_command))
         self.updater.dispatcher.add_handler(
             CallbackQueryHandler(
                 pattern=r"^/email (\d+)",
-                callback=EmailCommand(
-                    index, website, mailer).handle_callback_regex))
+                callback=self.served(EmailCommand(
+                    index, website, mail_queue,
+                    converter, attachment_cache,
+                    download_limiter, fetch_limit,
+                    archives=archives)).handle_callback_regex))
+        self.updater.dispatcher.add_handler(
+            CallbackQueryHandler(
+                pattern=r"^/email (series) (\d+)$",
+                callback=self.served(EmailCommand(
+                    index, website, mail_queue,
+                    converter, attachment_cache,
+                    download_limiter, fetch_limit,
+                    archives=archives)).handle_callback_regex))
 
         self.updater.dispatcher.add_handler(
             CommandHandler(
                 "restart",
-                callback=RestartCommand(self.updater).handle_message))
+                callback=self.served(
+                    RestartCommand(self.updater)).handle_message))
+        self.updater.dispatcher.add_handler(
+            CommandHandler(
+                "profile",
+                callback=self.served(ProfileCommand()).handle_command))
+        self.updater.dispatcher.add_handler(
+            CommandHandler(
+                "stats",
+                callback=self.served(StatsCommand(
+                    index.database, self.updater, mail_queue,
+                    converter, attachment_cache, website)).handle_command))
+
+        self.updater.dispatcher.add_handler(
+            InlineQueryHandler(
+                callback=self.served(InlineSearchCommand(
+                    index, search_limiter)).handle_inline_query))
 
         self.updater.dispatcher.add_handler(
             MessageHandler(
                 filters=Filters.text,
-                callback=MessageCommand(index).handle_message))
+                callback=self.served(MessageCommand(
+                    index, search_limiter)).handle_message))
+
+    def served(self, command):
+        # The commands serve their responses through the outbox.
+        command.outbox = self.outbox
+        return command
+
+    def notify_email(self, job):
+        if job.status == job.SENT:
+            response = EmailSentResponse(job.user)
+        else:
+            response = EmailFailedResponse(job.user)
+        self.outbox.put(
+            job.user.user_id,
+            lambda bot, _: response.send(bot, job.user.user_id),
+            self.updater.bot, None)
 
     def serve(self):
+        self.rate_limits.load()
+        self.outbox.start()
+        self.mail_queue.start()
         self.updater.start_polling()
         self.updater.idle()
+        self.mail_queue.stop()
+        self.outbox.stop()
+        self.rate_limits.save()
@@ -0,0 +1,138 @@
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+# A request keeps at most this many spans for the detailed dump, the
+# rest are only counted, so a runaway loop cannot eat the memory.
+MAX_SPANS = 1000
+
+_local = threading.local()
+
+
+class Trace:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.started = time.perf_counter()
+        self.kinds = {}
+        self.spans = []
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, kind, detail, duration):
+        summary = self.kinds.get(kind)
+        if summary is None:
+            summary = self.kinds[kind] = {
+                "count": 0, "total_ms": 0.0, "slowest_ms": 0.0, "slowest": None}
+
+        duration_ms = duration * 1e3
+        summary["count"] += 1
+        summary["total_ms"] += duration_ms
+        if duration_ms > summary["slowest_ms"]:
+            summary["slowest_ms"] = duration_ms
+            summary["slowest"] = detail
+
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((kind, detail, duration_ms))
+
+    def grouped_spans(self):
+        # Identical statements are grouped, so an N+1 shows up as a single
+        # statement repeated N times rather than as N lines.
+        groups = {}
+        for kind, detail, duration_ms in self.spans:
+            group = groups.setdefault(
+                (kind, detail),
+                {"kind": kind, "detail": detail, "count": 0, "total_ms": 0.0})
+            group["count"] += 1
+            group["total_ms"] += duration_ms
+
+        for group in groups.values():
+            group["total_ms"] = round(group["total_ms"], 3)
+        return sorted(
+            groups.values(),
+            key=lambda group: group["total_ms"],
+            reverse=True)
+
+    def to_dict(self, duration, detailed=False):
+        record = {"trace": self.name}
+        record.update(self.attributes)
+        record["duration_ms"] = round(duration * 1e3, 3)
+        record["spans"] = {
+            kind: dict(
+                summary,
+                total_ms=round(summary["total_ms"], 3),
+                slowest_ms=round(summary["slowest_ms"], 3))
+            for kind, summary in self.kinds.items()
+        }
+        if detailed:
+            record["detail"] = self.grouped_spans()
+        return record
+
+
+class Tracer:
+    def __init__(self, sample_rate=0.0, slow_threshold=1.0, logger=None):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.logger = logger or logging.getLogger("tamizdat.trace")
+
+    def configure(self, sample_rate, slow_threshold):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        # Nested traces, such as a command calling another command, are
+        # folded into the outer one.
+        trace = current_trace()
+        if trace is not None:
+            yield trace
+            return
+
+        trace = _local.trace = Trace(name, attributes)
+        try:
+            yield trace
+        except BaseException as error:
+            trace.set(error=type(error).__name__)
+            raise
+        finally:
+            _local.trace = None
+            self.emit(trace)
+
+    def emit(self, trace):
+        duration = time.perf_counter() - trace.started
+        detailed = (
+            duration >= self.slow_threshold or
+            random.random() < self.sample_rate)
+        try:
+            self.logger.info(json.dumps(
+                trace.to_dict(duration, detailed),
+                ensure_ascii=False,
+                default=str))
+        except Exception as error:
+            logging.error("Could not emit trace: {}".format(error))
+
+
+TRACER = Tracer()
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def span(kind, detail=None):
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(kind, detail, time.perf_counter() - started)
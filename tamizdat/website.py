@@ -1,11 +1,15 @@
 import logging
+import time
 from os import path
 from urllib.parse import urljoin
 
 from lxml import html
 import requests
 
-from .models import File
+from .metrics import count_cache, instrument
+from .models import EBOOK_FORMATS, BookInfo, Ebook, File
+from .scheduler import INTERACTIVE, DirectScheduler
+from .tracing import span
 
 
 XPATH_ANNOTATION_TEXT = "//h2[text()='Аннотация']/following-sibling::p//text()"
@@ -21,12 +25,16 @@ class Website:
         baseurl="http://flibusta.net",
         book_url_format="{baseurl}/b/{id}",
         encoding="utf-8",
-        requests=requests
+        requests=requests,
+        scheduler=None,
+        timeout=30,
     ):
         self.baseurl = baseurl
         self.book_url_format = book_url_format
         self.encoding = encoding
         self.requests = requests
+        self.scheduler = scheduler or DirectScheduler()
+        self.timeout = timeout
 
     @staticmethod
     def _get_extension(href):
@@ -42,6 +50,35 @@ class Website:
     def _url(self, relative_url):
         return urljoin(self.baseurl, relative_url)
 
+    @staticmethod
+    def _text(response):
+        response.raise_for_status()
+        return response.text
+
+    @staticmethod
+    def _content(response):
+        response.raise_for_status()
+        return response.content
+
+    def _timeout(self, deadline):
+        # A request never outlives its deadline, so a stalled mirror
+        # times out and counts as a host failure instead of holding on
+        # to a slot.
+        if deadline is None:
+            return self.timeout
+        return max(min(self.timeout, deadline - time.monotonic()), 1)
+
+    def _get(self, url, read, priority, deadline):
+        # All the requests to the library go through the scheduler, which
+        # decides when they start or whether they run at all.
+        def fetch():
+            timeout = self._timeout(deadline)
+            with span("http", url), \
+                    self.requests.get(url, timeout=timeout) as response:
+                return read(response)
+
+        return self.scheduler.run(url, fetch, priority, deadline)
+
     def _scrape_additional_info(self, page_source):
         etree = html.fromstring(page_source)
 
@@ -59,42 +96,70 @@ class Website:
             if cover_image_url
             else None)
 
-        ebook_url = None
+        ebook_urls = {}
         for link in download_links:
-            if self._get_extension(link) == "epub":
-                ebook_url = link
+            extension = self._get_extension(link)
+            if extension in EBOOK_FORMATS:
+                ebook_urls[extension] = link
 
-        return annotation_text, cover_image_url, ebook_url
+        return annotation_text, cover_image_url, ebook_urls
+
+    @staticmethod
+    def _update_file(file_, remote_url, local_path):
+        # The file the book already has is kept, and so are the Telegram
+        # ids it has been uploaded under, unless it is another file.
+        if file_ is None or file_.local_path != local_path:
+            file_ = File(local_path=local_path)
+        if file_.file_id is None or file_.remote_url != remote_url:
+            file_.remote_url = remote_url
+            file_.save()
+        return file_
 
     def _append_additional_info(self, book, info):
         logging.info(
             "Appending additional info for book_id={}"
             .format(book.book_id))
 
-        annotation, cover_image_url, ebook_url = info
+        annotation, cover_image_url, ebook_urls = info
+        # A book is scraped once, whatever the page has, so the info is
+        # written even when there is none to show.
+        previous = BookInfo.get_or_none(BookInfo.book == book.book_id)
+        book_info = BookInfo(book=book.book_id)
 
         if annotation:
             logging.debug("Setting annotation")
-            book.annotation = annotation
+            book_info.annotation = annotation
 
         if cover_image_url:
             logging.debug("Setting cover image")
             _, ext = path.splitext(cover_image_url)
-            cover_image = File(
-                remote_url=cover_image_url,
-                local_path="{}{}".format(book.book_id, ext))
-            cover_image.save()
-            book.cover_image = cover_image
-
-        logging.debug("Setting ebook")
-        ebook = File(
-            remote_url=ebook_url,
-            local_path="{}.epub".format(book.book_id))
-        ebook.save()
-        book.ebook_epub = ebook
-
-    def fetch_additional_info(self, book):
-        if book.augmented:
+            book_info.cover_image = self._update_file(
+                previous.cover_image if previous else None,
+                cover_image_url,
+                "{}{}".format(book.book_id, ext))
+
+        for format_, ebook_url in ebook_urls.items():
+            logging.debug("Setting {} ebook".format(format_))
+            ebook = Ebook.get_or_none(
+                (Ebook.book == book.book_id) & (Ebook.format == format_))
+            if not ebook:
+                ebook = Ebook(book=book, format=format_)
+            ebook.file = self._update_file(
+                ebook.file if ebook.file_id else None,
+                ebook_url,
+                "{}.{}".format(book.book_id, format_))
+            ebook.save()
+
+        BookInfo.delete().where(BookInfo.book == book.book_id).execute()
+        book_info.save(force_insert=True)
+        book.info = book_info
+        book._ebooks = None
+
+    @instrument("fetch_additional_info")
+    def fetch_additional_info(self, book, priority=INTERACTIVE, deadline=None):
+        augmented = book.augmented
+        count_cache("book_info", augmented)
+        if augmented:
             logging.debug(
                 "Book has all the additional info. "
                 "No need to fetch anything.")
@@ -108,28 +173,32 @@ class Website:
             "Fetching additional info for book_id={}"
             .format(book.book_id))
 
-        with self.requests.get(url) as response:
-            info = self._scrape_additional_info(response.text)
-            self._append_additional_info(book, info)
+        page_source = self._get(url, self._text, priority, deadline)
+        info = self._scrape_additional_info(page_source)
 
-        book.augmented = True
-        book.save()
+        # The page is fetched and parsed before the transaction starts,
+        # so the write lock is only held for the few inserts.
+        with BookInfo._meta.database.atomic():
+            self._append_additional_info(book, info)
 
-    def download(self, url, filename):
+    @instrument("download")
+    def download(self, url, filename, priority=INTERACTIVE, deadline=None):
         url = self._url(url)
 
         logging.debug("Saving {} to {}".format(url, filename))
-        with requests.get(url) as response:
-            with open(filename, "wb") as fd:
-                fd.write(response.content)
+        content = self._get(url, self._content, priority, deadline)
+        with open(filename, "wb") as fd:
+            fd.write(content)
 
-    def download_file(self, file_):
+    def download_file(self, file_, priority=INTERACTIVE, deadline=None):
         remote_url = file_.remote_url
         local_path = file_.local_path
 
-        if not local_path or not path.exists(local_path):
+        cached = local_path and path.exists(local_path)
+        count_cache("file", cached)
+        if not cached:
             logging.debug("We don't have the file on disk.")
-            self.download(remote_url, local_path)
+            self.download(remote_url, local_path, priority, deadline)
             logging.debug("File downloaded!")
             local_path = file_.local_path
             file_.save()
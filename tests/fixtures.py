@@ -1,3 +1,5 @@
+import socketserver
+import threading
 from collections import OrderedDict
 from io import StringIO
 
@@ -101,3 +103,70 @@ def fake_catalog_with_author_duplicates(header, num_lines):
     return store_catalog(
         header,
         fake_cards_with_author_duplicates(num_lines))
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough of RFC 5321 for smtplib: EHLO, AUTH PLAIN, NOOP and a
+    # single-recipient transaction. Every connection and delivered message
+    # is recorded on the server, so tests can check pooling and content.
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 localhost ESMTP")
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+
+            verb = line.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.reply("250-localhost")
+                self.reply("250 AUTH PLAIN")
+            elif verb == "AUTH":
+                self.reply("235 Authentication successful")
+            elif verb == "NOOP":
+                self.server.noops += 1
+                self.reply("250 OK")
+            elif verb == "MAIL" and self.server.failures:
+                self.server.failures -= 1
+                self.reply("451 Try again later")
+            elif verb in ("MAIL", "RCPT", "RSET"):
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    data.append(data_line)
+                self.server.messages.append(b"".join(data))
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.host, self.port = self.server_address
+        self.connections = 0
+        self.noops = 0
+        self.failures = 0
+        self.messages = []
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import zipfile
+from os import path
+from unittest import TestCase
+
+from tamizdat.archive import ArchiveError, Archives
+from tamizdat.models import make_database, ArchiveMember, Book, Ebook, File
+
+
+class ArchivesTestCase(TestCase):
+    def setUp(self):
+        self.database = make_database()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.addCleanup(os.chdir, cwd)
+
+        self.content = "<FictionBook>Пикник на обочине</FictionBook>".encode() * 100
+        self.archive("f.fb2-000001-000002.zip", {
+            "1.fb2": self.content,
+            "2.fb2": b"<FictionBook/>",
+            "readme.txt": b"Not a book",
+        })
+        self.archives = Archives(chunk_size=64)
+
+    def archive(self, name, members, compression=zipfile.ZIP_DEFLATED):
+        with zipfile.ZipFile(name, "w", compression) as archive:
+            for member, content in members.items():
+                archive.writestr(member, content)
+
+    def test_books_are_indexed(self):
+        self.assertEqual(self.archives.index("."), 2)
+        member = self.archives.find(1)
+        self.assertEqual(member.format, "fb2")
+        self.assertTrue(member.archive.endswith("f.fb2-000001-000002.zip"))
+        self.assertIsNone(self.archives.find(3))
+
+    def test_later_archives_take_over(self):
+        self.archive("f.fb2-000002-000003.zip", {"2.fb2": b"<FictionBook>"})
+        self.archives.index(".")
+        self.assertTrue(
+            self.archives.find(2).archive.endswith("f.fb2-000002-000003.zip"))
+        self.assertEqual(ArchiveMember.select().count(), 2)
+
+    def test_members_are_read_in_place(self):
+        self.archive(
+            "stored.zip", {"3.fb2": self.content}, zipfile.ZIP_STORED)
+        self.archives.index(".")
+        for book_id in (1, 3):
+            member = self.archives.find(book_id)
+            self.assertEqual(b"".join(self.archives.read(member)), self.content)
+
+    def test_corrupted_members_are_not_extracted(self):
+        self.archives.index(".")
+        member = self.archives.find(1)
+        member.crc += 1
+
+        with self.assertRaises(ArchiveError):
+            self.archives.extract(member, "1.fb2")
+        self.assertEqual(os.listdir("."), ["f.fb2-000001-000002.zip"])
+
+    def test_ebook_is_extracted_once(self):
+        self.archives.index(".")
+        book = Book.create(book_id=1, title="Пикник на обочине")
+
+        ebook = self.archives.get_ebook(book)
+        self.assertEqual(ebook.format, "fb2")
+        with open(ebook.file.local_path, "rb") as fd:
+            self.assertEqual(fd.read(), self.content)
+
+        os.remove("f.fb2-000001-000002.zip")
+        book = Book.get(Book.book_id == 1)
+        self.assertEqual(self.archives.get_ebook(book).file_id, ebook.file_id)
+        self.assertEqual(Ebook.select().count(), 1)
+        self.assertEqual(File.select().count(), 1)
+
+    def test_ebook_in_a_format_the_user_does_not_read(self):
+        self.archives.index(".")
+        book = Book.create(book_id=1, title="Пикник на обочине")
+        self.assertIsNone(self.archives.get_ebook(book, formats=("epub", )))
+        self.assertFalse(path.exists("1.fb2"))
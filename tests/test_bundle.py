@@ -0,0 +1,47 @@
+import tempfile
+import zipfile
+from io import BytesIO
+from os import path
+from unittest import TestCase
+
+from tamizdat.bundle import pack, write_zip
+
+
+class PackTestCase(TestCase):
+    def pack(self, sizes, limit):
+        return pack(sizes, limit, size=lambda size: size)
+
+    def test_books_are_packed_into_few_bundles(self):
+        self.assertEqual(
+            self.pack([30, 60, 20, 40, 50], 100),
+            [[30, 20, 50], [60, 40]])
+
+    def test_large_books_get_bundles_of_their_own(self):
+        self.assertEqual(self.pack([10, 200, 10], 100), [[10, 10], [200]])
+
+    def test_nothing_is_packed_into_nothing(self):
+        self.assertEqual(self.pack([], 100), [])
+
+
+class WriteZipTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, contents):
+        local_path = path.join(self.directory.name, name)
+        with open(local_path, "wb") as fd:
+            fd.write(contents)
+        return local_path
+
+    def test_books_are_written_under_unique_names(self):
+        first = self.write("1.epub", b"first")
+        second = self.write("2.epub", b"second")
+
+        fd = BytesIO()
+        write_zip(fd, [(first, "Book.epub"), (second, "Book.epub")])
+
+        with zipfile.ZipFile(fd) as archive:
+            self.assertEqual(
+                archive.namelist(), ["Book.epub", "Book (2).epub"])
+            self.assertEqual(archive.read("Book (2).epub"), b"second")
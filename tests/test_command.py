@@ -1,5 +1,8 @@
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from os import path
 from unittest import TestCase
-from unittest.mock import call, patch, Mock
+from unittest.mock import ANY, call, patch, MagicMock, Mock
 
 from faker import Faker
 
@@ -12,10 +15,21 @@ from tamizdat.command import (
     SettingsEmailSetCommand,
     SearchCommand,
     MessageCommand,
+    InlineSearchCommand,
     BookInfoCommand,
+    AuthorCommand,
+    SeriesCommand,
     DownloadCommand,
-    EmailCommand)
-from tamizdat.models import make_database, User
+    EmailCommand,
+    ProfileCommand,
+    StatsCommand,
+    MAX_BUNDLE)
+from tamizdat.index import Index, TimeLimitExceeded
+from tamizdat.inline import Debouncer
+from tamizdat.models import make_database, Book, EmailJob, Ebook, File, User
+from tamizdat.ratelimit import ConcurrencyLimit
+from tamizdat.response import BundleResponse, DownloadResponse
+from tamizdat.scheduler import CircuitOpen, DeadlineExceeded
 
 
 fake = Faker()
@@ -128,6 +142,17 @@ class SettingsCommandTestCase(UserCommandTestMixin, TestCase):
         self.command.handle_command(self.update, self.context)
         MockResponse(self.user).serve.assert_called_with(self.context.bot, self.update.message)
 
+    @patch("tamizdat.command.SettingsResponse")
+    def test_response_is_served_through_the_outbox(self, MockResponse):
+        self.command.outbox = Mock()
+        self.command.handle_command(self.update, self.context)
+        MockResponse().serve.assert_not_called()
+
+        (chat_id, serve, bot, message), _ = self.command.outbox.put.call_args
+        self.assertEqual(chat_id, self.update.message.chat.id)
+        serve(bot, message)
+        MockResponse(self.user).serve.assert_called_with(self.context.bot, self.update.message)
+
 
 class SettingsEmailChooseCommandTestCase(UserCommandTestMixin, TestCase):
     def setUp(self):
@@ -175,13 +200,52 @@ class SearchCommandTestCase(UserCommandTestMixin, TestCase):
 
     @patch("tamizdat.command.SearchResponse")
     def test_search_command_returns_result_if_found(self, MockResponse):
-        self.index.search.return_value = Mock()  # Anything but None
+        self.index.search.return_value = [Mock()]
         self.update.message.text = fake.sentence()
 
         self.command.handle_message(self.update, self.context)
 
         MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
 
+    @patch("tamizdat.command.SearchResponse")
+    def test_search_command_passes_filters(self, MockResponse):
+        self.index.search.return_value = [Mock()]
+        self.update.message.text = (
+            "Стругацкие, lang:RU year:1965..1970 series:“Мир Полудня”")
+
+        self.command.handle_message(self.update, self.context)
+
+        self.index.search.assert_called_with(
+            "Стругацкие",
+            language="ru",
+            years=(1965, 1970),
+            series="Мир Полудня")
+        MockResponse.assert_called_with([ANY], None)
+
+    @patch("tamizdat.command.SearchResponse")
+    def test_search_command_suggests_filters_for_full_pages(self, MockResponse):
+        books = [Mock() for _ in range(10)]
+        self.index.search.return_value = books
+        self.update.message.text = "Толстой"
+
+        self.command.handle_message(self.update, self.context)
+
+        self.index.search.assert_called_with("Толстой")
+        MockResponse.assert_called_with(books, self.index.facets())
+
+    def test_parsing_years(self):
+        self.assertEqual(SearchCommand.parse_years("1990"), (1990, 1990))
+        self.assertEqual(
+            SearchCommand.parse_years("1990..2000"), (1990, 2000))
+        self.assertEqual(SearchCommand.parse_years("1990.."), (1990, None))
+        self.assertEqual(SearchCommand.parse_years("..2000"), (None, 2000))
+        self.assertIsNone(SearchCommand.parse_years(".."))
+        self.assertIsNone(SearchCommand.parse_years("девяностые"))
+
+    def test_malformed_years_are_ignored(self):
+        self.assertEqual(
+            self.command.parse("Пикник year:девяностые"), ("Пикник", {}))
+
     @patch("tamizdat.command.BookNotFoundResponse")
     def test_search_command_returns_not_found_if_not_found(self, MockResponse):
         self.index.search.return_value = None
@@ -191,6 +255,33 @@ class SearchCommandTestCase(UserCommandTestMixin, TestCase):
 
         MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
 
+    @patch("tamizdat.command.RateLimitedResponse")
+    def test_search_command_is_rate_limited(self, MockResponse):
+        self.user.is_admin = False
+        self.command.rate_limiter = Mock()
+        self.command.rate_limiter.allow.return_value = False
+        self.command.rate_limiter.retry_after.return_value = 3
+        self.update.message.text = fake.sentence()
+
+        self.command.handle_message(self.update, self.context)
+
+        self.index.search.assert_not_called()
+        self.command.rate_limiter.allow.assert_called_with(self.user.user_id)
+        MockResponse.assert_called_with(3)
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
+    @patch("tamizdat.command.SearchResponse")
+    def test_admins_are_not_rate_limited(self, MockResponse):
+        self.user.is_admin = True
+        self.command.rate_limiter = Mock()
+        self.index.search.return_value = [Mock()]
+        self.update.message.text = fake.sentence()
+
+        self.command.handle_message(self.update, self.context)
+
+        self.command.rate_limiter.allow.assert_not_called()
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
 
 class MessageCommandTestCase(UserCommandTestMixin, TestCase):
     def setUp(self):
@@ -215,6 +306,147 @@ class MessageCommandTestCase(UserCommandTestMixin, TestCase):
             self.context.bot, self.update.message, self.update.message.text)
 
 
+class ImmediateExecutor:
+    def submit(self, function, *args):
+        return function(*args)
+
+
+class InlineSearchCommandTestCase(TestCase):
+    def setUp(self):
+        self.database = make_database()
+        self.user = User.create(user_id=1, is_authorized=True)
+        self.index = MagicMock()
+        self.index.search.return_value = [Mock(
+            book_id=7, title="Пикник на обочине", subtitle=None,
+            series=None, author_list=[])]
+        self.index.uploaded_ebooks.return_value = {}
+        self.debouncer = Debouncer(sleep=lambda seconds: None)
+        self.command = InlineSearchCommand(
+            self.index,
+            debouncer=self.debouncer,
+            executor=ImmediateExecutor())
+
+        self.context = Mock()
+        self.context.bot.id = 42
+
+    def query(self, text, query_id="1", user_id=1):
+        update = Mock()
+        update.inline_query.id = query_id
+        update.inline_query.query = text
+        update.inline_query.from_user.id = user_id
+        return update
+
+    @patch("tamizdat.command.InlineSearchResponse")
+    def test_books_are_searched_by_prefix(self, MockResponse):
+        update = self.query("Пикник, обоч")
+        self.command.handle_inline_query(update, self.context)
+
+        self.index.search.assert_called_with(
+            "пикник обоч", items_per_page=50, prefix=True)
+        self.index.uploaded_ebooks.assert_called_with(
+            self.index.search.return_value, 42, self.user.preferred_formats)
+        MockResponse.assert_called_with(self.index.search.return_value, {})
+        MockResponse().serve.assert_called_with(
+            self.context.bot, update.inline_query)
+
+    def test_repeated_queries_are_answered_from_cache(self):
+        self.command.handle_inline_query(self.query("пикник"), self.context)
+        update = self.query("пикник на")
+        self.command.handle_inline_query(update, self.context)
+
+        self.assertEqual(self.index.search.call_count, 1)
+        update.inline_query.answer.assert_called_once()
+
+    def test_superseded_queries_are_not_answered(self):
+        update = self.query("пикн", query_id="1")
+        deadline = self.debouncer.arrive(1, "1")
+        self.debouncer.arrive(1, "2")
+
+        self.command.answer(update, self.context.bot, update.inline_query, deadline)
+
+        self.index.search.assert_not_called()
+        update.inline_query.answer.assert_not_called()
+
+    def test_slow_queries_are_not_answered(self):
+        self.index.time_limit.return_value.__exit__.side_effect = (
+            TimeLimitExceeded(1))
+        update = self.query("пикник")
+        self.command.handle_inline_query(update, self.context)
+
+        update.inline_query.answer.assert_not_called()
+
+    def test_unauthorized_users_get_no_results(self):
+        update = self.query("пикник", user_id=2)
+        self.command.handle_inline_query(update, self.context)
+
+        self.index.search.assert_not_called()
+        update.inline_query.answer.assert_not_called()
+
+
+class AuthorCommandTestCase(UserCommandTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.database = make_database()
+        self.index = Mock()
+        self.command = AuthorCommand(self.index)
+
+    @patch("tamizdat.command.AuthorBooksResponse")
+    def test_author_command_lists_first_page(self, MockResponse):
+        author = self.index.get_author.return_value
+        self.index.count_author_books.return_value = 25
+        self.context.match.groups.return_value = ("42", )
+
+        self.command.handle_command_regex(self.update, self.context)
+
+        self.index.get_author.assert_called_with(42)
+        self.index.author_books.assert_called_with(author.author_id, 1)
+        MockResponse.assert_called_with(
+            author, self.index.author_books.return_value, 1, 3)
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
+    @patch("tamizdat.command.AuthorBooksResponse")
+    def test_author_callback_lists_pages_within_range(self, MockResponse):
+        self.index.count_author_books.return_value = 25
+        self.context.match.groups.return_value = ("42", "7")
+
+        self.command.handle_callback_regex(self.update, self.context)
+
+        MockResponse.assert_called_with(ANY, ANY, 3, 3)
+
+    @patch("tamizdat.command.BookNotFoundResponse")
+    def test_author_command_returns_not_found_if_not_found(self, MockResponse):
+        self.index.get_author.return_value = None
+        self.context.match.groups.return_value = ("42", )
+
+        self.command.handle_command_regex(self.update, self.context)
+
+        self.index.author_books.assert_not_called()
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
+
+class SeriesCommandTestCase(UserCommandTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.database = make_database()
+        self.index = Mock()
+        self.command = SeriesCommand(self.index)
+
+    @patch("tamizdat.command.SeriesBooksResponse")
+    def test_series_callback_lists_page(self, MockResponse):
+        series = self.index.get_series.return_value
+        series.books = 12
+        self.context.match.groups.return_value = ("7", "2")
+
+        self.command.handle_callback_regex(self.update, self.context)
+
+        self.index.get_series.assert_called_with(7)
+        self.index.series_books.assert_called_with(series.series_id, 2)
+        MockResponse.assert_called_with(
+            series, self.index.series_books.return_value, 2, 2)
+        MockResponse().serve.assert_called_with(
+            self.context.bot, self.update.callback_query.message)
+
+
 class BookInfoCommandTestCase(UserCommandTestMixin, TestCase):
     def setUp(self):
         super().setUp()
@@ -235,7 +467,7 @@ class BookInfoCommandTestCase(UserCommandTestMixin, TestCase):
         self.command.handle_command_regex(self.update, self.context)
 
         self.index.get.assert_called_with(book_id)
-        self.website.fetch_additional_info.assert_called_with(book)
+        self.website.fetch_additional_info.assert_called_with(book, deadline=ANY)
         MockResponse(book).serve.assert_called_with(self.context.bot, self.update.message)
 
     @patch("tamizdat.command.BookNotFoundResponse")
@@ -251,6 +483,72 @@ class BookInfoCommandTestCase(UserCommandTestMixin, TestCase):
         self.index.get.assert_called_with(book_id)
         MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
 
+    @patch("tamizdat.command.BookInfoResponse")
+    def test_info_command_finds_typed_ids_in_the_book_cache(self, MockResponse):
+        Book.create(book_id=1, title=fake.sentence())
+        self.command.index = Index(self.database)
+        self.context.args = ("1", )
+
+        self.command.handle_command(self.update, self.context)
+        with patch.object(self.command.index, "_load") as load:
+            self.command.handle_command(self.update, self.context)
+        load.assert_not_called()
+        (book, ), _ = MockResponse.call_args
+        self.assertEqual(book.book_id, 1)
+
+    @patch("tamizdat.command.BookInfoResponse")
+    def test_info_command_shows_book_when_library_is_unavailable(self, MockResponse):
+        book = Mock()
+        self.index.get.return_value = book
+        self.website.fetch_additional_info.side_effect = DeadlineExceeded()
+        self.context.args = (1, )
+
+        self.command.handle_command(self.update, self.context)
+        MockResponse.assert_called_with(book)
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
+    @patch("tamizdat.command.BookInfoResponse")
+    def test_info_command_does_not_fetch_when_fetches_are_busy(self, MockResponse):
+        book = Mock()
+        self.index.get.return_value = book
+        self.command.fetch_limit = ConcurrencyLimit(1)
+        self.context.args = (1, )
+
+        with self.command.fetch_limit.slot():
+            self.command.handle_command(self.update, self.context)
+        self.website.fetch_additional_info.assert_not_called()
+        self.website.download_file.assert_not_called()
+        MockResponse.assert_called_with(book)
+
+    @patch("tamizdat.command.RateLimitedResponse")
+    def test_info_command_is_rate_limited(self, MockResponse):
+        self.user.is_admin = False
+        self.command.rate_limiter = Mock()
+        self.command.rate_limiter.allow.return_value = False
+        self.command.rate_limiter.retry_after.return_value = 3
+        self.context.args = (1, )
+
+        self.command.handle_command(self.update, self.context)
+        self.index.get.assert_not_called()
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
+    @patch("tamizdat.command.BookInfoResponse")
+    def test_info_command_downloads_covers_that_are_not_uploaded(self, MockResponse):
+        book = Mock()
+        self.index.get.return_value = book
+        self.context.args = (1, )
+
+        book.cover_image.get_telegram_id.return_value = None
+        self.command.handle_command(self.update, self.context)
+        self.website.download_file.assert_called_with(
+            book.cover_image, deadline=ANY)
+
+        self.website.download_file.reset_mock()
+        book.cover_image.get_telegram_id.return_value = "photo_id"
+        self.command.handle_command(self.update, self.context)
+        self.website.download_file.assert_not_called()
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
 
 class DownloadCommandTestCase(UserCommandTestMixin, TestCase):
     def setUp(self):
@@ -270,11 +568,175 @@ class DownloadCommandTestCase(UserCommandTestMixin, TestCase):
 
         self.command.handle_command_regex(self.update, self.context)
 
+        self.website.fetch_additional_info.assert_called_with(book, deadline=ANY)
         self.website.download_file.assert_has_calls(
-            [call(book.ebook_epub), call(book.cover_image)])
+            [call(book.get_ebook().file, deadline=ANY),
+             call(book.cover_image, deadline=ANY)])
 
         MockResponse(book).serve.assert_called_with(self.context.bot, self.update.message)
 
+    def archive_book(self, *library_formats):
+        # The book is in the archives as fb2, and in the library in the
+        # given formats.
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        Book.create(book_id=1, title=fake.sentence())
+        for format_ in library_formats:
+            Ebook.create(book=1, format=format_, file=File.create(
+                remote_url="/b/1/{}".format(format_),
+                local_path=path.join(self.directory, "1.{}".format(format_))))
+
+        self.command.index = Index(self.database)
+        self.command.archives = Mock()
+        self.command.archives.find.return_value = Mock(format="fb2")
+        self.command.archives.get_ebook.side_effect = (
+            lambda book, formats: self.local_ebook(book, "fb2"))
+        self.context.match.groups.return_value = ("1", )
+
+    def local_ebook(self, book, format_):
+        local_path = path.join(self.directory, "1.{}".format(format_))
+        with open(local_path, "w") as fd:
+            fd.write(format_)
+        return Ebook.create(
+            book=book.book_id, format=format_,
+            file=File.create(local_path=local_path))
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_serves_books_from_archives(self, MockResponse):
+        self.archive_book()
+        self.command.fetch_limit = ConcurrencyLimit(1)
+
+        with self.command.fetch_limit.slot():
+            self.command.handle_command_regex(self.update, self.context)
+
+        self.website.fetch_additional_info.assert_not_called()
+        self.website.download_file.assert_not_called()
+        MockResponse.assert_called_with(ANY, Ebook.get(Ebook.format == "fb2"))
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_prefers_archives_to_library_downloads(self, MockResponse):
+        self.archive_book("epub")
+
+        self.command.handle_command_regex(self.update, self.context)
+
+        self.website.download_file.assert_not_called()
+        MockResponse.assert_called_with(ANY, Ebook.get(Ebook.format == "fb2"))
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_prefers_library_formats_on_disk(self, MockResponse):
+        self.archive_book("epub")
+        with open(path.join(self.directory, "1.epub"), "w") as fd:
+            fd.write("epub")
+
+        self.command.handle_command_regex(self.update, self.context)
+
+        self.command.archives.get_ebook.assert_not_called()
+        self.website.download_file.assert_any_call(ANY, deadline=ANY)
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_converts_archives_over_library_formats(self, MockResponse):
+        self.archive_book("epub")
+        self.command.converter = Mock()
+        self.command.converter.can_convert.return_value = True
+        converted = Mock(format="epub")
+        self.command.converter.convert_ebook.return_value = converted
+
+        self.command.handle_command_regex(self.update, self.context)
+
+        self.command.converter.convert_ebook.assert_called_with(
+            ANY, Ebook.get(Ebook.format == "fb2"), "epub")
+        self.website.download_file.assert_not_called()
+        MockResponse.assert_called_with(ANY, converted)
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_leaves_unread_formats_to_library(self, MockResponse):
+        self.archive_book("epub")
+        self.command.formats = ("epub", "mobi")
+
+        self.command.handle_command_regex(self.update, self.context)
+
+        self.command.archives.get_ebook.assert_not_called()
+        self.website.download_file.assert_any_call(ANY, deadline=ANY)
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_serves_earlier_conversions(self, MockResponse):
+        self.archive_book()
+        converted = self.local_ebook(Book.get(Book.book_id == 1), "epub")
+        self.command.converter = Mock()
+        self.command.converter.can_convert.return_value = True
+
+        self.command.handle_command_regex(self.update, self.context)
+
+        self.command.archives.get_ebook.assert_not_called()
+        self.command.converter.convert_ebook.assert_not_called()
+        MockResponse.assert_called_with(ANY, converted)
+
+    @patch("tamizdat.command.BusyResponse")
+    def test_download_command_is_rejected_when_fetches_are_busy(self, MockResponse):
+        self.command.fetch_limit = ConcurrencyLimit(1)
+        self.context.match.groups.return_value = (1, )
+
+        with self.command.fetch_limit.slot():
+            self.command.handle_command_regex(self.update, self.context)
+
+        self.index.get.assert_not_called()
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_converts_to_preferred_format(self, MockResponse):
+        book_id = fake.random.randint(100, 100000)
+        book = Mock()
+        ebook = book.get_ebook.return_value
+        ebook.format = "fb2"
+        converter = Mock()
+        converter.can_convert.return_value = True
+
+        self.index.get.return_value = book
+        self.context.match.groups.return_value = (book_id, )
+
+        command = DownloadCommand(
+            self.index, self.website, ("mobi", "fb2"), converter)
+        command.handle_command_regex(self.update, self.context)
+
+        converter.convert_ebook.assert_called_with(book, ebook, "mobi")
+        MockResponse.assert_called_with(
+            book, converter.convert_ebook.return_value)
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_warms_attachment_cache(self, MockResponse):
+        book_id = fake.random.randint(100, 100000)
+        book = Mock()
+        attachment_cache = Mock()
+
+        self.index.get.return_value = book
+        self.context.match.groups.return_value = (book_id, )
+
+        command = DownloadCommand(
+            self.index, self.website, attachment_cache=attachment_cache)
+        command.handle_command_regex(self.update, self.context)
+
+        attachment_cache.warm_async.assert_called_with(book.get_ebook())
+
+    @patch("tamizdat.command.DownloadResponse")
+    def test_download_command_falls_back_if_conversion_fails(self, MockResponse):
+        book_id = fake.random.randint(100, 100000)
+        book = Mock()
+        ebook = book.get_ebook.return_value
+        converter = Mock()
+        converter.can_convert.return_value = True
+        converter.convert_ebook.side_effect = RuntimeError()
+
+        self.index.get.return_value = book
+        self.context.match.groups.return_value = (book_id, )
+
+        command = DownloadCommand(
+            self.index, self.website, ("mobi", "fb2"), converter)
+        command.handle_command_regex(self.update, self.context)
+
+        MockResponse.assert_called_with(book, ebook)
+
     @patch("tamizdat.command.BookNotFoundResponse")
     def test_download_command_returns_not_found_if_not_found(self, MockResponse):
         book_id = fake.random.randint(100, 100000)
@@ -285,6 +747,28 @@ class DownloadCommandTestCase(UserCommandTestMixin, TestCase):
         self.command.handle_command_regex(self.update, self.context)
         MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
 
+    @patch("tamizdat.command.EbookNotFoundResponse")
+    def test_download_command_returns_not_found_if_no_ebook(self, MockResponse):
+        book_id = fake.random.randint(100, 100000)
+        book = Mock()
+        book.get_ebook.return_value = None
+
+        self.index.get.return_value = book
+        self.context.match.groups.return_value = (book_id, )
+
+        self.command.handle_command_regex(self.update, self.context)
+        self.website.download_file.assert_not_called()
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
+    @patch("tamizdat.command.LibraryUnavailableResponse")
+    def test_download_command_reports_unavailable_library(self, MockResponse):
+        self.index.get.return_value = Mock()
+        self.website.download_file.side_effect = CircuitOpen("flibusta.net")
+        self.context.match.groups.return_value = (1, )
+
+        self.command.handle_command_regex(self.update, self.context)
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
     @patch("tamizdat.command.DownloadResponse")
     def test_download_command_skips_cover_if_not_defined(self, MockResponse):
         book_id = fake.random.randint(100, 100000)
@@ -298,10 +782,69 @@ class DownloadCommandTestCase(UserCommandTestMixin, TestCase):
 
         # A clunky way to assert that something _was not_ called.
         with self.assertRaises(AssertionError):
-            self.website.download_file.assert_called_with(book.cover_image)
+            self.website.download_file.assert_called_with(book.cover_image, deadline=ANY)
 
         MockResponse(book).serve.assert_called_with(self.context.bot, self.update.message)
 
+    @patch("tamizdat.command.BundleResponse")
+    def test_download_callback_fetches_a_series_at_once(self, MockResponse):
+        books = {book_id: Mock(book_id=book_id) for book_id in (1, 2, 3)}
+        books[2].get_ebook.return_value = None
+        self.index.series_books.return_value = list(books.values())
+        self.index.get.side_effect = books.get
+        self.context.match.groups.return_value = ("series", "42")
+
+        self.command.handle_callback_regex(self.update, self.context)
+
+        self.index.series_books.assert_called_with(42, 1, MAX_BUNDLE)
+        MockResponse.assert_called_with([
+            (books[1], books[1].get_ebook()),
+            (books[3], books[3].get_ebook())])
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.callback_query.message)
+
+    @patch("tamizdat.command.BundleResponse")
+    def test_download_command_charges_a_bundle_per_book(self, MockResponse):
+        books = {book_id: Mock(book_id=book_id) for book_id in (1, 2, 3, 4)}
+        self.index.get.side_effect = lambda book_id: books[int(book_id)]
+        self.user.is_admin = False
+        self.command.rate_limiter = Mock()
+        self.command.rate_limiter.allow.side_effect = [True, True, False]
+        self.context.args = ["1", "2", "3", "4"]
+
+        self.command.handle_command(self.update, self.context)
+
+        self.assertEqual(self.command.rate_limiter.allow.call_count, 3)
+        MockResponse.assert_called_with([
+            (books[1], books[1].get_ebook()),
+            (books[2], books[2].get_ebook())])
+
+    @patch("tamizdat.command.ThreadPoolExecutor", wraps=ThreadPoolExecutor)
+    @patch("tamizdat.command.BundleResponse")
+    def test_download_command_takes_a_slot_per_bundle_fetch(self, MockResponse, MockExecutor):
+        self.index.get.return_value = Mock()
+        self.command.fetch_limit = ConcurrencyLimit(4)
+        self.context.args = ["1", "2", "3", "4"]
+
+        with self.command.fetch_limit.slot():
+            self.command.handle_command(self.update, self.context)
+
+            # The bundle has given back the slots it took.
+            with self.command.fetch_limit.slot() as first, \
+                    self.command.fetch_limit.slot() as second, \
+                    self.command.fetch_limit.slot() as third:
+                self.assertTrue(first and second and third)
+
+        MockExecutor.assert_called_with(3)
+
+    @patch("tamizdat.command.BookNotFoundResponse")
+    def test_download_command_with_several_books_not_found(self, MockResponse):
+        self.index.get.return_value = None
+        self.context.args = ["1", "2"]
+
+        self.command.handle_command(self.update, self.context)
+        self.assertEqual(self.index.get.call_count, 2)
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
 
 class EmailCommandTestCase(UserCommandTestMixin, TestCase):
     def setUp(self):
@@ -309,49 +852,102 @@ class EmailCommandTestCase(UserCommandTestMixin, TestCase):
         self.database = make_database()
         self.index = Mock()
         self.website = Mock()
-        self.mailer = Mock()
-        self.command = EmailCommand(self.index, self.website, self.mailer)
+        self.mail_queue = Mock()
+        self.command = EmailCommand(self.index, self.website, self.mail_queue)
 
     @patch("tamizdat.command.DownloadCommand")
-    @patch("tamizdat.command.EmailSentResponse")
-    def test_email_command_sends_email_if_found(self, MockResponse, MockDownloadCommand):
+    @patch("tamizdat.command.EmailQueuedResponse")
+    def test_email_command_queues_email_if_found(self, MockResponse, MockDownloadCommand):
         book_id = fake.random.randint(100, 1000000)
-        book = Mock()
+        book, ebook = Mock(), Mock()
 
-        self.index.get.return_value = book
+        MockDownloadCommand().execute.return_value = DownloadResponse(book, ebook)
         self.context.match.groups.return_value = (book_id, )
 
         self.command.handle_command_regex(self.update, self.context)
-        self.mailer.send.assert_called_with(book, self.user)
+        self.mail_queue.enqueue.assert_called_with(book, ebook, self.user)
+        self.index.get.assert_not_called()
         MockResponse(self.user).serve.assert_called_with(self.context.bot, self.update.message)
 
+    @patch("tamizdat.command.DownloadCommand")
+    def test_email_command_is_not_queued_if_download_failed(self, MockDownloadCommand):
+        failure = Mock()
+        MockDownloadCommand().execute.return_value = failure
+        self.context.match.groups.return_value = (1, )
+
+        self.command.handle_command_regex(self.update, self.context)
+        self.mail_queue.enqueue.assert_not_called()
+        failure.serve.assert_called_with(self.context.bot, self.update.message)
+
     @patch("tamizdat.command.DownloadCommand")
     @patch("tamizdat.command.EmailFailedResponse")
     def test_email_command_returns_failure_message_if_failed(self, MockResponse, MockDownloadCommand):
         book_id = fake.random.randint(100, 1000000)
-        book = Mock()
 
-        self.index.get.return_value = book
+        MockDownloadCommand().execute.return_value = DownloadResponse(Mock(), Mock())
         self.context.match.groups.return_value = (book_id, )
-        self.mailer.send.side_effect = Mock(side_effect=RuntimeError())
+        self.mail_queue.enqueue.side_effect = Mock(side_effect=RuntimeError())
 
         self.command.handle_command_regex(self.update, self.context)
         MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
 
     @patch("tamizdat.command.DownloadCommand")
-    @patch("tamizdat.command.EmailSentResponse")
-    def test_email_callback_sends_email_if_found(self, MockResponse, MockDownloadCommand):
-        # The same as test_email_comamnd_sends_email_if_found, but with a callback.
+    @patch("tamizdat.command.EmailQueuedResponse")
+    def test_email_callback_queues_email_if_found(self, MockResponse, MockDownloadCommand):
+        # The same as test_email_command_queues_email_if_found, but with a callback.
         book_id = fake.random.randint(100, 1000000)
-        book = Mock()
+        book, ebook = Mock(), Mock()
 
-        self.index.get.return_value = book
+        MockDownloadCommand().execute.return_value = DownloadResponse(book, ebook)
         self.context.match.groups.return_value = (book_id, )
 
         self.command.handle_callback_regex(self.update, self.context)
-        self.mailer.send.assert_called_with(book, self.user)
+        self.mail_queue.enqueue.assert_called_with(book, ebook, self.user)
         MockResponse(self.user).serve.assert_called_with(self.context.bot, self.update.callback_query.message)
 
+    @patch("tamizdat.command.DownloadCommand")
+    @patch("tamizdat.command.EmailQueuedResponse")
+    def test_email_command_queues_a_bundle_of_books(self, MockResponse, MockDownloadCommand):
+        items = [(Mock(), Mock()), (Mock(), Mock())]
+        MockDownloadCommand().execute.return_value = BundleResponse(items)
+        self.context.args = ["1", "2"]
+
+        self.command.handle_command(self.update, self.context)
+        MockDownloadCommand().execute.assert_called_with(
+            self.context.bot, self.update.message, "1", "2")
+        self.mail_queue.enqueue_bundle.assert_called_with(items, self.user)
+        self.mail_queue.enqueue.assert_not_called()
+        MockResponse(self.user).serve.assert_called_with(self.context.bot, self.update.message)
+
+    @patch("tamizdat.command.EmailQueuedResponse")
+    def test_email_command_charges_a_bundle_per_book(self, MockResponse):
+        books = {book_id: Mock(book_id=book_id) for book_id in (1, 2, 3)}
+        self.index.get.side_effect = lambda book_id: books[int(book_id)]
+        self.user.is_admin = False
+        self.user.preferred_formats = ("epub", )
+        self.command.rate_limiter = Mock()
+        self.command.rate_limiter.allow.side_effect = [True, True, False]
+        self.context.args = ["1", "2", "3"]
+
+        self.command.handle_command(self.update, self.context)
+
+        self.assertEqual(self.command.rate_limiter.allow.call_count, 3)
+        self.mail_queue.enqueue_bundle.assert_called_with([
+            (books[1], books[1].get_ebook()),
+            (books[2], books[2].get_ebook())], self.user)
+
+    @patch("tamizdat.command.BookNotFoundResponse")
+    def test_email_callback_reports_a_series_that_could_not_be_fetched(self, MockResponse):
+        self.index.series_books.return_value = [Mock(book_id=1), Mock(book_id=2)]
+        self.index.get.return_value = None
+        self.context.match.groups.return_value = ("series", "42")
+
+        self.command.handle_callback_regex(self.update, self.context)
+
+        self.mail_queue.enqueue.assert_not_called()
+        self.mail_queue.enqueue_bundle.assert_not_called()
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.callback_query.message)
+
     @patch("tamizdat.command.SettingsEmailChooseResponse")
     def test_email_callback_asks_for_email_if_none(self, MockResponse):
         book_id = fake.random.randint(100, 1000000)
@@ -364,3 +960,59 @@ class EmailCommandTestCase(UserCommandTestMixin, TestCase):
 
         self.command.handle_callback_regex(self.update, self.context)
         MockResponse().serve.assert_called_with(self.context.bot, self.update.callback_query.message)
+
+
+class ProfileCommandTestCase(UserCommandTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.profiler = Mock()
+        self.command = ProfileCommand(self.profiler, max_seconds=60)
+
+    @patch("tamizdat.command.threading.Thread")
+    @patch("tamizdat.command.ProfileStartedResponse")
+    def test_profile_runs_in_background(self, MockResponse, MockThread):
+        self.context.args = ("600", )
+        self.command.handle_command(self.update, self.context)
+
+        MockThread.assert_called_with(
+            target=self.command.profile,
+            args=(self.context.bot, self.update.message, 60),
+            daemon=True)
+        MockThread().start.assert_called_with()
+        MockResponse(60).serve.assert_called_with(self.context.bot, self.update.message)
+
+    @patch("tamizdat.command.ProfileResponse")
+    def test_profile_is_sent_when_collected(self, MockResponse):
+        self.command.profile(self.context.bot, self.update.message, 5)
+        self.profiler.profile.assert_called_with(5)
+        MockResponse.assert_called_with(self.profiler.profile())
+        MockResponse().serve.assert_called_with(self.context.bot, self.update.message)
+
+
+class StatsCommandTestCase(UserCommandTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.database = make_database()
+        self.updater = Mock()
+        self.updater.update_queue.qsize.return_value = 3
+        self.converter = Mock()
+        self.converter.pending = {"a.mobi": Mock()}
+        self.converter.cache_dir = "/nonexistent"
+        self.command = StatsCommand(
+            self.database, self.updater, Mock(), self.converter)
+
+    @patch("tamizdat.command.StatsResponse")
+    def test_stats_report_queues_and_caches(self, MockResponse):
+        user = User.create(user_id=1)
+        EmailJob.create(user=user, book=1, ebook=1)
+
+        self.command.handle_command(self.update, self.context)
+
+        (stats, ), _ = MockResponse.call_args
+        self.assertGreater(stats["rss"], 0)
+        self.assertEqual(stats["database"], 0)
+        self.assertEqual(
+            stats["queues"], {"updates": 3, "emails": 1, "conversions": 1})
+        self.assertEqual(stats["caches"]["conversions"], (0, 0))
+        self.assertEqual(stats["caches"]["telegram_files"], (0, None))
+        self.assertEqual(stats["caches"]["books"], (0, None))
@@ -0,0 +1,181 @@
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from os import path
+from unittest import TestCase
+
+from tamizdat.convert import Converter, ConversionPool
+from tamizdat.models import make_database, Book, Ebook, File
+
+from .fixtures import fake_book
+
+
+class CopyConverter(Converter):
+    def convert(self, source_path, target_path):
+        shutil.copyfile(source_path, target_path)
+
+
+class CountingConverter(CopyConverter):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def convert(self, source_path, target_path):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        super().convert(source_path, target_path)
+
+
+class ConversionPoolTestCase(TestCase):
+    def setUp(self):
+        self.database = make_database()
+        self.directory = tempfile.mkdtemp()
+        self.source_path = path.join(self.directory, "source.fb2")
+        with open(self.source_path, "wb") as fd:
+            fd.write(b"<FictionBook/>")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_pool(self, converter, **kwargs):
+        return ConversionPool(
+            converter,
+            cache_dir=path.join(self.directory, "converted"),
+            executor=ThreadPoolExecutor(4),
+            **kwargs)
+
+    def test_converter_accepts_only_known_formats(self):
+        converter = Converter()
+        self.assertTrue(converter.can_convert("fb2", "epub"))
+        self.assertTrue(converter.can_convert("epub", "mobi"))
+        self.assertFalse(converter.can_convert("epub", "epub"))
+        self.assertFalse(converter.can_convert("mobi", "epub"))
+        self.assertFalse(converter.can_convert("fb2", "fb2"))
+
+    def test_conversion_in_process_pool(self):
+        pool = ConversionPool(
+            CopyConverter(),
+            cache_dir=path.join(self.directory, "converted"),
+            max_workers=1)
+        target_path = pool.convert(self.source_path, "epub")
+        pool.shutdown()
+
+        self.assertTrue(target_path.endswith(".epub"))
+        with open(target_path, "rb") as fd:
+            self.assertEqual(fd.read(), b"<FictionBook/>")
+
+    def test_converted_file_is_cached_by_source_hash(self):
+        converter = CountingConverter()
+        pool = self.make_pool(converter)
+
+        first_path = pool.convert(self.source_path, "epub")
+        copy_path = path.join(self.directory, "copy.fb2")
+        shutil.copyfile(self.source_path, copy_path)
+        second_path = pool.convert(copy_path, "epub")
+
+        self.assertEqual(first_path, second_path)
+        self.assertEqual(converter.calls, 1)
+
+    def test_concurrent_conversions_share_one_job(self):
+        converter = CountingConverter(delay=0.2)
+        pool = self.make_pool(converter)
+
+        with ThreadPoolExecutor(4) as requests:
+            paths = list(requests.map(
+                lambda _: pool.convert(self.source_path, "mobi"),
+                range(4)))
+
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(converter.calls, 1)
+        self.assertEqual(pool.pending, {})
+
+    def test_conversion_that_is_done_at_once_is_forgotten(self):
+        class ImmediateExecutor:
+            def submit(self, function, *args):
+                future = Future()
+                future.set_result(function(*args))
+                return future
+
+        pool = ConversionPool(
+            CopyConverter(),
+            cache_dir=path.join(self.directory, "converted"),
+            executor=ImmediateExecutor())
+        self.assertTrue(pool.convert(self.source_path, "epub").endswith(".epub"))
+        self.assertEqual(pool.pending, {})
+
+    def test_slow_conversion_times_out(self):
+        pool = self.make_pool(CountingConverter(delay=0.5), timeout=0.01)
+        with self.assertRaises(TimeoutError):
+            pool.convert(self.source_path, "epub")
+
+    def test_converting_ebook_records_new_format(self):
+        pool = self.make_pool(CopyConverter())
+
+        book = Book.create(**fake_book())
+        ebook = Ebook.create(
+            book=book, format="fb2",
+            file=File.create(local_path=self.source_path))
+
+        converted = pool.convert_ebook(book, ebook, "epub")
+        self.assertEqual(converted.format, "epub")
+        self.assertTrue(path.exists(converted.file.local_path))
+        self.assertEqual(book.get_ebook(("epub", "fb2")), converted)
+
+    def test_converting_ebook_again_keeps_its_file(self):
+        pool = self.make_pool(CopyConverter())
+
+        book = Book.create(**fake_book())
+        ebook = Ebook.create(
+            book=book, format="fb2",
+            file=File.create(local_path=self.source_path))
+
+        converted = pool.convert_ebook(book, ebook, "epub")
+        converted.file.set_telegram_id(1, "file_id")
+        again = pool.convert_ebook(book, ebook, "epub")
+
+        self.assertEqual(again.file_id, converted.file_id)
+        self.assertEqual(again.file.get_telegram_id(1), "file_id")
+        self.assertEqual(File.select().count(), 2)
+
+    def test_library_ebook_is_not_replaced_by_conversion(self):
+        pool = self.make_pool(CopyConverter())
+
+        book = Book.create(**fake_book())
+        ebook = Ebook.create(
+            book=book, format="fb2",
+            file=File.create(local_path=self.source_path))
+        library_path = path.join(self.directory, "1.epub")
+        with open(library_path, "wb") as fd:
+            fd.write(b"epub")
+        library_file = File.create(
+            remote_url="/b/1/epub", local_path=library_path)
+        Ebook.create(book=book, format="epub", file=library_file)
+
+        with self.assertRaises(ValueError):
+            pool.convert_ebook(book, ebook, "epub")
+        self.assertEqual(
+            Ebook.get(Ebook.format == "epub").file.local_path, library_path)
+
+    def test_library_ebook_not_downloaded_is_kept_as_converted(self):
+        pool = self.make_pool(CopyConverter())
+
+        book = Book.create(**fake_book())
+        ebook = Ebook.create(
+            book=book, format="fb2",
+            file=File.create(local_path=self.source_path))
+        library_file = File.create(
+            remote_url="/b/1/epub",
+            local_path=path.join(self.directory, "1.epub"))
+        Ebook.create(book=book, format="epub", file=library_file)
+
+        converted = pool.convert_ebook(book, ebook, "epub")
+        self.assertEqual(converted.file_id, library_file.file_id)
+        self.assertEqual(converted.file.remote_url, "/b/1/epub")
+        self.assertTrue(path.exists(converted.file.local_path))
+        self.assertEqual(
+            pool.convert_ebook(book, ebook, "epub").file_id,
+            library_file.file_id)
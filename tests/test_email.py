@@ -0,0 +1,321 @@
+import email
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+from io import BytesIO
+from os import path
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from tamizdat.email import AttachmentCache, Mailer, MailQueue
+from tamizdat.models import (
+    make_database, Book, BookInfo, Ebook, EmailJob, File, User)
+
+from .fixtures import FakeSMTPServer, fake_book
+
+
+logging.disable(logging.CRITICAL)
+
+
+class MailTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = make_database(
+            path.join(self.directory, "index.sqlite3"))
+
+        ebook_path = path.join(self.directory, "book.epub")
+        with open(ebook_path, "wb") as fd:
+            fd.write(b"ebook contents")
+
+        self.book = Book.create(**fake_book())
+        self.ebook = Ebook.create(
+            book=self.book,
+            format="epub",
+            file=File.create(local_path=ebook_path))
+        self.user = User.create(user_id=102030, email="reader@example.com")
+
+        self.server = FakeSMTPServer().__enter__()
+        self.mailer = Mailer(
+            login="bot@example.com",
+            password="password",
+            host=self.server.host,
+            port=self.server.port,
+            use_ssl=False)
+
+    def tearDown(self):
+        self.server.__exit__()
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+
+class MailerTestCase(MailTestCase):
+    def write_ebook(self, contents):
+        with open(self.ebook.file.local_path, "wb") as fd:
+            fd.write(contents)
+
+    def write_message(self):
+        fd = BytesIO()
+        self.mailer.write_message(fd, self.book, self.ebook, self.user)
+        return fd.getvalue()
+
+    def test_message_has_the_ebook_attached(self):
+        BookInfo.create(book=self.book.book_id, annotation="Аннотация")
+        message = email.message_from_bytes(self.write_message())
+        self.assertEqual(message["To"], self.user.email)
+
+        text, attachment = message.get_payload()
+        self.assertEqual(text.get_payload(decode=True).decode(), "Аннотация")
+        self.assertEqual(attachment.get_filename(), "book.epub")
+        self.assertEqual(attachment.get_payload(decode=True), b"ebook contents")
+
+    def test_annotation_does_not_clash_with_the_attachment(self):
+        annotation = "Read more:\n--attachment--\nend"
+        BookInfo.create(book=self.book.book_id, annotation=annotation)
+        message = email.message_from_bytes(self.write_message())
+
+        text, attachment = message.get_payload()
+        self.assertEqual(
+            text.get_payload(decode=True).decode().splitlines(),
+            annotation.splitlines())
+        self.assertEqual(attachment.get_payload(decode=True), b"ebook contents")
+
+    def test_large_attachment_is_encoded_in_whole_lines(self):
+        contents = bytes(range(256)) * 1000
+        self.write_ebook(contents)
+
+        raw_message = self.write_message()
+        for line in raw_message.split(b"\r\n"):
+            self.assertLessEqual(len(line), 78)
+
+        message = email.message_from_bytes(raw_message)
+        attachment, = message.get_payload()
+        self.assertEqual(attachment.get_payload(decode=True), contents)
+
+    def test_streamed_message_is_received_intact(self):
+        contents = b"..leading dots\r\n.\r\n" * 1000
+        self.write_ebook(contents)
+
+        self.mailer.send(self.book, self.ebook, self.user)
+        received, = self.server.messages
+        message = email.message_from_bytes(received.replace(b"\r\n..", b"\r\n."))
+        attachment, = message.get_payload()
+        self.assertEqual(attachment.get_payload(decode=True), contents)
+
+    def test_message_is_sent_in_blocks(self):
+        self.write_ebook(bytes(range(256)) * 1000)
+
+        server = self.mailer.connect()
+        server.send = Mock(wraps=server.send)
+        self.mailer.send(self.book, self.ebook, self.user, server)
+        server.close()
+
+        # Some 4500 lines, in six blocks and a few commands.
+        self.assertLess(server.send.call_count, 20)
+        self.assertEqual(len(self.server.messages), 1)
+
+    def test_dots_are_stuffed_across_blocks(self):
+        contents = b"..leading dots\r\n.\r\n" * 1000
+        self.write_ebook(contents)
+
+        with patch("tamizdat.email.SEND_BLOCK_SIZE", 7):
+            self.mailer.send(self.book, self.ebook, self.user)
+
+        received, = self.server.messages
+        message = email.message_from_bytes(received.replace(b"\r\n..", b"\r\n."))
+        attachment, = message.get_payload()
+        self.assertEqual(attachment.get_payload(decode=True), contents)
+
+    def test_send_without_a_pool_opens_its_own_connection(self):
+        self.mailer.send(self.book, self.ebook, self.user)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 1)
+
+
+class AttachmentCacheTestCase(MailTestCase):
+    def setUp(self):
+        super().setUp()
+        self.attachment_cache = AttachmentCache(
+            path.join(self.directory, "attachments"))
+        self.mailer.attachment_cache = self.attachment_cache
+
+    def test_cache_is_keyed_by_book_and_format(self):
+        cached_path = self.attachment_cache.path(self.ebook)
+        self.assertTrue(cached_path.endswith(
+            "{}.epub.b64".format(self.book.book_id)))
+
+    def test_warming_encodes_the_attachment_once(self):
+        self.assertFalse(self.attachment_cache.is_fresh(self.ebook))
+        cached_path = self.attachment_cache.warm(self.ebook)
+        self.assertTrue(self.attachment_cache.is_fresh(self.ebook))
+
+        with open(cached_path, "rb") as fd:
+            self.assertEqual(fd.read(), b"ZWJvb2sgY29udGVudHM=\r\n")
+
+        mtime = path.getmtime(cached_path)
+        self.attachment_cache.warm_async(self.ebook).result()
+        self.assertEqual(path.getmtime(cached_path), mtime)
+
+    def test_changed_ebook_is_encoded_again(self):
+        cached_path = self.attachment_cache.warm(self.ebook)
+        os.utime(cached_path, (0, 0))
+        self.assertFalse(self.attachment_cache.is_fresh(self.ebook))
+
+    def test_message_is_built_from_the_cached_attachment(self):
+        self.attachment_cache.warm(self.ebook)
+        with open(self.attachment_cache.path(self.ebook), "wb") as fd:
+            fd.write(b"Y2FjaGVk\r\n")
+
+        fd = BytesIO()
+        self.mailer.write_message(fd, self.book, self.ebook, self.user)
+        message = email.message_from_bytes(fd.getvalue())
+        attachment, = message.get_payload()
+        self.assertEqual(attachment.get_payload(decode=True), b"cached")
+
+
+class MailQueueTestCase(MailTestCase):
+    def setUp(self):
+        super().setUp()
+        self.notify = Mock()
+        self.mail_queue = MailQueue(
+            self.mailer,
+            notify=self.notify,
+            pool_size=1,
+            max_attempts=2,
+            backoff=60)
+
+    def tearDown(self):
+        self.mail_queue.stop()
+        super().tearDown()
+
+    def enqueue(self, num_jobs=1):
+        return [
+            self.mail_queue.enqueue(self.book, self.ebook, self.user)
+            for _ in range(num_jobs)
+        ]
+
+    def test_enqueued_job_is_stored_and_sent_later(self):
+        job, = self.enqueue()
+        self.assertEqual(len(self.server.messages), 0)
+        self.assertEqual(EmailJob.get_by_id(job.job_id).status, EmailJob.PENDING)
+
+        # A fresh queue picks up whatever is left in the database.
+        mail_queue = MailQueue(self.mailer, notify=self.notify)
+        self.assertEqual(mail_queue.process_pending(), 1)
+        mail_queue.stop()
+
+        job = EmailJob.get_by_id(job.job_id)
+        self.assertEqual(job.status, EmailJob.SENT)
+        self.assertEqual(len(self.server.messages), 1)
+        self.notify.assert_called_once_with(job)
+
+    def test_job_seen_by_two_pollers_is_sent_once(self):
+        self.enqueue()
+        jobs = self.mail_queue.due_jobs()
+
+        other_queue = MailQueue(self.mailer)
+        self.assertEqual(other_queue.process_pending(), 1)
+        other_queue.stop()
+
+        for job in jobs:
+            self.mail_queue.process(job)
+        self.assertEqual(len(self.server.messages), 1)
+
+    def test_stale_claims_are_released(self):
+        stale, taken = self.enqueue(2)
+        EmailJob.update(status=EmailJob.SENDING, next_attempt_at=0).where(
+            EmailJob.job_id == stale.job_id).execute()
+        self.assertTrue(self.mail_queue.claim(taken))
+
+        self.assertEqual(self.mail_queue.release_stale(), 1)
+        self.assertEqual(self.mail_queue.due_jobs(), [stale])
+        self.assertEqual(
+            EmailJob.get_by_id(taken.job_id).status, EmailJob.SENDING)
+
+    def test_jobs_share_one_authenticated_connection(self):
+        self.enqueue(3)
+        self.assertEqual(self.mail_queue.process_pending(), 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 3)
+
+        self.enqueue()
+        self.mail_queue.process_pending()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_idle_connections_are_kept_alive_with_noop(self):
+        self.enqueue()
+        self.mail_queue.process_pending()
+
+        self.mail_queue.pool.keepalive = 0
+        self.mail_queue.pool.ping()
+        self.assertEqual(self.server.noops, 1)
+
+    def test_dropped_connection_is_reopened(self):
+        self.enqueue()
+        self.mail_queue.process_pending()
+        (server, _), = self.mail_queue.pool.idle
+        server.sock.shutdown(socket.SHUT_RDWR)
+
+        self.mail_queue.pool.keepalive = 0
+        self.enqueue()
+        self.mail_queue.process_pending()
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_failed_job_is_retried_with_backoff(self):
+        self.server.failures = 1
+        job, = self.enqueue()
+
+        self.mail_queue.process_pending()
+        job = EmailJob.get_by_id(job.job_id)
+        self.assertEqual(job.status, EmailJob.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.next_attempt_at, time.time() + 30)
+        self.notify.assert_not_called()
+
+        self.assertEqual(self.mail_queue.process_pending(), 0)
+
+        job.next_attempt_at = 0
+        job.save()
+        self.mail_queue.process_pending()
+        job = EmailJob.get_by_id(job.job_id)
+        self.assertEqual(job.status, EmailJob.SENT)
+        self.notify.assert_called_once_with(job)
+
+    def test_job_fails_after_max_attempts(self):
+        self.server.failures = 2
+        job, = self.enqueue()
+
+        for _ in range(2):
+            EmailJob.update(next_attempt_at=0).execute()
+            self.mail_queue.process_pending()
+
+        job = EmailJob.get_by_id(job.job_id)
+        self.assertEqual(job.status, EmailJob.FAILED)
+        self.assertIsNotNone(job.error)
+        self.notify.assert_called_once_with(job)
+
+    def test_bundle_is_packed_into_as_few_messages_as_fit(self):
+        items = [(self.book, self.ebook)]
+        for number in range(2):
+            ebook_path = path.join(self.directory, "{}.epub".format(number))
+            with open(ebook_path, "wb") as fd:
+                fd.write(b"ebook contents")
+            book = Book.create(**fake_book())
+            items.append((book, Ebook.create(
+                book=book,
+                format="epub",
+                file=File.create(local_path=ebook_path))))
+
+        with patch("tamizdat.email.MESSAGE_SIZE_LIMIT", 9000):
+            first, second = self.mail_queue.enqueue_bundle(items, self.user)
+        self.assertEqual(first.attachments(), items[:2])
+        self.assertEqual(second.attachments(), items[2:])
+
+        self.assertEqual(self.mail_queue.process_pending(), 2)
+        message = email.message_from_bytes(self.server.messages[0])
+        self.assertEqual(
+            [part.get_filename() for part in message.get_payload()],
+            ["book.epub", "0.epub"])
@@ -1,11 +1,16 @@
 import logging
 import random
+import tempfile
+from os import path
 from unittest import TestCase
+from unittest.mock import patch
 
-from tamizdat.index import Index
+from tamizdat.index import Index, TimeLimitExceeded
 from tamizdat.models import (
     make_database,
-    Author, Book, BookAuthors, CardIndex, Card)
+    Author, AuthorListing, Book, BookAuthors, BookIndex, BookInfo, Card,
+    DecadeFacet, Ebook, File, LanguageFacet, Series, SeriesListing,
+    TelegramFile)
 
 from .fixtures import (
     CATALOG_BROKEN_HEADER, CATALOG_PROPER_HEADER,
@@ -89,23 +94,23 @@ class IndexTestCase(TestCase):
         self.catalog._import_cards(catalog)
         self.catalog._prepare_authors()
         self.catalog._prepare_books()
-        self.catalog._prepare_card_index()
+        self.catalog._prepare_book_index()
 
         self.assertEqual(Book.select().count(), 10)
         self.assertEqual(Author.select().count(), 10)
         self.assertEqual(BookAuthors.select().count(), 10)
-        self.assertEqual(CardIndex.select().count(), 10)
+        self.assertEqual(BookIndex.select().count(), 10)
 
     def test_preparing_index_from_imported_cards_with_author_duplicates(self):
         catalog = fake_catalog_with_author_duplicates(CATALOG_PROPER_HEADER, 10)
         self.catalog._import_cards(catalog)
         self.catalog._prepare_authors()
         self.catalog._prepare_books()
-        self.catalog._prepare_card_index()
+        self.catalog._prepare_book_index()
         self.assertLess(Book.select().count(), 10)
         self.assertLess(Author.select().count(), 10)
         self.assertEqual(BookAuthors.select().count(), 10)
-        self.assertEqual(CardIndex.select().count(), 10)
+        self.assertEqual(BookIndex.select().count(), Book.select().count())
 
     def test_simple_search(self):
         cards = fake_cards(10)
@@ -144,3 +149,280 @@ class IndexTestCase(TestCase):
         search_results = self.catalog.get(random_id)
         self.assertIsInstance(search_results, Book)
         self.assertEqual(search_results.book_id, random_id)
+
+    def test_search_loads_the_authors_of_the_page(self):
+        cards = fake_cards_with_author_duplicates(10)
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+        books = self.catalog.search(random.choice(cards)["title"])
+
+        with patch.object(
+            self.database, "execute_sql", wraps=self.database.execute_sql
+        ) as execute_sql:
+            authors = [book.author_list for book in books]
+        execute_sql.assert_not_called()
+        self.assertEqual(len(authors[0]), 2)
+
+    def test_get_loads_the_book_with_its_authors_and_files(self):
+        cards = fake_cards(10)
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+        book_id = random.choice(cards)["book_id"]
+        BookInfo.create(
+            book=book_id,
+            annotation="Annotation",
+            cover_image=File.create(remote_url="cover.jpg"))
+        Ebook.create(book=book_id, format="epub", file=File.create())
+
+        with patch.object(
+            self.database, "execute_sql", wraps=self.database.execute_sql
+        ) as execute_sql:
+            book = self.catalog.get(book_id)
+            self.assertEqual(execute_sql.call_count, 2)
+
+            self.assertEqual(len(book.author_list), 1)
+            self.assertEqual(book.annotation, "Annotation")
+            self.assertEqual(book.cover_image.remote_url, "cover.jpg")
+            self.assertEqual(book.get_ebook().format, "epub")
+            self.assertIsNotNone(book.get_ebook().file.file_id)
+            self.assertEqual(execute_sql.call_count, 2)
+
+            self.assertIs(self.catalog.get(book_id), book)
+            self.assertEqual(execute_sql.call_count, 2)
+
+    def test_get_caches_missing_info(self):
+        cards = fake_cards(10)
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+        book = self.catalog.get(random.choice(cards)["book_id"])
+
+        with patch.object(
+            self.database, "execute_sql", wraps=self.database.execute_sql
+        ) as execute_sql:
+            self.assertFalse(book.augmented)
+            self.assertIsNone(book.get_ebook())
+        execute_sql.assert_not_called()
+
+    def test_saving_drops_the_book_from_cache(self):
+        cards = fake_cards(10)
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+        book_id = random.choice(cards)["book_id"]
+
+        book = self.catalog.get(book_id)
+        BookInfo.create(book=book_id, annotation="Annotation")
+        book = self.catalog.get(book_id)
+        self.assertEqual(book.annotation, "Annotation")
+
+        ebook_file = File.create()
+        Ebook.create(book=book_id, format="epub", file=ebook_file)
+        book = self.catalog.get(book_id)
+        self.assertIsNone(book.get_ebook().file.local_path)
+
+        ebook_file.local_path = "{}.epub".format(book_id)
+        ebook_file.save()
+        book = self.catalog.get(book_id)
+        self.assertEqual(
+            book.get_ebook().file.local_path, "{}.epub".format(book_id))
+
+    def test_search_filters_by_language_and_years(self):
+        cards = fake_cards(10)
+        for number, card in enumerate(cards):
+            card["title"] = "Пикник на обочине"
+            card["languge"] = "RU" if number < 6 else "EN"
+            card["year"] = 1970 + number
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+
+        def found(*args, **kwargs):
+            return sorted(
+                book.year
+                for book in self.catalog.search(*args, **kwargs))
+
+        self.assertEqual(len(found("Пикник")), 10)
+        self.assertEqual(found("Пикник", language="en"), [1976, 1977, 1978, 1979])
+        self.assertEqual(
+            found("Пикник", language="ru", years=(1972, 1973)), [1972, 1973])
+        self.assertEqual(found("Пикник", years=(1978, None)), [1978, 1979])
+        self.assertEqual(found("", language="en", years=(None, 1976)), [1976])
+        self.assertEqual(found(""), [])
+
+    def test_search_filters_by_series(self):
+        cards = fake_cards(10)
+        cards[0]["series"] = "Мир Полудня"
+        cards[1]["title"] = "Мир Полудня"
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+
+        books = self.catalog.search("", series="мир полудня")
+        self.assertEqual(len(books), 1)
+        self.assertEqual(books[0].book_id, cards[0]["book_id"])
+
+    def test_prefix_search_matches_the_beginnings_of_words(self):
+        cards = fake_cards(10)
+        cards[0]["title"] = "Пикник на обочине"
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+
+        self.assertEqual(self.catalog.search("пикн обоч"), [])
+        books = self.catalog.search("пикн обоч", prefix=True)
+        self.assertEqual(
+            [book.book_id for book in books], [cards[0]["book_id"]])
+
+    def test_time_limit_interrupts_queries(self):
+        with self.assertRaises(TimeLimitExceeded):
+            with self.catalog.time_limit(0):
+                self.database.execute_sql(
+                    "WITH RECURSIVE n(i) AS "
+                    "(SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+                    "SELECT MAX(i) FROM (SELECT i FROM n LIMIT 10000000)")
+
+        # The handler is gone after the block.
+        self.database.execute_sql("SELECT 1")
+
+    def test_uploaded_ebooks_in_the_preferred_format(self):
+        cards = fake_cards(3)
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+        books = list(Book.select().order_by(Book.book_id))
+
+        for book, formats in zip(books, (("epub", "mobi"), ("fb2",), ())):
+            for format_ in formats:
+                file_ = File.create()
+                Ebook.create(book=book.book_id, format=format_, file=file_)
+                TelegramFile.create(
+                    file=file_, bot_id=1,
+                    telegram_id="{}.{}".format(book.book_id, format_))
+        TelegramFile.create(file=File.create(), bot_id=2, telegram_id="other")
+
+        uploads = self.catalog.uploaded_ebooks(
+            books, bot_id=1, formats=("mobi", "epub"))
+        self.assertEqual(
+            uploads, {books[0].book_id: "{}.mobi".format(books[0].book_id)})
+
+    def test_facets_are_counted_at_import(self):
+        cards = fake_cards(10)
+        for number, card in enumerate(cards):
+            card["languge"] = "ru" if number < 7 else "en"
+            card["year"] = 1985 + number
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+
+        facets = self.catalog.facets()
+        self.assertEqual(facets["language"], [("ru", 7), ("en", 3)])
+        self.assertEqual(facets["decade"], [(1980, 5), (1990, 5)])
+
+        # The counts are read once.
+        LanguageFacet.delete().execute()
+        self.assertEqual(self.catalog.facets(), facets)
+
+    def test_migration_lowers_the_case_of_languages(self):
+        cards = fake_cards(10)
+        for card in cards:
+            card["languge"] = "ru"
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+
+        # The languages as they were left by older versions.
+        Book.update(language="RU").where(Book.id % 2 == 0).execute()
+        self.database.drop_tables([LanguageFacet, DecadeFacet])
+
+        self.assertTrue(self.catalog.migrate())
+        self.assertEqual(self.catalog.facets()["language"], [("ru", 10)])
+        self.assertEqual(len(self.catalog.search("", language="ru")), 10)
+
+    def test_author_books_are_listed_by_year(self):
+        cards = fake_cards_with_author_duplicates(30)
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+        author = Author.select().first()
+
+        self.assertEqual(self.catalog.count_author_books(author.author_id), 15)
+        first_page = self.catalog.author_books(author.author_id)
+        second_page = self.catalog.author_books(author.author_id, 2)
+        self.assertEqual(len(first_page), 10)
+        self.assertEqual(len(second_page), 5)
+
+        books = first_page + second_page
+        self.assertEqual(
+            [(book.year, book.title) for book in books],
+            sorted((card["year"], card["title"]) for card in cards[::2]))
+        self.assertEqual(len(books[0].author_list), 2)
+        self.assertEqual(self.catalog.author_books(author.author_id, 3), [])
+
+    def test_series_books_are_listed_by_year(self):
+        cards = fake_cards(10)
+        for number, card in enumerate(cards):
+            if number % 2:
+                card["series"] = "Мир Полудня"
+                card["year"] = 1980 - number
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+
+        book = self.catalog.get(cards[1]["book_id"])
+        series = self.catalog.get_series(book.series_id)
+        self.assertEqual(series.name, "Мир Полудня")
+        self.assertEqual(series.books, 5)
+
+        books = self.catalog.series_books(series.series_id)
+        self.assertEqual(
+            [book.year for book in books], [1971, 1973, 1975, 1977, 1979])
+        self.assertIsNone(self.catalog.get_series(series.series_id + 100))
+
+    def test_search_by_author(self):
+        cards = fake_cards(10)
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+        random_card = random.choice(cards)
+
+        search_result = self.catalog.search("{} {}".format(
+            random_card["last_name"], random_card["title"]))
+        self.assertEqual(len(search_result), 1)
+        self.assertEqual(search_result[0].book_id, random_card["book_id"])
+
+    def test_import_drops_the_cards(self):
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, fake_cards(10)))
+        self.assertFalse(self.database.table_exists(Card._meta.table_name))
+        self.assertFalse(self.catalog.migrate())
+
+    def test_import_sets_page_size(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = make_database(path.join(directory, "catalog.sqlite3"))
+            index = Index(database)
+            index.import_catalog(
+                store_catalog(CATALOG_PROPER_HEADER, fake_cards(10)),
+                page_size=16384)
+
+            self.assertEqual(database.page_size, 16384)
+            self.assertEqual(database.journal_mode, "wal")
+            database.close()
+
+    def test_migrating_card_index(self):
+        cards = fake_cards(10)
+        self.catalog.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, cards))
+
+        # The cards and their index as they were left by older versions.
+        self.database.create_tables([Card])
+        for card in cards:
+            Card.create(**card)
+        self.database.drop_tables([
+            BookIndex, LanguageFacet, DecadeFacet,
+            Series, AuthorListing, SeriesListing])
+        self.database.execute_sql(
+            "CREATE VIRTUAL TABLE cardindex USING fts5 ("
+            "last_name, first_name, middle_name, title, subtitle, series)")
+
+        self.assertTrue(self.catalog.migrate())
+        self.assertFalse(self.catalog.migrate())
+        self.assertFalse(self.database.table_exists("cardindex"))
+        self.assertEqual(
+            sum(books for _, books in self.catalog.facets()["language"]), 10)
+        self.assertEqual(AuthorListing.select().count(), 10)
+        self.assertFalse(self.database.table_exists(Card._meta.table_name))
+
+        random_card = random.choice(cards)
+        search_result = self.catalog.search(random_card["title"])
+        self.assertEqual(len(search_result), 1)
+        self.assertEqual(search_result[0].title, random_card["title"])
@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+from unittest import TestCase
+
+from tamizdat.inline import Debouncer, PrefixCache, matches, words
+
+
+def fake_book(title, last_name="Стругацкий", series=None):
+    author = SimpleNamespace(
+        last_name=last_name, first_name="Аркадий", middle_name=None)
+    return SimpleNamespace(
+        title=title, subtitle=None, series=series, author_list=[author])
+
+
+class WordsTestCase(TestCase):
+    def test_only_latin_diacritics_are_stripped(self):
+        self.assertEqual(words("Café «Бойня» №5"), ["cafe", "бойня", "5"])
+
+    def test_every_word_has_to_start_a_word_of_the_book(self):
+        book = fake_book("Пикник на обочине", series="Мир Полудня")
+        self.assertTrue(matches(book, ["пикн", "струг"]))
+        self.assertTrue(matches(book, ["полуд"]))
+        self.assertFalse(matches(book, ["никн"]))
+        self.assertFalse(matches(book, ["пикник", "жук"]))
+
+
+class DebouncerTestCase(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.slept = []
+        self.debouncer = Debouncer(
+            delay=0.3, clock=lambda: self.now, sleep=self.slept.append)
+
+    def test_superseded_queries_are_dropped(self):
+        first = self.debouncer.arrive(1, "a")
+        self.now = 0.1
+        second = self.debouncer.arrive(1, "b")
+        other = self.debouncer.arrive(2, "c")
+
+        self.assertFalse(self.debouncer.settle(1, "a", first))
+        self.assertTrue(self.debouncer.settle(1, "b", second))
+        self.assertTrue(self.debouncer.settle(2, "c", other))
+        self.assertEqual(self.debouncer.latest, {})
+
+    def test_settling_waits_for_the_rest_of_the_delay(self):
+        deadline = self.debouncer.arrive(1, "a")
+        self.now = 0.2
+        self.debouncer.settle(1, "a", deadline)
+        self.now = 1
+        self.debouncer.settle(1, "a", deadline)
+        self.assertAlmostEqual(self.slept[0], 0.1)
+        self.assertEqual(self.slept[1], 0)
+
+
+class PrefixCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = PrefixCache(size=2)
+        self.books = [
+            fake_book("Пикник на обочине"),
+            fake_book("Жук в муравейнике"),
+        ]
+
+    def test_queries_are_cached_by_their_words(self):
+        self.cache.put("Пикник, на", self.books, complete=True)
+        self.assertIs(self.cache.get(" пикник  НА "), self.books)
+        self.assertIsNone(self.cache.get("жук"))
+
+    def test_longer_queries_filter_complete_results(self):
+        self.cache.put("струг", self.books, complete=True)
+        books = self.cache.get("стругацкий жу")
+        self.assertEqual(books, [self.books[1]])
+        self.assertEqual(self.cache.get("стругацкий жу"), [self.books[1]])
+
+    def test_longer_queries_do_not_filter_partial_results(self):
+        self.cache.put("струг", self.books, complete=False)
+        self.assertIsNone(self.cache.get("стругацкий жу"))
+
+    def test_least_recently_used_queries_are_evicted(self):
+        self.cache.put("пикник", self.books, complete=False)
+        self.cache.put("жук", self.books, complete=False)
+        self.cache.get("пикник")
+        self.cache.put("обочина", self.books, complete=False)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get("жук"))
+        self.assertIsNotNone(self.cache.get("пикник"))
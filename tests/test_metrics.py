@@ -0,0 +1,92 @@
+import time
+from unittest import TestCase
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from tamizdat.metrics import (
+    Counter, Gauge, Histogram, Registry,
+    instrument, start_metrics_server,
+    OPERATION_ERRORS, OPERATION_SECONDS, OPERATIONS_IN_FLIGHT)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_is_rendered_per_label(self):
+        counter = Counter(
+            "commands", "Commands", ["command"], registry=self.registry)
+        counter.labels("search").inc()
+        counter.labels("search").inc()
+        counter.labels("info").inc(3)
+
+        text = self.registry.render()
+        self.assertIn("# TYPE commands counter", text)
+        self.assertIn('commands_total{command="search"} 2.0', text)
+        self.assertIn('commands_total{command="info"} 3.0', text)
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("quotes", "Quotes", ["text"], registry=self.registry)
+        counter.labels('say "hi"').inc()
+        self.assertIn('quotes_total{text="say \\"hi\\""} 1.0', self.registry.render())
+
+    def test_gauge_goes_up_and_down(self):
+        gauge = Gauge("in_flight", "In flight", registry=self.registry)
+        gauge.labels().inc()
+        gauge.labels().inc()
+        gauge.labels().dec()
+        self.assertIn("in_flight 1.0", self.registry.render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram(
+            "latency", "Latency", buckets=(0.1, 1.0), registry=self.registry)
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.labels().observe(value)
+
+        text = self.registry.render()
+        self.assertIn('latency_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_bucket{le="1.0"} 3', text)
+        self.assertIn('latency_bucket{le="+Inf"} 4', text)
+        self.assertIn("latency_count 4", text)
+        self.assertIn("latency_sum 6.05", text)
+
+    def test_instrumented_function_is_timed_and_errors_are_counted(self):
+        @instrument("test_operation")
+        def operation(fail):
+            self.assertEqual(
+                OPERATIONS_IN_FLIGHT.labels("test_operation").value, 1)
+            if fail:
+                raise RuntimeError()
+
+        operation(fail=False)
+        with self.assertRaises(RuntimeError):
+            operation(fail=True)
+
+        self.assertEqual(OPERATIONS_IN_FLIGHT.labels("test_operation").value, 0)
+        self.assertEqual(OPERATION_ERRORS.labels("test_operation").value, 1)
+        self.assertEqual(sum(OPERATION_SECONDS.labels("test_operation").counts), 2)
+
+    def test_instrumentation_overhead_is_small(self):
+        def operation():
+            pass
+
+        instrumented = instrument("test_overhead")(operation)
+
+        started = time.perf_counter()
+        for _ in range(10000):
+            instrumented()
+        overhead = (time.perf_counter() - started) / 10000
+        self.assertLess(overhead, 1e-4)
+
+    def test_metrics_are_served_over_http(self):
+        Counter("served", "Served", registry=self.registry).labels().inc()
+        server = start_metrics_server(0, registry=self.registry)
+        _, port = server.server_address
+        try:
+            with urlopen("http://127.0.0.1:{}/metrics".format(port)) as response:
+                self.assertIn(b"served_total 1.0", response.read())
+            with self.assertRaises(HTTPError):
+                urlopen("http://127.0.0.1:{}/other".format(port))
+        finally:
+            server.shutdown()
+            server.server_close()
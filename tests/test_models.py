@@ -1,10 +1,21 @@
+import sqlite3
+import tempfile
+import threading
+from os import path
 from unittest import TestCase
 
-from tamizdat.models import make_database, Author, Book, Card, File, User
+from tamizdat.index import Index
+from peewee import OperationalError
+
+from tamizdat.models import (
+    make_database, open_database, open_split_database,
+    CATALOG_MODELS, KINDLE_FORMATS, READER_FORMATS,
+    Author, Book, BookCache, BookInfo, Card, Ebook, File, User)
 
 from .fixtures import (
-    fake_author, fake_book, fake_card,
-    fake_first_name, fake_last_name)
+    CATALOG_PROPER_HEADER,
+    fake_author, fake_book, fake_card, fake_cards,
+    fake_first_name, fake_last_name, store_catalog)
 
 
 class ModelTestCase(TestCase):
@@ -62,6 +73,8 @@ class ModelTestCase(TestCase):
         self.assertEqual(author2.books[0], book_selected)
 
     def test_create_card(self):
+        # The cards are a staging table of the import.
+        self.database.create_tables([Card])
         card_inserted = Card(**fake_card())
         self.assertEqual(card_inserted.save(), 1)
 
@@ -90,14 +103,19 @@ class ModelTestCase(TestCase):
         file_inserted.save()
 
         file_selected = File.get(File.file_id == file_inserted.file_id)
-        self.assertEqual(file_inserted.remote_url, file_selected.remote_url)
+        self.assertEqual(file_inserted.local_path, file_selected.local_path)
 
-        file_inserted.telegram_id = "telegram_id"
-        self.assertIsNone(file_selected.telegram_id)
-        file_inserted.save()
+    def test_telegram_ids_are_stored_per_bot(self):
+        file_ = File.create()
+        self.assertIsNone(file_.get_telegram_id(1))
 
-        file_selected = File.get(File.file_id == file_inserted.file_id)
-        self.assertEqual(file_inserted.telegram_id, file_selected.telegram_id)
+        file_.set_telegram_id(1, "first")
+        file_.set_telegram_id(2, "second")
+        self.assertEqual(file_.get_telegram_id(1), "first")
+        self.assertEqual(file_.get_telegram_id(2), "second")
+
+        file_.set_telegram_id(1, "updated")
+        self.assertEqual(file_.get_telegram_id(1), "updated")
 
     def test_create_user(self):
         user_inserted = User(
@@ -109,3 +127,212 @@ class ModelTestCase(TestCase):
 
         user_selected = User.get(User.username == user_inserted.username)
         self.assertEqual(user_inserted, user_selected)
+
+    def test_book_picks_ebook_in_order_of_preference(self):
+        book = Book(**fake_book())
+        book.save()
+        self.assertIsNone(book.get_ebook())
+
+        for format_ in ("fb2", "mobi"):
+            Ebook.create(book=book, format=format_, file=File.create())
+
+        self.assertEqual(book.get_ebook(READER_FORMATS).format, "fb2")
+        self.assertEqual(book.get_ebook(KINDLE_FORMATS).format, "mobi")
+
+        Ebook.create(book=book, format="epub", file=File.create())
+        self.assertEqual(book.get_ebook(READER_FORMATS).format, "epub")
+        self.assertEqual(book.get_ebook(KINDLE_FORMATS).format, "mobi")
+
+    def test_user_with_kindle_address_prefers_kindle_formats(self):
+        user = User(user_id=102030, email="reader@example.com")
+        self.assertFalse(user.is_kindle)
+        self.assertEqual(user.preferred_formats, READER_FORMATS)
+
+        user.email = "reader@Kindle.com"
+        self.assertTrue(user.is_kindle)
+        self.assertEqual(user.preferred_formats, KINDLE_FORMATS)
+
+
+class BookInfoTestCase(TestCase):
+    def setUp(self):
+        self.database = make_database()
+        self.book = Book.create(**fake_book())
+
+    def test_book_without_info_is_not_augmented(self):
+        self.assertIsNone(self.book.info)
+        self.assertFalse(self.book.augmented)
+        self.assertIsNone(self.book.annotation)
+        self.assertIsNone(self.book.cover_image)
+
+    def test_book_info_is_looked_up_once(self):
+        cover = File.create(remote_url="http://example.com/cover.jpg")
+        BookInfo.create(
+            book=self.book.book_id, annotation="Annotation", cover_image=cover)
+
+        book = Book.get(Book.book_id == self.book.book_id)
+        self.assertTrue(book.augmented)
+        self.assertEqual(book.annotation, "Annotation")
+        self.assertEqual(book.cover_image, cover)
+
+        BookInfo.delete().execute()
+        self.assertTrue(book.augmented)
+
+
+class BookCacheTestCase(TestCase):
+    def setUp(self):
+        self.database = make_database()
+        self.cache = BookCache(size=2)
+        self.books = [Book.create(**fake_book()) for _ in range(3)]
+
+    def test_least_recently_used_book_is_evicted(self):
+        first, second, third = self.books
+        self.cache.put(first)
+        self.cache.put(second)
+        self.assertIs(self.cache.get(first.book_id), first)
+
+        self.cache.put(third)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIs(self.cache.get(first.book_id), first)
+        self.assertIsNone(self.cache.get(second.book_id))
+
+    def test_books_are_discarded_by_their_files(self):
+        first, second, _ = self.books
+        cover_image = File.create()
+        BookInfo.create(book=first.book_id, cover_image=cover_image)
+        self.cache.put(first)
+        self.cache.put(second)
+
+        self.cache.discard_file(cover_image.file_id)
+        self.assertIsNone(self.cache.get(first.book_id))
+        self.assertIs(self.cache.get(second.book_id), second)
+
+
+class OpenDatabaseTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.address = path.join(self.directory.name, "index.sqlite3")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_opening_missing_database_creates_it(self):
+        database = open_database(self.address)
+        self.assertIn("user", database.get_tables())
+        database.close()
+
+    def test_opening_existing_database_skips_table_creation(self):
+        sqlite3.connect(self.address).close()
+        database = open_database(self.address)
+        self.assertEqual(database.get_tables(), [])
+        database.close()
+
+
+class ConcurrencyTestCase(TestCase):
+    WAIT_SECONDS = 10
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.address = path.join(self.directory.name, "index.sqlite3")
+        self.database = make_database(self.address)
+
+        self.cards = fake_cards(100)
+        self.index = Index(self.database)
+        self.index.import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, self.cards))
+
+    def tearDown(self):
+        self.database.close()
+        self.directory.cleanup()
+
+    def test_database_is_in_wal_mode(self):
+        mode, = self.database.execute_sql("PRAGMA journal_mode").fetchone()
+        self.assertEqual(mode, "wal")
+
+    def test_searches_do_not_stall_during_writes(self):
+        locked = threading.Event()
+        searched = threading.Event()
+        results = []
+
+        def write():
+            # Holds the write lock until the searches are done. Searches
+            # that waited for it would time out instead.
+            with self.database.atomic("EXCLUSIVE"):
+                User.create(user_id=1)
+                locked.set()
+                searched.wait(self.WAIT_SECONDS)
+            self.database.close()
+
+        def search():
+            for card in self.cards[:40]:
+                results.append(bool(self.index.search(card["title"])))
+            self.database.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.assertTrue(locked.wait(self.WAIT_SECONDS))
+
+        readers = [threading.Thread(target=search) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+
+        # The write transaction is still open.
+        self.assertTrue(writer.is_alive())
+        searched.set()
+        writer.join()
+
+        self.assertEqual(results, [True] * 160)
+        self.assertEqual(User.select().count(), 1)
+
+
+class SplitDatabaseTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.catalog_address = path.join(self.directory.name, "catalog.sqlite3")
+        self.state_address = path.join(self.directory.name, "state.sqlite3")
+
+        catalog = make_database(self.catalog_address, models=CATALOG_MODELS)
+        self.cards = fake_cards(10)
+        Index(catalog).import_catalog(
+            store_catalog(CATALOG_PROPER_HEADER, self.cards))
+        catalog.close()
+
+        self.database = open_split_database(
+            self.catalog_address, self.state_address)
+        self.index = Index(self.database)
+
+    def tearDown(self):
+        self.database.close()
+        self.directory.cleanup()
+
+    def test_catalog_is_searched_and_state_is_written(self):
+        card = self.cards[0]
+        book, = self.index.search(card["title"])
+        self.assertEqual(book.title, card["title"])
+
+        BookInfo.create(book=book.book_id, annotation="Annotation")
+        User.create(user_id=1)
+        book = self.index.get(card["book_id"])
+        self.assertEqual(book.annotation, "Annotation")
+        self.assertEqual(User.select().count(), 1)
+
+    def test_catalog_is_read_only(self):
+        book = self.index.get(self.cards[0]["book_id"])
+        book.title = "Changed"
+        with self.assertRaises(OperationalError):
+            book.save()
+
+    def test_catalog_tables_are_not_in_the_state_database(self):
+        tables = {
+            name for name, in sqlite3.connect(self.state_address).execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+        self.assertIn("user", tables)
+        self.assertNotIn("book", tables)
+
+    def test_missing_catalog_is_an_error(self):
+        with self.assertRaises(FileNotFoundError):
+            open_split_database(
+                path.join(self.directory.name, "missing.sqlite3"),
+                self.state_address)
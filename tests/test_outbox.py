@@ -0,0 +1,102 @@
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import Mock
+
+from telegram.error import RetryAfter
+
+from tamizdat.outbox import Outbox
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.slept = []
+        self.outbox = Outbox(
+            rate=2,
+            chat_rate=1,
+            clock=lambda: self.now,
+            sleep=self.sleep)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def take(self):
+        chat_id, (serve, _, _) = self.outbox._take()
+        self.outbox._done(chat_id)
+        return serve
+
+    def test_chats_take_turns_within_their_limits(self):
+        self.outbox.put(1, "first", None, None)
+        self.outbox.put(1, "second", None, None)
+        self.outbox.put(2, "other", None, None)
+
+        self.assertEqual(self.take(), "first")
+        self.assertEqual(self.take(), "other")
+        self.assertEqual(self.outbox.queue_depth(), 1)
+
+        self.now = 1
+        self.assertEqual(self.take(), "second")
+
+    def test_chats_are_served_one_response_at_a_time(self):
+        self.outbox.put(1, "first", None, None)
+        self.outbox.put(1, "second", None, None)
+        self.outbox.put(2, "other", None, None)
+        self.now = 10
+
+        chat_id, _ = self.outbox._take()
+        self.assertEqual(chat_id, 1)
+        self.now = 20
+        chat_id, _ = self.outbox._take()
+        self.assertEqual(chat_id, 2)
+
+    def test_calls_share_the_global_budget(self):
+        function = Mock()
+        for _ in range(4):
+            self.outbox.call(function)
+        self.assertEqual(function.call_count, 4)
+        self.assertEqual(self.now, 1)
+
+    def test_flood_control_pauses_and_retries(self):
+        function = Mock(side_effect=[RetryAfter(3), RetryAfter(3), "sent"])
+        document = BytesIO(b"book")
+        document.read()
+
+        self.assertEqual(self.outbox.call(function, document), "sent")
+        self.assertEqual(self.slept, [3, 6])
+        self.assertEqual(document.read(), b"book")
+
+    def test_flood_control_gives_up_eventually(self):
+        self.outbox.max_attempts = 2
+        function = Mock(side_effect=RetryAfter(1))
+        with self.assertRaises(RetryAfter):
+            self.outbox.call(function)
+        self.assertEqual(function.call_count, 2)
+
+    def test_responses_are_served_through_the_outbox(self):
+        message = Mock()
+        message.chat.id = 1
+        self.outbox.serve(
+            1, lambda bot, message: message.reply_text("text"), Mock(), message)
+
+        message.reply_text.assert_called_with("text")
+        self.assertEqual(self.outbox.bucket.tokens, 1)
+
+    def test_waiting_responses_are_sent_on_stop(self):
+        outbox = Outbox(rate=1000, chat_rate=1000, chat_burst=10, workers=2)
+        served = []
+        outbox.start()
+        for chat_id in range(3):
+            for number in range(3):
+                outbox.put(
+                    chat_id,
+                    lambda bot, message, item=(chat_id, number):
+                        served.append(item),
+                    None, None)
+        outbox.stop()
+
+        self.assertEqual(len(served), 9)
+        for chat_id in range(3):
+            self.assertEqual(
+                [number for chat, number in served if chat == chat_id],
+                [0, 1, 2])
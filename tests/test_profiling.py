@@ -0,0 +1,64 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from tamizdat.profiling import (
+    Profile, SamplingProfiler, directory_size, rss_bytes)
+
+
+def busy_loop(stopped):
+    while not stopped.is_set():
+        sum(range(100))
+
+
+class SamplingProfilerTestCase(TestCase):
+    def test_dispatcher_threads_are_sampled(self):
+        stopped = threading.Event()
+        worker = threading.Thread(
+            target=busy_loop, args=(stopped, ), name="Bot:1:worker:0")
+        other = threading.Thread(
+            target=stopped.wait, name="Thread-other")
+        worker.start()
+        other.start()
+        try:
+            profile = SamplingProfiler(interval=0.001).profile(0.2)
+        finally:
+            stopped.set()
+            worker.join()
+            other.join()
+
+        self.assertGreater(profile.samples, 0)
+        self.assertTrue(all(
+            stack[0] == "Bot:1:worker:0" for stack in profile.stacks))
+
+        frames = [frame for frame, _, _ in profile.hotspots()]
+        self.assertTrue(any(frame.startswith("busy_loop (") for frame in frames))
+
+    def test_hotspots_and_collapsed_stacks(self):
+        profile = Profile({
+            ("thread", "main", "search"): 3,
+            ("thread", "main", "render"): 1,
+        }, samples=4, duration=1.0)
+
+        hotspots = profile.hotspots(limit=2)
+        self.assertEqual(hotspots[0], ("main", 1.0, 0.0))
+        self.assertEqual(hotspots[1], ("search", 0.75, 0.75))
+        self.assertEqual(
+            profile.collapsed(),
+            "thread;main;render 1\nthread;main;search 3\n")
+
+
+class ResourcesTestCase(TestCase):
+    def test_rss_is_reported(self):
+        self.assertGreater(rss_bytes(), 0)
+
+    def test_directory_size(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, size in (("a", 10), ("b", 20)):
+                with open(os.path.join(directory, name), "wb") as fd:
+                    fd.write(b"x" * size)
+            os.mkdir(os.path.join(directory, "nested"))
+
+            self.assertEqual(directory_size(directory), (2, 30))
+        self.assertEqual(directory_size(directory), (0, 0))
@@ -0,0 +1,99 @@
+import json
+import tempfile
+from os import path
+from unittest import TestCase
+
+from tamizdat.ratelimit import (
+    ConcurrencyLimit, RateLimiter, RateLimits, TokenBucket)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTestCase(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_burst_is_allowed_and_then_refilled(self):
+        bucket = TokenBucket(rate=0.5, burst=2, clock=self.clock)
+        self.assertTrue(bucket.take())
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+        self.assertEqual(bucket.retry_after(), 2)
+
+        self.clock.now += 2
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_tokens_do_not_exceed_burst(self):
+        bucket = TokenBucket(rate=1, burst=2, clock=self.clock)
+        self.clock.now += 100
+        self.assertTrue(bucket.take())
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_every_key_has_its_own_budget(self):
+        limiter = RateLimiter(rate=1, burst=1, clock=self.clock)
+        self.assertTrue(limiter.allow(1))
+        self.assertFalse(limiter.allow(1))
+        self.assertTrue(limiter.allow(2))
+
+    def test_global_budget_is_shared(self):
+        limiter = RateLimiter(
+            rate=1, burst=5, global_rate=1, global_burst=2, clock=self.clock)
+        self.assertTrue(limiter.allow(1))
+        self.assertTrue(limiter.allow(2))
+        self.assertFalse(limiter.allow(3))
+        self.assertEqual(limiter.retry_after(3), 1)
+
+        # A key rejected by the global bucket keeps its own tokens.
+        self.assertEqual(limiter.buckets[3].tokens, 5)
+
+    def test_state_is_restored(self):
+        limiter = RateLimiter(rate=1, burst=2, clock=self.clock)
+        limiter.allow(1)
+        limiter.allow(1)
+        limiter.allow(2)
+
+        restored = RateLimiter(rate=1, burst=2, clock=self.clock)
+        restored.restore(json.loads(json.dumps(limiter.state())))
+        self.assertFalse(restored.allow(1))
+        self.assertTrue(restored.allow(2))
+        self.assertFalse(restored.allow(2))
+
+    def test_rate_limits_are_saved_and_loaded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = path.join(directory, "limits.json")
+            limits = RateLimits(
+                download=RateLimiter(rate=1, burst=1, clock=self.clock),
+                path=filename)
+            limits.load()
+            limits.download.allow(1)
+            limits.save()
+
+            restored = RateLimits(
+                download=RateLimiter(rate=1, burst=1, clock=self.clock),
+                path=filename)
+            restored.load()
+            self.assertFalse(restored.download.allow(1))
+
+
+class ConcurrencyLimitTestCase(TestCase):
+    def test_slots_are_not_waited_for(self):
+        limit = ConcurrencyLimit(1)
+        with limit.slot() as first:
+            with limit.slot() as second:
+                self.assertTrue(first)
+                self.assertFalse(second)
+        with limit.slot() as third:
+            self.assertTrue(third)
@@ -1,15 +1,27 @@
+import tempfile
+import zipfile
+from types import SimpleNamespace
 from unittest import TestCase
 from unittest.mock import patch, Mock
 
 from faker import Faker
+from jinja2 import Environment, PackageLoader
 from telegram.parsemode import ParseMode
 
 from tamizdat.models import (
     make_database,
-    Author, Book, User)
+    Author, Book, BookInfo, Ebook, File, Series, User)
 from tamizdat.response import (
+    AuthorBooksResponse,
+    BookInfoResponse,
+    BundleResponse,
+    InlineSearchResponse,
+    SeriesBooksResponse,
+    environment,
     NewUserAdminNotification, SettingsResponse,
-    SettingsEmailSetResponse, SearchResponse)
+    SettingsEmailSetResponse, SearchResponse, DownloadResponse,
+    ProfileResponse, StatsResponse)
+from tamizdat.profiling import Profile
 
 
 fake = Faker()
@@ -117,3 +129,276 @@ class SearchResponseTestCase(ResponseTestCase):
             self.assertIn(book.authors[0].last_name, text)
             self.assertIn(str(book.year), text)
             self.assertIn(book.series, text)
+
+    def test_search_filters_are_suggested(self):
+        facets = {"language": [("ru", 120), ("en", 30)], "decade": [(1990, 42)]}
+        text = str(SearchResponse(self.books, facets))
+        self.assertIn("`lang:ru` (120)", text)
+        self.assertIn("`lang:en` (30)", text)
+        self.assertIn("`year:1990..1999` (42)", text)
+        self.assertNotIn("lang:", str(self.response))
+
+
+class InlineSearchResponseTestCase(ResponseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.books = []
+        for book_id in range(3):
+            book = Book(
+                book_id=book_id,
+                title=fake.sentence(),
+                year=fake.random.randint(1990, 2020),
+                language="ru")
+            book._authors = [Author(
+                first_name=fake.first_name(), last_name=fake.last_name())]
+            self.books.append(book)
+
+    def test_uploaded_books_are_sent_as_documents(self):
+        uploaded, *others = self.books
+        query = Mock()
+        InlineSearchResponse(
+            self.books, {uploaded.book_id: "file_id"}).serve(self.bot, query)
+
+        (results, ), kwargs = query.answer.call_args
+        self.assertTrue(kwargs["is_personal"])
+        self.assertEqual(results[0].document_file_id, "file_id")
+        for book, result in zip(others, results[1:]):
+            self.assertEqual(result.type, "article")
+            self.assertEqual(result.id, str(book.book_id))
+            self.assertIn(book.author_list[0].last_name, result.description)
+            self.assertIn(str(book.year), result.description)
+            self.assertIn(
+                book.title, result.input_message_content.message_text)
+
+
+class DownloadResponseTestCase(ResponseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ebook_file = tempfile.NamedTemporaryFile(suffix=".epub")
+        self.book = Book.create(book_id=1, title=fake.sentence())
+        self.ebook = Ebook.create(
+            book=self.book,
+            format="epub",
+            file=File.create(local_path=self.ebook_file.name))
+        self.response = DownloadResponse(self.book, self.ebook)
+
+        self.bot.id = 1
+        self.message.reply_document.return_value.document.file_id = "file_id"
+
+    def tearDown(self):
+        self.ebook_file.close()
+
+    def test_document_is_uploaded_once_per_bot(self):
+        self.response.serve(self.bot, self.message)
+        args, kwargs = self.message.reply_document.call_args
+        self.assertTrue(kwargs["filename"].endswith(".epub"))
+
+        self.response.serve(self.bot, self.message)
+        self.message.reply_document.assert_called_with("file_id")
+
+        other_bot = Mock(id=2)
+        self.response.serve(other_bot, self.message)
+        args, kwargs = self.message.reply_document.call_args
+        self.assertIn("document", kwargs)
+
+
+class BundleResponseTestCase(ResponseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.items = []
+        for book_id in (1, 2, 3):
+            local_path = "{}/{}.epub".format(self.directory.name, book_id)
+            with open(local_path, "wb") as fd:
+                fd.write(b"x" * 100)
+            book = Book.create(
+                book_id=book_id, title="Том {}".format(book_id),
+                series="Полдень")
+            self.items.append((book, Ebook.create(
+                book=book,
+                format="epub",
+                file=File.create(local_path=local_path))))
+        self.archives = []
+        self.message.reply_document.side_effect = self.reply_document
+
+    def reply_document(self, document, filename, timeout):
+        with zipfile.ZipFile(document) as archive:
+            self.archives.append((filename, archive.namelist()))
+
+    def test_books_are_sent_as_one_archive(self):
+        BundleResponse(self.items).serve(self.bot, self.message)
+        self.assertEqual(self.archives, [
+            ("Polden'.zip", ["Tom 1.epub", "Tom 2.epub", "Tom 3.epub"])])
+
+    def test_archive_is_split_into_parts_telegram_takes(self):
+        BundleResponse(self.items, limit=250).serve(self.bot, self.message)
+        self.assertEqual(self.archives, [
+            ("Polden' (1-2).zip", ["Tom 1.epub", "Tom 2.epub"]),
+            ("Polden' (2-2).zip", ["Tom 3.epub"])])
+
+
+class BookInfoResponseTestCase(ResponseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cover_file = tempfile.NamedTemporaryFile(suffix=".jpg")
+        self.book = Book.create(book_id=1, title=fake.sentence(), language="ru")
+        self.cover = File.create(
+            remote_url="http://example.com/1.jpg",
+            local_path=self.cover_file.name)
+        BookInfo.create(book=self.book, cover_image=self.cover)
+        self.book = Book.get(Book.book_id == 1)
+        self.response = BookInfoResponse(self.book)
+
+        self.bot.id = 1
+        photo = Mock(file_id="photo_id")
+        self.message.reply_photo.return_value.photo = [Mock(), photo]
+
+    def tearDown(self):
+        self.cover_file.close()
+
+    def test_cover_is_uploaded_once_per_bot(self):
+        self.response.serve(self.bot, self.message)
+        (photo, ), _ = self.message.reply_photo.call_args
+        self.assertEqual(photo.name, self.cover_file.name)
+
+        self.response.serve(self.bot, self.message)
+        self.message.reply_photo.assert_called_with("photo_id")
+
+    def test_cover_that_is_not_on_disk_is_sent_by_url(self):
+        self.cover.local_path = None
+        self.cover.save()
+        self.response.serve(self.bot, self.message)
+        self.message.reply_photo.assert_called_with("http://example.com/1.jpg")
+
+
+class ListingResponseTestCase(ResponseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.author = Author.create(
+            first_name=fake.first_name(), last_name=fake.last_name())
+        self.books = [
+            Book.create(
+                book_id=book_id, title=fake.sentence(), language="ru")
+            for book_id in range(1, 4)
+        ]
+
+    def buttons(self):
+        _, kwargs = self.message.reply_text.call_args
+        markup = kwargs["reply_markup"]
+        if markup is None:
+            return []
+        return [
+            button.callback_data
+            for row in markup.inline_keyboard
+            for button in row
+        ]
+
+    def test_author_page_links_to_neighbouring_pages(self):
+        response = AuthorBooksResponse(self.author, self.books, 2, 3)
+        text = str(response)
+        self.assertIn(self.author.last_name, text)
+        self.assertIn("Страница 2 из 3", text)
+        self.assertIn("/info1", text)
+
+        response.serve(self.bot, self.message)
+        self.assertEqual(self.buttons(), [
+            "/author {} 1".format(self.author.author_id),
+            "/author {} 3".format(self.author.author_id)])
+
+    def test_single_page_series_is_sent_whole(self):
+        series = Series.create(name="Мир Полудня", books=3)
+        response = SeriesBooksResponse(series, self.books, 1, 1)
+        self.assertIn("Мир Полудня", str(response))
+        self.assertNotIn("Страница", str(response))
+
+        response.serve(self.bot, self.message)
+        self.assertEqual(self.buttons(), [
+            "/download series {}".format(series.series_id),
+            "/email series {}".format(series.series_id)])
+
+
+class AdminResponseTestCase(ResponseTestCase):
+    def test_profile_is_sent_with_stack_dump(self):
+        profile = Profile(
+            {("Bot:1:dispatcher", "run (dispatcher.py:1)"): 2},
+            samples=2, duration=1.0)
+
+        ProfileResponse(profile).serve(self.bot, self.message)
+
+        (text, ), _ = self.message.reply_text.call_args
+        self.assertIn("100.0% 100.0% run (dispatcher.py:1)", text)
+        _, kwargs = self.message.reply_document.call_args
+        self.assertEqual(
+            kwargs["document"].read(),
+            b"Bot:1:dispatcher;run (dispatcher.py:1) 2\n")
+        self.assertTrue(kwargs["filename"].endswith(".folded"))
+
+    def test_stats_are_rendered(self):
+        text = str(StatsResponse({
+            "rss": 50 * 1000 ** 2,
+            "database": 2 * 1000 ** 3,
+            "threads": 8,
+            "queues": {"emails": 3},
+            "caches": {"attachments": (10, 2000), "telegram_files": (4, None)},
+        }))
+        self.assertIn("50.0 MB", text)
+        self.assertIn("2.0 GB", text)
+        self.assertIn("`emails`: 3", text)
+        self.assertIn("`attachments`: 10, 2.0 kB", text)
+        self.assertIn("`telegram_files`: 4", text)
+        self.assertNotIn("None", text)
+
+
+class InliningLoaderTestCase(TestCase):
+    def setUp(self):
+        self.plain_environment = Environment(
+            loader=PackageLoader("tamizdat", "templates"),
+            lstrip_blocks=True,
+            trim_blocks=True)
+
+    def fake_book(self, num_authors, language):
+        return SimpleNamespace(
+            book_id=fake.random.randint(100, 1000000),
+            title=fake.sentence(),
+            subtitle=fake.random.choice([None, fake.sentence()]),
+            year=fake.random.choice([None, fake.random.randint(1900, 2020)]),
+            series=fake.random.choice([None, fake.sentence()]),
+            language=language,
+            annotation=fake.random.choice([None, fake.text()]),
+            series_id=fake.random.choice([None, fake.random.randint(1, 1000)]),
+            author_list=[
+                SimpleNamespace(
+                    author_id=fake.random.randint(1, 1000),
+                    first_name=fake.first_name(),
+                    middle_name=fake.random.choice([None, fake.first_name()]),
+                    last_name=fake.last_name())
+                for _ in range(num_authors)
+            ])
+
+    def assertRendersAsPlain(self, template_path, **context):
+        self.assertEqual(
+            environment.get_template(template_path).render(**context),
+            self.plain_environment.get_template(template_path).render(**context))
+
+    def test_inlined_templates_render_as_included_ones(self):
+        books = [
+            self.fake_book(num_authors, language)
+            for num_authors in range(4)
+            for language in ("ru", "en", "eo")
+        ]
+        self.assertRendersAsPlain("search_results.md", books=books)
+        self.assertRendersAsPlain(
+            "author_books.md",
+            author=books[-1].author_list[0],
+            books=books,
+            page_number=2,
+            pages=3)
+        for book in books:
+            self.assertRendersAsPlain("book_info.md", book=book)
+            self.assertRendersAsPlain("authors.md", book=book)
+
+    def test_no_includes_are_left_after_loading(self):
+        source, _, _ = environment.loader.get_source(
+            environment, "search_results.md")
+        self.assertNotIn("include", source)
@@ -0,0 +1,158 @@
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock
+
+import requests
+
+from tamizdat.scheduler import (
+    BACKGROUND, INTERACTIVE,
+    CircuitOpen, DeadlineExceeded, RequestScheduler)
+
+
+URL = "http://flibusta.net/b/1"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class RequestSchedulerTestCase(TestCase):
+    def test_concurrency_is_limited_per_host(self):
+        scheduler = RequestScheduler(max_concurrent=2, min_interval=0)
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def fetch():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        threads = [
+            threading.Thread(target=scheduler.run, args=(URL, fetch))
+            for _ in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(peak), 6)
+        self.assertLessEqual(max(peak), 2)
+
+    def test_requests_are_spaced_by_min_interval(self):
+        scheduler = RequestScheduler(min_interval=0.05)
+        started = []
+        for _ in range(3):
+            scheduler.run(URL, lambda: started.append(time.monotonic()))
+
+        self.assertGreaterEqual(started[1] - started[0], 0.045)
+        self.assertGreaterEqual(started[2] - started[1], 0.045)
+
+    def test_interactive_requests_go_first(self):
+        scheduler = RequestScheduler(max_concurrent=1, min_interval=0)
+        blocker = threading.Event()
+        order = []
+
+        def run(name, priority):
+            scheduler.run(URL, lambda: order.append(name), priority)
+
+        first = threading.Thread(
+            target=scheduler.run, args=(URL, blocker.wait))
+        first.start()
+        while not scheduler.hosts or not scheduler.hosts["flibusta.net"].active:
+            time.sleep(0.001)
+
+        threads = [
+            threading.Thread(target=run, args=("background", BACKGROUND)),
+            threading.Thread(target=run, args=("interactive", INTERACTIVE)),
+        ]
+        for thread in threads:
+            thread.start()
+            while scheduler.queue_depth() < threads.index(thread) + 1:
+                time.sleep(0.001)
+
+        blocker.set()
+        for thread in [first] + threads:
+            thread.join()
+        self.assertEqual(order, ["interactive", "background"])
+
+    def test_waiting_past_deadline_is_cancelled(self):
+        scheduler = RequestScheduler(max_concurrent=1, min_interval=0)
+        blocker = threading.Event()
+        first = threading.Thread(
+            target=scheduler.run, args=(URL, blocker.wait))
+        first.start()
+        while not scheduler.hosts or not scheduler.hosts["flibusta.net"].active:
+            time.sleep(0.001)
+
+        called = []
+        with self.assertRaises(DeadlineExceeded):
+            scheduler.run(
+                URL, lambda: called.append(1),
+                deadline=time.monotonic() + 0.02)
+
+        blocker.set()
+        first.join()
+        self.assertEqual(called, [])
+        self.assertEqual(scheduler.queue_depth(), 0)
+
+    def test_circuit_opens_after_failures_and_probes_after_timeout(self):
+        clock = FakeClock()
+        scheduler = RequestScheduler(
+            min_interval=0, failure_threshold=2, reset_timeout=30, clock=clock)
+
+        def fail():
+            raise ConnectionError()
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                scheduler.run(URL, fail)
+        with self.assertRaises(CircuitOpen):
+            scheduler.run(URL, lambda: None)
+
+        # Other hosts are not affected.
+        self.assertEqual(scheduler.run("http://other.net/", lambda: 1), 1)
+
+        clock.now += 30
+        with self.assertRaises(ConnectionError):
+            scheduler.run(URL, fail)
+        with self.assertRaises(CircuitOpen):
+            scheduler.run(URL, lambda: None)
+
+        clock.now += 30
+        self.assertEqual(scheduler.run(URL, lambda: 1), 1)
+        self.assertEqual(scheduler.run(URL, lambda: 2), 2)
+
+    def test_only_host_failures_open_the_circuit(self):
+        scheduler = RequestScheduler(min_interval=0, failure_threshold=1)
+
+        def fail(status_code):
+            return Mock(side_effect=requests.HTTPError(
+                response=Mock(status_code=status_code)))
+
+        with self.assertRaises(requests.HTTPError):
+            scheduler.run(URL, fail(404))
+        with self.assertRaises(ValueError):
+            scheduler.run(URL, Mock(side_effect=ValueError()))
+        self.assertEqual(scheduler.run(URL, lambda: 1), 1)
+
+        with self.assertRaises(requests.HTTPError):
+            scheduler.run(URL, fail(503))
+        with self.assertRaises(CircuitOpen):
+            scheduler.run(URL, lambda: None)
+
+    def test_timeouts_open_the_circuit(self):
+        scheduler = RequestScheduler(min_interval=0, failure_threshold=1)
+        with self.assertRaises(requests.Timeout):
+            scheduler.run(URL, Mock(side_effect=requests.Timeout()))
+        with self.assertRaises(CircuitOpen):
+            scheduler.run(URL, lambda: None)
@@ -0,0 +1,136 @@
+import json
+from unittest import TestCase
+from unittest.mock import patch, Mock
+
+from tamizdat.command import SearchCommand
+from tamizdat.models import make_database, Book, User
+from tamizdat.tracing import Tracer, current_trace, span
+
+from .fixtures import fake_book
+
+
+class TracerTestCase(TestCase):
+    def setUp(self):
+        self.database = make_database()
+        self.logger = Mock()
+        self.tracer = Tracer(
+            sample_rate=0, slow_threshold=60, logger=self.logger)
+
+    def emitted(self):
+        self.assertEqual(self.logger.info.call_count, 1)
+        (line, ), _ = self.logger.info.call_args
+        return json.loads(line)
+
+    def test_trace_emits_one_line_with_span_summaries(self):
+        with self.tracer.trace("request", chat_id=42) as trace:
+            with span("http", "http://example.com"):
+                pass
+            with span("http", "http://example.com/slow"):
+                pass
+            trace.set(outcome="done")
+
+        record = self.emitted()
+        self.assertEqual(record["trace"], "request")
+        self.assertEqual(record["chat_id"], 42)
+        self.assertEqual(record["outcome"], "done")
+        self.assertEqual(record["spans"]["http"]["count"], 2)
+        self.assertNotIn("detail", record)
+        self.assertIsNone(current_trace())
+
+    def test_database_queries_are_counted(self):
+        Book.create(**fake_book())
+
+        with self.tracer.trace("request"):
+            for book in Book.select():
+                list(book.authors)
+
+        record = self.emitted()
+        self.assertEqual(record["spans"]["db"]["count"], 2)
+        self.assertIn("SELECT", record["spans"]["db"]["slowest"])
+
+    def test_slow_requests_group_repeated_statements(self):
+        self.tracer.slow_threshold = 0
+        for _ in range(3):
+            Book.create(**fake_book())
+
+        with self.tracer.trace("request"):
+            for book in Book.select():
+                list(book.authors)
+
+        detail = self.emitted()["detail"]
+        self.assertEqual(len(detail), 2)
+        self.assertEqual(
+            sorted(statement["count"] for statement in detail), [1, 3])
+
+    def test_sampled_requests_are_detailed(self):
+        self.tracer.sample_rate = 1
+        with self.tracer.trace("request"):
+            with span("smtp", "reader@example.com"):
+                pass
+
+        detail, = self.emitted()["detail"]
+        self.assertEqual(detail["detail"], "reader@example.com")
+
+    def test_nested_traces_are_folded(self):
+        with self.tracer.trace("outer") as outer:
+            with self.tracer.trace("inner") as inner:
+                self.assertIs(inner, outer)
+
+        self.assertEqual(self.emitted()["trace"], "outer")
+
+    def test_errors_are_recorded(self):
+        with self.assertRaises(RuntimeError):
+            with self.tracer.trace("request"):
+                raise RuntimeError()
+
+        self.assertEqual(self.emitted()["error"], "RuntimeError")
+
+    def test_spans_outside_of_traces_are_ignored(self):
+        with span("db", "SELECT 1"):
+            pass
+        self.logger.info.assert_not_called()
+
+    def test_command_is_traced_per_update(self):
+        User.create(user_id=1, is_authorized=True)
+        index = Mock()
+        index.search.return_value = []
+        update = Mock()
+        update.update_id = 7
+        update.message.chat.id = 1
+        update.message.text = "Пикник на обочине"
+        context = Mock()
+
+        with patch("tamizdat.command.TRACER", self.tracer):
+            SearchCommand(index).handle_message(update, context)
+
+        record = self.emitted()
+        self.assertEqual(record["trace"], "SearchCommand")
+        self.assertEqual(record["update_id"], 7)
+        self.assertEqual(record["outcome"], "BookNotFoundResponse")
+        self.assertEqual(record["spans"]["db"]["count"], 1)
+        self.assertEqual(record["spans"]["telegram"]["count"], 1)
+
+    def test_replies_from_the_outbox_are_traced_with_the_update(self):
+        User.create(user_id=1, is_authorized=True)
+        index = Mock()
+        index.search.return_value = []
+        update = Mock()
+        update.update_id = 7
+        update.message.chat.id = 1
+        update.message.text = "Пикник на обочине"
+        command = SearchCommand(index)
+        command.outbox = Mock()
+
+        with patch("tamizdat.command.TRACER", self.tracer):
+            command.handle_message(update, Mock())
+            (_, serve, bot, message), _ = command.outbox.put.call_args
+            serve(bot, message)
+
+        self.assertEqual(self.logger.info.call_count, 2)
+        (line, ), _ = self.logger.info.call_args
+        record = json.loads(line)
+        self.assertEqual(record["trace"], "Reply")
+        self.assertEqual(record["command"], "SearchCommand")
+        self.assertEqual(record["update_id"], 7)
+        self.assertEqual(record["response"], "BookNotFoundResponse")
+        self.assertEqual(record["spans"]["telegram"]["count"], 1)
@@ -1,7 +1,9 @@
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 
-from tamizdat.models import make_database, Book, File
+import requests
+
+from tamizdat.models import make_database, Book, BookInfo, Ebook, File
 from tamizdat.website import Website
 
 
@@ -43,11 +45,13 @@ class WebsiteTestCase(TestCase):
 
         page_source = read_saved_page("93872")
         info = self.website._scrape_additional_info(page_source)
-        annotation, cover, ebook = info
+        annotation, cover, ebooks = info
 
         self.assertIsNotNone(annotation)
         self.assertTrue(cover.endswith("jpg"))
-        self.assertTrue(ebook.endswith("epub"))
+        self.assertEqual(set(ebooks), {"fb2", "epub", "mobi"})
+        for format_, url in ebooks.items():
+            self.assertTrue(url.endswith(format_))
 
     def test_appending_additional_info(self):
         self.website.requests.head = mock_head
@@ -60,7 +64,7 @@ class WebsiteTestCase(TestCase):
 
         self.assertIsNone(book.annotation)
         self.assertIsNone(book.cover_image)
-        self.assertIsNone(book.ebook_epub)
+        self.assertIsNone(book.get_ebook())
 
         self.website._append_additional_info(book, info)
 
@@ -69,6 +73,89 @@ class WebsiteTestCase(TestCase):
         self.assertIsInstance(book.cover_image, File)
         self.assertTrue(book.cover_image.remote_url.endswith(".jpg"))
 
-        self.assertIsInstance(book.ebook_epub, File)
-        self.assertTrue(book.ebook_epub.remote_url.endswith("/epub"))
-        self.assertTrue(book.ebook_epub.local_path.endswith(".epub"))
+        self.assertEqual(book.ebooks.count(), 3)
+        for ebook in book.ebooks:
+            self.assertIsInstance(ebook.file, File)
+            self.assertTrue(ebook.file.remote_url.endswith(ebook.format))
+            self.assertTrue(ebook.file.local_path.endswith(ebook.format))
+
+    def test_appending_additional_info_twice_keeps_one_ebook_per_format(self):
+        page_source = read_saved_page("93872")
+        info = self.website._scrape_additional_info(page_source)
+
+        book = Book(book_id=93872, title="Трудно быть богом")
+        book.save()
+
+        self.website._append_additional_info(book, info)
+        self.website._append_additional_info(book, info)
+        self.assertEqual(Ebook.select().count(), 3)
+
+    def test_appending_additional_info_twice_keeps_the_files(self):
+        page_source = read_saved_page("93872")
+        info = self.website._scrape_additional_info(page_source)
+
+        book = Book(book_id=93872, title="Трудно быть богом")
+        book.save()
+
+        self.website._append_additional_info(book, info)
+        book.cover_image.set_telegram_id(1, "photo_id")
+        files = {ebook.format: ebook.file_id for ebook in book.ebooks}
+
+        self.website._append_additional_info(book, info)
+        self.assertEqual(book.cover_image.get_telegram_id(1), "photo_id")
+        self.assertEqual(
+            {ebook.format: ebook.file_id for ebook in book.ebooks}, files)
+        self.assertEqual(File.select().count(), 4)
+
+    def test_fetching_additional_info_skips_books_without_ebooks(self):
+        book = Book(book_id=93872, title="Трудно быть богом")
+        book.save()
+
+        self.website.requests.get().__enter__().text = "<html></html>"
+        self.website.fetch_additional_info(book)
+        self.assertIsNotNone(BookInfo.get_or_none(BookInfo.book == 93872))
+
+        self.website.requests.get.reset_mock()
+        self.website.fetch_additional_info(book)
+        self.website.requests.get.assert_not_called()
+
+    def test_fetching_additional_info_skips_augmented_books(self):
+        book = Book(book_id=93872, title="Трудно быть богом")
+        book.save()
+
+        self.website.requests.get().__enter__().text = read_saved_page("93872")
+        self.website.fetch_additional_info(book)
+        self.assertTrue(book.augmented)
+
+        self.website.requests.get.reset_mock()
+        self.website.fetch_additional_info(book)
+        self.website.requests.get.assert_not_called()
+
+    def test_fetching_a_missing_page_raises(self):
+        book = Book(book_id=93872, title="Трудно быть богом")
+        book.save()
+
+        response = self.website.requests.get().__enter__()
+        response.raise_for_status.side_effect = requests.HTTPError()
+        with self.assertRaises(requests.HTTPError):
+            self.website.fetch_additional_info(book)
+        self.assertFalse(book.augmented)
+
+    def test_requests_time_out_by_the_deadline(self):
+        book = Book(book_id=93872, title="Трудно быть богом")
+        book.save()
+
+        self.website.requests.get().__enter__().text = "<html></html>"
+        with patch("tamizdat.website.time.monotonic", return_value=100):
+            self.website.fetch_additional_info(book, deadline=105)
+        self.website.requests.get.assert_called_with(
+            "http://flibusta.net/b/93872", timeout=5)
+
+    def test_requests_without_a_deadline_time_out_eventually(self):
+        book = Book(book_id=93872, title="Трудно быть богом")
+        book.save()
+
+        self.website.requests.get().__enter__().text = "<html></html>"
+        self.website.fetch_additional_info(book)
+        self.website.requests.get.assert_called_with(
+            "http://flibusta.net/b/93872", timeout=30)